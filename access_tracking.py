@@ -0,0 +1,30 @@
+from . import journal_types
+
+from efforting.mvp4 import type_system as TS
+from efforting.mvp4.type_system.bases import public_base
+
+from array import array
+import threading, time
+
+class access_tracker(public_base):
+	#Keeps only the latest access time per path until the next journal flush
+	latest_access = TS.factory(dict)
+	lock = TS.factory(threading.Lock)
+
+	def touch(self, path, now):
+		#Returns True if nothing was pending before
+		with self.lock:
+			first = not self.latest_access
+			self.latest_access[path] = now
+		return first
+
+	def __len__(self):
+		return len(self.latest_access)
+
+	def drain(self):
+		with self.lock:
+			if not self.latest_access:
+				return None
+			latest_access, self.latest_access = self.latest_access, dict()
+
+		return journal_types.access_batch(time.time(), tuple(latest_access), array('d', latest_access.values()))
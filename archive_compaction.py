@@ -0,0 +1,233 @@
+#Compaction of the journal archive into time bucketed segments.
+#The archive is first rotated out to <archive>.compacting, entries are then streamed into one segment per time bucket in <archive>.segments.
+#Segments are written to temporary files and a manifest listing them is put in place before they replace the old segments,
+#an interrupted compaction is either rolled forward (manifest exists) or started over (it doesn't).
+#Only the open buckets are kept in memory (and when collapsing, only the last change and access count per path of those).
+
+from . import journal_types
+from .journal_format import write_section, section_reader
+from .compression import CODECS
+from .pickling import db_dumps, db_loads
+
+from collections import OrderedDict
+from array import array
+import os, time
+
+SEGMENT_SUFFIX = '.segment'
+TEMPORARY_SUFFIX = '.tmp'
+
+
+def segment_directory(archive_filename):
+	return f'{archive_filename}.segments'
+
+def compacting_filename(archive_filename):
+	return f'{archive_filename}.compacting'
+
+def manifest_filename(archive_filename):
+	return f'{archive_filename}.compaction-manifest'
+
+def segment_filenames(archive_filename):
+	#Oldest first, names start with the UTC start time of the bucket
+	directory = segment_directory(archive_filename)
+	if not os.path.isdir(directory):
+		return []
+	return [os.path.join(directory, name) for name in sorted(os.listdir(directory)) if name.endswith(SEGMENT_SUFFIX)]
+
+
+def collapse_change(first, last):
+	#A path that changed several times in a bucket is described by a single change from the value before the bucket to the last value.
+	#It keeps the time of the last change, history read at an earlier time inside the bucket sees the value from before the bucket (or of a checkpoint inside it).
+	if isinstance(first, journal_types.update):
+		return journal_types.update(last.time, last.path, last.value, first.previous_value, version=last.version)
+	else:
+		return journal_types.create(last.time, last.path, last.value, version=last.version)
+
+
+class segment_builder:
+	def __init__(self, filename, collapse, section_size, compression=None):
+		self.filename = filename
+		self.compression = compression
+		self.temporary_filename = f'{filename}{TEMPORARY_SUFFIX}'
+		self.collapse = collapse
+		self.section_size = section_size
+		self.file = None
+		self.pending = list()
+		self.changes = dict()			#path -> (first change, last change)
+		self.access_counts = dict()		#path -> [count, last accessed]
+
+	def open(self):
+		reopened = os.path.exists(self.temporary_filename)
+		self.file = open(self.temporary_filename, 'ab')
+		if not reopened and os.path.exists(self.filename):
+			#Merge with what earlier compactions put in this bucket
+			with open(self.filename, 'rb') as existing:
+				for section in section_reader(existing):
+					for entry in section:
+						self.add(entry)
+
+	def count_access(self, path, count, timestamp):
+		if counter := self.access_counts.get(path):
+			counter[0] += count
+			counter[1] = max(counter[1], timestamp)
+		else:
+			self.access_counts[path] = [count, timestamp]
+
+	def add(self, entry):
+		if self.collapse:
+			#NOTE - create and update are subclasses of access so they must be matched first
+			match entry:
+				case journal_types.batch(changes=changes):
+					for change in changes:
+						self.add(change)
+					return
+				case journal_types.create(path=path):
+					previous = self.changes.get(path)
+					self.changes[path] = (previous[0] if previous else entry, entry)
+					return
+				case journal_types.access(path=path, time=timestamp):
+					self.count_access(path, 1, timestamp)
+					return
+				case journal_types.access_batch(paths=paths, timestamps=timestamps):
+					for path, timestamp in zip(paths, timestamps):
+						self.count_access(path, 1, timestamp)
+					return
+				case journal_types.access_summary(paths=paths, counts=counts, timestamps=timestamps):
+					for path, count, timestamp in zip(paths, counts, timestamps):
+						self.count_access(path, count, timestamp)
+					return
+
+		self.pending.append(entry)
+		if len(self.pending) >= self.section_size:
+			self.write_pending()
+
+	def write_pending(self):
+		if self.pending:
+			write_section(self.file, tuple(self.pending), self.compression)
+			self.pending = list()
+
+	def close(self):
+		if self.collapse:
+			self.pending.extend(collapse_change(first, last) for first, last in self.changes.values())
+			if self.access_counts:
+				paths = tuple(self.access_counts)
+				counts = array('Q', (count for count, timestamp in self.access_counts.values()))
+				timestamps = array('d', (timestamp for count, timestamp in self.access_counts.values()))
+				self.pending.append(journal_types.access_summary(max(timestamps), paths, counts, timestamps))
+			self.changes = dict()
+			self.access_counts = dict()
+
+		self.write_pending()
+		self.file.flush()
+		os.fsync(self.file.fileno())
+		self.file.close()
+		self.file = None
+
+
+def rotate_archive(archive_filename):
+	#Returns True if there is a rotated archive to compact. One left behind by an interrupted compaction is compacted before the archive is rotated again.
+	compacting = compacting_filename(archive_filename)
+	if os.path.exists(compacting):
+		return True
+	if not os.path.exists(archive_filename):
+		return False
+	os.replace(archive_filename, compacting)
+	return True
+
+
+def finish_interrupted_compaction(archive_filename):
+	directory = segment_directory(archive_filename)
+	manifest = manifest_filename(archive_filename)
+	if os.path.exists(manifest):
+		with open(manifest, 'rb') as manifest_file:
+			renames = db_loads(manifest_file.read())
+		for temporary_filename, filename in renames:
+			if os.path.exists(temporary_filename):
+				os.replace(temporary_filename, filename)
+
+		compacting = compacting_filename(archive_filename)
+		if os.path.exists(compacting):
+			os.remove(compacting)
+		os.remove(manifest)
+
+	elif os.path.isdir(directory):
+		#The manifest was never written so the rotated archive is still there and will be compacted again
+		for name in os.listdir(directory):
+			if name.endswith(TEMPORARY_SUFFIX):
+				os.remove(os.path.join(directory, name))
+
+
+def compact_rotated_archive(archive_filename, bucket_seconds=3600, collapse=False, section_size=1000, open_bucket_limit=4, compression=None):
+	start = time.monotonic()
+	finish_interrupted_compaction(archive_filename)
+	compacting = compacting_filename(archive_filename)
+	if not os.path.exists(compacting):
+		return None
+
+	directory = segment_directory(archive_filename)
+	os.makedirs(directory, exist_ok=True)
+
+	builders = dict()				#bucket -> segment_builder
+	open_builders = OrderedDict()	#bucket -> segment_builder, least recently used first
+	entry_count = 0
+	bytes_read = os.path.getsize(compacting)
+
+	with open(compacting, 'rb') as compacting_file:
+		reader = section_reader(compacting_file)
+		for section in reader:
+			for entry in section:
+				bucket = int(entry.time // bucket_seconds)
+				if builder := open_builders.get(bucket):
+					open_builders.move_to_end(bucket)
+				else:
+					if not (builder := builders.get(bucket)):
+						start_time = time.strftime('%Y%m%dT%H%M%S', time.gmtime(bucket * bucket_seconds))
+						builder = builders[bucket] = segment_builder(os.path.join(directory, f'{start_time}-{bucket_seconds}{SEGMENT_SUFFIX}'), collapse, section_size, compression)
+					builder.open()
+					open_builders[bucket] = builder
+					if len(open_builders) > open_bucket_limit:
+						open_builders.popitem(last=False)[1].close()
+
+				builder.add(entry)
+				entry_count += 1
+
+	for builder in open_builders.values():
+		builder.close()
+
+	renames = tuple((builder.temporary_filename, builder.filename) for builder in builders.values())
+	manifest = manifest_filename(archive_filename)
+	with open(f'{manifest}{TEMPORARY_SUFFIX}', 'wb') as manifest_file:
+		manifest_file.write(db_dumps(renames))
+		manifest_file.flush()
+		os.fsync(manifest_file.fileno())
+	os.replace(f'{manifest}{TEMPORARY_SUFFIX}', manifest)
+
+	finish_interrupted_compaction(archive_filename)
+
+	return dict(
+		entry_count = entry_count,
+		section_count = reader.section_count,
+		torn_bytes = bytes_read - reader.valid_end,
+		bytes_read = bytes_read,
+		segments_written = len(renames),
+		segment_bytes = sum(os.path.getsize(filename) for temporary_filename, filename in renames),
+		duration = time.monotonic() - start,
+	)
+
+
+def compact_archive(archive_filename, bucket_seconds=3600, collapse=False, section_size=1000, open_bucket_limit=4, compression=None):
+	#Offline compaction, the database must not be running. See database_core.compact_archive for online compaction.
+	finish_interrupted_compaction(archive_filename)
+	if rotate_archive(archive_filename):
+		return compact_rotated_archive(archive_filename, bucket_seconds, collapse, section_size, open_bucket_limit, compression)
+
+
+if __name__ == '__main__':
+	import argparse
+	parser = argparse.ArgumentParser(description='Compact journal archive into time bucketed segments')
+	parser.add_argument('filename', type=str, nargs='?', default='db-journal-archive.pickle', help='Filename of the journal archive')
+	parser.add_argument('--bucket-seconds', type=int, default=3600, help='Length of the time span covered by each segment')
+	parser.add_argument('--collapse', action='store_true', help='Keep only the last change per path and access counts in each segment')
+	parser.add_argument('--compression', type=str, choices=CODECS, help='Compress the sections of the segments')
+	args = parser.parse_args()
+
+	print(compact_archive(args.filename, args.bucket_seconds, args.collapse, compression=args.compression))
@@ -0,0 +1,255 @@
+from .wire_format import create_codec, encode_hello, hello_reply, HELLO_MAGIC, PROTOCOL_LEGACY, SUPPORTED_PROTOCOLS, protocol_error
+from .blob_store import DEFAULT_CHUNK_SIZE
+
+import asyncio, itertools, collections
+
+SENTINEL = object()
+
+
+class async_interface:
+	def __init__(self, reader, writer):
+		self.reader = reader
+		self.writer = writer
+		self.outstanding_queries = dict()	#Keyed by request id
+		self.request_ids = itertools.count(1)
+		self.decoder, self.encode = create_codec(PROTOCOL_LEGACY)
+		self.response_task = None
+
+	async def negotiate(self, protocols=SUPPORTED_PROTOCOLS):
+		#Must be called before start, offering only PROTOCOL_LEGACY skips the hello (see wire_format.open_channel)
+		if tuple(protocols) == (PROTOCOL_LEGACY,):
+			return
+		self.writer.write(encode_hello(protocols))
+		try:
+			magic, protocol = hello_reply.unpack(await self.reader.readexactly(hello_reply.size))
+		except asyncio.IncompleteReadError:
+			raise protocol_error('Connection closed during protocol negotiation, the endpoint might predate it (offer only PROTOCOL_LEGACY)') from None
+		if magic != HELLO_MAGIC:
+			raise protocol_error('Invalid hello reply')
+		if protocol not in protocols:
+			raise protocol_error(f'Endpoint supports none of the offered protocols {tuple(protocols)}')
+		self.decoder, self.encode = create_codec(protocol)
+
+	async def get_db_info(self):
+		return await self.query('get_db_info').require_response()
+
+	async def get_metrics(self):
+		return await self.query('get_metrics').require_response()
+
+	async def get(self, path, default=None):
+		return await self.query('get', str(path), default).require_response()
+
+	async def require(self, path):
+		return await self.query('require', str(path)).require_response()
+
+	async def set(self, path, value, durability=None):
+		await self.query('set', str(path), value, durability).require_response()
+
+	async def compare_and_set(self, path, expected_version, value, durability=None):
+		return await self.query('compare_and_set', str(path), expected_version, value, durability).require_response()
+
+	async def update_if_unmodified(self, path, function, default=None, durability=None, max_attempts=None):
+		#Same as interface.update_if_unmodified in service_client
+		current = await self.get_meta(path, None, True)
+		for attempt in itertools.count(1):
+			version, value = (current.version, current.value) if current else (0, default)
+			success, result = await self.compare_and_set(path, version, function(value), durability)
+			if success:
+				return result
+			if max_attempts is not None and attempt >= max_attempts:
+				raise Exception(f'{path} was modified concurrently in {attempt} attempts')
+			current = result
+
+	async def set_stream(self, path, chunks, durability=None, window=4):
+		#Same as interface.set_stream in service_client, chunks may also be an async iterable
+		upload_id = await self.query('set_stream_open', str(path)).require_response()
+		in_flight = collections.deque()
+
+		async def send(chunk):
+			in_flight.append(self.query('set_stream_write', upload_id, bytes(chunk)))
+			if len(in_flight) > window:
+				await in_flight.popleft().require_response()
+			else:
+				await self.writer.drain()
+
+		try:
+			if hasattr(chunks, '__aiter__'):
+				async for chunk in chunks:
+					await send(chunk)
+			else:
+				for chunk in chunks:
+					await send(chunk)
+			while in_flight:
+				await in_flight.popleft().require_response()
+		except:
+			if not self.writer.is_closing():
+				self.query('set_stream_abort', upload_id)
+			raise
+
+		return await self.query('set_stream_commit', upload_id, durability).require_response()
+
+	async def get_stream(self, path, chunk_size=DEFAULT_CHUNK_SIZE, window=4):
+		#Same as interface.get_stream in service_client
+		download_id = await self.query('get_stream_open', str(path), chunk_size).require_response()
+		in_flight = collections.deque()
+		try:
+			while True:
+				while len(in_flight) < window:
+					in_flight.append(self.query('get_stream_read', download_id))
+				if (chunk := await in_flight.popleft().require_response()) is None:
+					return
+				yield chunk
+		finally:
+			if not self.writer.is_closing():
+				self.query('get_stream_close', download_id)
+
+	async def list_paths_page(self, prefix='', chunk_size=1000, cursor=None):
+		return await self.query('list_paths', str(prefix), chunk_size, cursor).require_response()
+
+	async def list_paths(self, prefix='', chunk_size=1000, cursor=None):
+		#Same as interface.list_paths in service_client
+		while True:
+			page = await self.list_paths_page(prefix, chunk_size, cursor)
+			for path in page:
+				yield path
+			if len(page) < chunk_size:
+				return
+			cursor = page[-1]
+
+	async def get_meta(self, path, default=None, load_value=False):
+		return await self.query('get_meta', str(path), default, load_value).require_response()
+
+	async def get_at(self, path, timestamp, default=None):
+		return await self.query('get_at', str(path), timestamp, default).require_response()
+
+	async def restore_to(self, timestamp, durability=None):
+		return await self.query('restore_to', timestamp, durability).require_response()
+
+	async def multi_get(self, paths, default=None):
+		return await self.query('multi_get', tuple(map(str, paths)), default).require_response()
+
+	async def multi_set(self, mapping, durability=None):
+		await self.query('multi_set', {str(path): value for path, value in mapping.items()}, durability).require_response()
+
+	async def batch(self, operations, durability=None):
+		return await self.query('batch', tuple((command, str(path), *rest) for command, path, *rest in operations), durability).require_response()
+
+	async def watch(self, path, last_known_updated=None, include_values=False):
+		#Same as interface.watch in service_client
+		while True:
+			q = self.query('watch', str(path), last_known_updated, include_values)
+			overflow = False
+			try:
+				async for batch in q.partials():
+					for notification in batch:
+						if notification.kind == 'overflow':
+							overflow = True
+							last_known_updated = notification.updated
+						else:
+							yield notification
+			finally:
+				if not q.finished.is_set() and not self.writer.is_closing():
+					self.query('unwatch', q.request_id)
+
+			await q.require_response()
+			if not overflow:
+				return
+
+
+	def query(self, command, *arguments):
+		q = async_query(next(self.request_ids), command, arguments)
+		self.outstanding_queries[q.request_id] = q
+		self.writer.writelines(self.encode((q.request_id, q.command, *q.arguments)))
+		return q
+
+	def start(self):
+		self.response_task = asyncio.create_task(self.handle_query_responses())
+
+	async def handle_query_responses(self):
+		try:
+			while data := await self.reader.read(64 * 1024):
+				for state, request_id, arguments in self.decoder.feed(data):
+					if state == 'response':
+						self.outstanding_queries.pop(request_id).emit_response(arguments)
+					elif state == 'failure':
+						self.outstanding_queries.pop(request_id).emit_failure(arguments)
+					elif state == 'partial':
+						self.outstanding_queries[request_id].emit_partial(arguments)
+					else:
+						raise Exception((state, request_id, arguments))
+
+		finally:
+			#Nothing more will arrive, make sure nobody waits forever
+			for q in self.outstanding_queries.values():
+				q.emit_failure('Connection closed')
+			self.outstanding_queries.clear()
+
+	async def close(self):
+		self.writer.close()
+		await self.writer.wait_closed()
+		if self.response_task:
+			await asyncio.gather(self.response_task, return_exceptions=True)
+
+
+class async_query:
+	def __init__(self, request_id, command, arguments):
+		self.request_id = request_id
+		self.command = command
+		self.arguments = arguments
+		self.finished = asyncio.Event()
+		self.partial = asyncio.Queue()
+		self.success = False
+
+	def emit_response(self, response):
+		self.response = response
+		self.partial.put_nowait(SENTINEL)
+		self.success = True
+		self.finished.set()
+
+	def emit_failure(self, failure):
+		self.response = failure
+		self.partial.put_nowait(SENTINEL)
+		self.success = False
+		self.finished.set()
+
+	def emit_partial(self, response):
+		self.partial.put_nowait(response)
+
+	async def partials(self):
+		while (item := await self.partial.get()) is not SENTINEL:
+			yield item
+
+	async def wait(self):
+		await self.finished.wait()
+		return self.success, self.response
+
+	async def require_response(self):
+		await self.finished.wait()
+		if self.success:
+			return self.response
+		else:
+			import textwrap
+			TAB = '\t'
+			raise Exception(f'Remote error:\n\n{textwrap.indent(self.response, TAB)}')
+
+
+class async_remote_db_interface:
+	def __init__(self, host, port, protocols=SUPPORTED_PROTOCOLS):
+		self.host = host
+		self.port = port
+		self.protocols = protocols
+		self.remote = None
+
+	async def __aenter__(self):
+		reader, writer = await asyncio.open_connection(self.host, self.port)
+		self.remote = async_interface(reader, writer)
+		try:
+			await self.remote.negotiate(self.protocols)
+		except:
+			writer.close()
+			raise
+		self.remote.start()
+		return self.remote
+
+	async def __aexit__(self, et, ev, tb):
+		await self.remote.close()
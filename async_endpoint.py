@@ -0,0 +1,184 @@
+#asyncio based service endpoint, serves the same command set as service_endpoint.query_server on a single event loop.
+#Commands that may block (writes wait for the write lock and possibly for fsync) are run in the default executor.
+
+from .db_core import database_core
+from .wire_format import create_codec, decode_hello, is_hello, pick_protocol, hello_reply, HELLO_MAGIC, PROTOCOL_LEGACY, protocol_error
+from .service_endpoint import create_command_set, open_session, close_session, format_exception, stream_by_session
+from .subscriptions import subscription
+
+from collections.abc import Iterator
+import asyncio, time
+
+SENTINEL = object()
+
+#Commands that only read memory and are cheap enough to run directly on the event loop
+inline_commands = frozenset((
+	'ping',
+	'get_db_info',
+	'get_metrics',
+	'session_lock',
+	'session_unlock',
+	'unwatch',
+))
+
+#Commands reading values, by a function of their arguments returning the paths read.
+#They run on the event loop only if every one of those values is resident, see database_core.values_resident.
+value_commands = dict(
+	require = lambda path: (path,),
+	get = lambda path, default=None: (path,),
+	get_meta = lambda path, default=None, load_value=False: (path,) if load_value else (),
+	multi_get = lambda paths, default=None: paths,
+)
+
+
+class async_session:
+	def __init__(self, reader, writer, command_set, metrics=None, db=None):
+		self.reader = reader
+		self.writer = writer
+		self.command_set = command_set
+		self.metrics = metrics
+		self.db = db		#Database of command_set, without it value_commands always run in the executor
+		self.decoder = None
+		self.encode = None
+		self.stream_tasks = set()
+
+	def write(self, value):
+		if not self.writer.is_closing():
+			self.writer.writelines(self.encode(value))
+
+	def is_inline(self, command, arguments):
+		if command in inline_commands:
+			return True
+		if self.db and (paths_read := value_commands.get(command)):
+			try:
+				return self.db.values_resident(paths_read(*arguments))
+			except TypeError:
+				return False	#Wrong arguments, the command reports it
+		return False
+
+	async def call(self, command, *arguments):
+		if self.is_inline(command, arguments):
+			return self.command_set[command](self, *arguments)
+		else:
+			return await asyncio.get_running_loop().run_in_executor(None, self.command_set[command], self, *arguments)
+
+	async def forward_stream(self, request_id, stream):
+		loop = asyncio.get_running_loop()
+		wake = asyncio.Event()
+
+		def listener():
+			try:
+				loop.call_soon_threadsafe(wake.set)
+			except RuntimeError:
+				pass	#Event loop is closed
+
+		stream.listener = listener
+		start_time = time.monotonic()
+		try:
+			while (batch := stream.take(0)) is not None:
+				if batch:
+					self.write(('partial', request_id, batch))
+					await self.writer.drain()
+				else:
+					await wake.wait()
+					wake.clear()
+			self.write(('response', request_id, time.monotonic() - start_time))
+
+		except ConnectionError:
+			pass
+
+		finally:
+			stream.close()
+			stream_by_session.get(self, {}).pop(request_id, None)
+
+	async def execute(self, request_id, command, arguments):
+		start_time = time.perf_counter()
+		failed = False
+		try:
+			result = await self.call(command, *arguments)
+			if isinstance(result, subscription):
+				#Detached, the session keeps serving other requests while notifications are forwarded
+				stream_by_session[self][request_id] = result
+				task = asyncio.create_task(self.forward_stream(request_id, result))
+				self.stream_tasks.add(task)
+				task.add_done_callback(self.stream_tasks.discard)
+				return
+
+			elif isinstance(result, Iterator):
+				loop = asyncio.get_running_loop()
+				stream_start = time.monotonic()
+				while (sub_item := await loop.run_in_executor(None, next, result, SENTINEL)) is not SENTINEL:
+					self.write(('partial', request_id, sub_item))
+					await self.writer.drain()
+				stop_time = time.monotonic()
+				result = stop_time - stream_start
+
+		except Exception as e:
+			failed = True
+			self.write(('failure', request_id, format_exception(e)))
+		else:
+			self.write(('response', request_id, result))
+
+		if self.metrics and command in self.command_set:
+			self.metrics.record_command(command, time.perf_counter() - start_time, failed)
+
+	async def negotiate(self):
+		#Returns data received after the hello, None if the connection closed or no protocol could be agreed on
+		data = await self.reader.read(64 * 1024)
+		if not data:
+			return None
+		if not is_hello(data[:1]):
+			self.decoder, self.encode = create_codec(PROTOCOL_LEGACY)
+			return data
+
+		while (hello := decode_hello(data)) is None:
+			if not (more := await self.reader.read(64 * 1024)):
+				return None
+			data += more
+
+		offered, size = hello
+		protocol = pick_protocol(offered)
+		self.writer.write(hello_reply.pack(HELLO_MAGIC, protocol))
+		if not protocol:
+			return None
+		self.decoder, self.encode = create_codec(protocol)
+		return data[size:]
+
+	async def handle(self):
+		try:
+			if (data := await self.negotiate()) is None:
+				return
+
+			open_session(self)
+			try:
+				#data may be empty when only the hello has arrived so far
+				while True:
+					for request_id, command, *arguments in self.decoder.feed(data):
+						await self.execute(request_id, command, arguments)
+
+					#Responses to everything that arrived together are sent together
+					await self.writer.drain()
+					if not (data := await self.reader.read(64 * 1024)):
+						break
+			finally:
+				close_session(self)
+
+		except (ConnectionError, protocol_error):
+			pass
+
+		finally:
+			self.writer.close()
+
+
+async def serve(command_set, host, port, metrics=None, db=None):
+	async def handle_connection(reader, writer):
+		await async_session(reader, writer, command_set, metrics, db).handle()
+
+	server = await asyncio.start_server(handle_connection, host, port, reuse_address=True)
+	async with server:
+		await server.serve_forever()
+
+
+if __name__ == '__main__':
+	with database_core(journal_auto_flush_timeout=None) as db:
+		asyncio.run(serve(create_command_set(db), '0.0.0.0', 55201, db.metrics, db))
@@ -0,0 +1,51 @@
+#Shared helpers for the benchmark modules, see run_all.py
+
+from efforting.persistent_storage2.storage_types import namespace
+
+import contextlib, tempfile, time, os
+
+
+@contextlib.contextmanager
+def temporary_directory():
+	#Databases use relative filenames so every benchmark runs in a directory of its own
+	original_directory = os.getcwd()
+	with tempfile.TemporaryDirectory() as directory:
+		os.chdir(directory)
+		try:
+			yield directory
+		finally:
+			os.chdir(original_directory)
+
+
+def timed(function, *arguments):
+	start = time.perf_counter()
+	result = function(*arguments)
+	return time.perf_counter() - start, result
+
+def best_of(repeat, function, *arguments):
+	return min(timed(function, *arguments)[0] for _ in range(repeat))
+
+def percentiles(samples, fractions=(0.5, 0.9, 0.99)):
+	ordered = sorted(samples)
+	return {f'p{round(fraction * 100)}': ordered[min(int(fraction * len(ordered)), len(ordered) - 1)] for fraction in fractions}
+
+def result(name, **values):
+	#name identifies the measurement across runs, see run_all.compare
+	print(f'{name:<56} ' + ' '.join(f'{key}={value:.6g}' if isinstance(value, float) else f'{key}={value}' for key, value in values.items()))
+	return dict(name=name, **values)
+
+
+def nested_value(width=10, depth=3):
+	if depth == 0:
+		return list(range(width))
+	return {f'key_{n}': nested_value(width, depth - 1) for n in range(width)}
+
+value_shapes = dict(
+	scalar = 12345,
+	string_1k = 'x' * 1024,
+	bytes_64k = bytes(64 * 1024),
+	flat_list_1k = list(range(1000)),
+	flat_dict_1k = {f'key_{n}': n for n in range(1000)},
+	namespace_100 = namespace({f'field_{n}': n for n in range(100)}),
+	nested_10x3 = nested_value(10, 3),		#~1100 containers, 10k integers
+)
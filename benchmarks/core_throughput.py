@@ -0,0 +1,32 @@
+#database_core.store, load and get throughput by value shape, with and without freeze_values
+
+from efforting.persistent_storage2.db_core import database_core
+
+from common import temporary_directory, timed, result, value_shapes
+
+
+def main(quick=False):
+	results = list()
+	for freeze_values in (False, True):
+		for shape, value in value_shapes.items():
+			operations = 200 if shape.startswith('nested') else 20000
+			if quick:
+				operations //= 10
+
+			with temporary_directory(), database_core(create_snapshot=True, freeze_values=freeze_values, journal_auto_flush_timeout=None) as db:
+				paths = [f'benchmark.key_{n % 100}' for n in range(operations)]
+				store_duration, _ = timed(lambda: [db.store(path, value) for path in paths])
+				load_duration, _ = timed(lambda: [db.load(path) for path in paths])
+				get_duration, _ = timed(lambda: [db.get(path) for path in paths])
+
+			results.append(result(f'core.{shape}.freeze_{freeze_values}',
+				store_per_second = operations / store_duration,
+				load_per_second = operations / load_duration,
+				get_per_second = operations / get_duration,
+			))
+
+	return results
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,67 @@
+#Size and speed of snapshot and journal files per compression codec.
+#threaded_seconds is writing the snapshot pickle through compressing_writer (compressed on a worker thread while pickling),
+#inline_seconds is pickling and then compressing on one thread for comparison.
+
+from efforting.persistent_storage2.db_core import database_core
+from efforting.persistent_storage2.compression import compress, compressing_writer
+from efforting.persistent_storage2.pickling import db_dumps, db_pickler
+
+from common import temporary_directory, timed, result
+
+import os
+
+
+def text_value(n):
+	return {'name': f'item {n}', 'tags': ['alpha', 'beta', 'gamma'], 'text': f'lorem ipsum dolor sit amet {n % 100} ' * 10}
+
+
+def write_threaded(entries, codec):
+	with open('threaded.pickle', 'wb') as file, compressing_writer(file, codec) as compressed_file:
+		db_pickler(compressed_file).dump(entries)
+
+def write_inline(entries, codec):
+	with open('inline.pickle', 'wb') as file:
+		file.write(compress(codec, db_dumps(entries)))
+
+
+def main(quick=False):
+	results = list()
+	dataset_size = 10000 if quick else 100000
+
+	for codec in (None, 'zlib', 'lzma', 'bz2'):
+		with temporary_directory():
+			configuration = dict(snapshot_compression=codec, journal_compression=codec, archive_compression=codec, journal_auto_flush_timeout=None)
+			with database_core(create_snapshot=True, **configuration) as db:
+				db.store_many((f'benchmark.key_{n}', text_value(n)) for n in range(dataset_size))
+				write_duration, _ = timed(db.flush_everything)
+
+				entries = db.capture_entries()
+				if codec:
+					threaded_duration, _ = timed(write_threaded, entries, codec)
+					inline_duration, _ = timed(write_inline, entries, codec)
+
+				for n in range(dataset_size // 10):
+					db.store(f'benchmark.key_{n}', text_value(n + 1))
+					if n % 1000 == 999:
+						db.flush_journal()
+				db.flush_journal()
+				journal_bytes = os.path.getsize(db.journal_filename)
+
+			db = database_core(**configuration)
+			db.create_journal_stream(db.journal_filename)
+			load_duration, _ = timed(db.load_snapshot)
+			db.journal_file.close()
+
+			results.append(result(f'compression.{codec}',
+				snapshot_bytes = os.path.getsize(db.snapshot_filename),
+				snapshot_write_seconds = write_duration,
+				**(dict(threaded_seconds=threaded_duration, inline_seconds=inline_duration) if codec else {}),
+				snapshot_load_seconds = load_duration,
+				journal_bytes = journal_bytes,
+			))
+
+	return results
+
+
+if __name__ == '__main__':
+	main()
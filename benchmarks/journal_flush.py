@@ -0,0 +1,41 @@
+#flush_journal time by number of pending entries and flush_everything time by dataset size
+
+from efforting.persistent_storage2.db_core import database_core
+
+from common import temporary_directory, timed, result
+
+
+def main(quick=False):
+	results = list()
+	sizes = (1000, 10000) if quick else (1000, 10000, 100000)
+
+	for pending in sizes:
+		#The writer thread is not started so that the benchmark controls when flushing happens
+		with temporary_directory():
+			db = database_core(create_snapshot=True)
+			db.create_journal_stream(db.journal_filename)
+			db.load_snapshot()
+			for n in range(pending):
+				db.store(f'benchmark.key_{n}', n)
+			duration, _ = timed(db.flush_journal)
+			db.journal_file.close()
+
+		results.append(result(f'journal.flush_journal.{pending}', seconds=duration, entries_per_second=pending / duration))
+
+	for snapshot_format in ('pickle', 'indexed'):
+		for dataset_size in sizes:
+			with temporary_directory(), database_core(create_snapshot=True, snapshot_format=snapshot_format, journal_auto_flush_timeout=None) as db:
+				db.store_many(((f'benchmark.key_{n}', {'n': n, 'text': f'value {n}'}) for n in range(dataset_size)))
+				duration, statistics = timed(db.flush_everything, False)
+
+			results.append(result(f'journal.flush_everything.{snapshot_format}.{dataset_size}',
+				seconds = duration,
+				capture_seconds = statistics['capture_duration'],
+				bytes_written = statistics['bytes_written'],
+			))
+
+	return results
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,52 @@
+#Write throughput of database_core.store with a growing number of writer threads, each writing to its own paths.
+#Compares a single write lock stripe (everything serializes like the old global write_lock) with the default striping.
+
+from efforting.persistent_storage2.db_core import database_core
+from efforting.persistent_storage2.locking import striped_lock
+
+import threading, tempfile, time, os
+
+
+def run(thread_count, stripe_count, durability, writes_per_thread):
+	with tempfile.TemporaryDirectory() as directory:
+		os.chdir(directory)
+		with database_core(create_snapshot=True, write_lock=striped_lock(stripe_count), journal_auto_flush_timeout=0.05) as db:
+			start_barrier = threading.Barrier(thread_count + 1)
+
+			def writer(index):
+				start_barrier.wait()
+				for n in range(writes_per_thread):
+					db.store(f'writer_{index}.key_{n % 100}', n, durability)
+
+			threads = [threading.Thread(target=writer, args=(index,)) for index in range(thread_count)]
+			for thread in threads:
+				thread.start()
+
+			start_barrier.wait()
+			start = time.perf_counter()
+			for thread in threads:
+				thread.join()
+			duration = time.perf_counter() - start
+
+	return thread_count * writes_per_thread / duration
+
+
+def main(thread_counts=(1, 2, 4, 8, 16), writes_per_thread=2000):
+	original_directory = os.getcwd()
+	results = list()
+	try:
+		for durability in ('none', 'fsync'):
+			for stripe_count in (1, 64):
+				for thread_count in thread_counts:
+					per_thread = writes_per_thread if durability == 'none' else writes_per_thread // 10
+					writes_per_second = run(thread_count, stripe_count, durability, per_thread)
+					results.append(dict(name=f'lock_contention.{durability}.stripes_{stripe_count}.threads_{thread_count}', writes_per_second=writes_per_second))
+					print(f'durability={durability:<6} stripes={stripe_count:<3} threads={thread_count:<3} {writes_per_second:12.0f} writes/s')
+	finally:
+		os.chdir(original_directory)
+
+	return results
+
+
+if __name__ == '__main__':
+	main()
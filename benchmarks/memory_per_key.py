@@ -0,0 +1,60 @@
+#Memory held per stored key, measured with tracemalloc.
+#database is everything a database_core allocates for the keys (symbols, entries, path index, values),
+#records compares an entry record alone as storage_types.entry and as entry_table.compact_entry.
+
+from efforting.persistent_storage2.db_core import database_core
+from efforting.persistent_storage2.entry_table import entry_table
+from efforting.persistent_storage2 import storage_types
+
+from common import temporary_directory, result
+
+import multiprocessing, tracemalloc, gc, time
+
+
+def allocated(function):
+	#Returns (bytes still allocated after calling function, the return value)
+	gc.collect()
+	tracemalloc.start()
+	try:
+		before = tracemalloc.get_traced_memory()[0]
+		value = function()
+		gc.collect()
+		return tracemalloc.get_traced_memory()[0] - before, value
+	finally:
+		tracemalloc.stop()
+
+
+def measure_database(dataset_size):
+	with temporary_directory():
+		with database_core(create_snapshot=True, journal_auto_flush_timeout=None) as db:
+			def fill():
+				db.store_many((f'benchmark.group_{n % 100}.key_{n}', n) for n in range(dataset_size))
+				db.flush_journal()
+			return allocated(fill)[0]
+
+def measure_entries(dataset_size):
+	now = time.time()
+	return allocated(lambda: [storage_types.entry(f'benchmark.group_{n % 100}.key_{n}', n, now, now, now) for n in range(dataset_size)])[0]
+
+def measure_compact_entries(dataset_size):
+	now = time.time()
+	table = entry_table()
+	return allocated(lambda: [table.add(f'benchmark.group_{n % 100}.key_{n}', n, now, now, now) for n in range(dataset_size)])[0]
+
+
+def main(quick=False):
+	dataset_size = 20000 if quick else 200000
+	results = list()
+
+	#Every measurement runs in a fresh process so that memory freed by the previous one isn't reused and left out
+	context = multiprocessing.get_context('spawn')
+	for name, measure in (('database', measure_database), ('records.entry', measure_entries), ('records.compact_entry', measure_compact_entries)):
+		with context.Pool(1) as pool:
+			size = pool.apply(measure, (dataset_size,))
+		results.append(result(f'memory.{name}', bytes_per_key=size / dataset_size))
+
+	return results
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,103 @@
+#Read throughput through connection_pool with 0, 1 and 2 replicas (replica.py processes) and how long a write takes to become visible on a replica.
+#The primary and the clients run in this process, every replica in a process of its own.
+
+from efforting.persistent_storage2.db_core import database_core
+from efforting.persistent_storage2.service_endpoint import query_server, create_command_set
+from efforting.persistent_storage2.service_client import remote_db_interface
+from efforting.persistent_storage2.client_pool import connection_pool
+
+from common import temporary_directory, result, percentiles
+
+import subprocess, threading, socket, time, sys, os
+
+
+def free_port():
+	with socket.socket() as sock:
+		sock.bind(('127.0.0.1', 0))
+		return sock.getsockname()[1]
+
+
+def start_replica(primary_port):
+	port = free_port()
+	process = subprocess.Popen((sys.executable, '-m', 'efforting.persistent_storage2.replica', '--primary', f'127.0.0.1:{primary_port}', '--port', str(port)), env=os.environ)
+	deadline = time.monotonic() + 60
+	while time.monotonic() < deadline:
+		try:
+			with remote_db_interface('127.0.0.1', port) as remote:
+				if remote.query('get_replication_status').require_response()['ready']:
+					return process, port
+		except OSError:
+			pass
+		time.sleep(0.1)
+
+	process.kill()
+	raise TimeoutError('Replica did not become ready')
+
+
+def run_readers(pool, dataset_size, reader_count, reads_per_reader):
+	def reader(index):
+		for n in range(reads_per_reader):
+			pool.get(f'benchmark.key_{(index * reads_per_reader + n) % dataset_size}')
+
+	threads = [threading.Thread(target=reader, args=(index,)) for index in range(reader_count)]
+	start = time.perf_counter()
+	for thread in threads:
+		thread.start()
+	for thread in threads:
+		thread.join()
+	return reader_count * reads_per_reader / (time.perf_counter() - start)
+
+
+def visibility_delays(primary, replica_port, count):
+	delays = list()
+	with remote_db_interface('127.0.0.1', replica_port) as replica:
+		for n in range(count):
+			start = time.perf_counter()
+			primary.set('benchmark.visibility', n)
+			while replica.get('benchmark.visibility') != n:
+				pass
+			delays.append(time.perf_counter() - start)
+	return delays
+
+
+def main(quick=False):
+	results = list()
+	dataset_size = 1000 if quick else 10000
+	reads_per_reader = 250 if quick else 2500
+	reader_count = 8
+
+	with temporary_directory(), database_core(create_snapshot=True) as db:
+		db.store_many((f'benchmark.key_{n}', n) for n in range(dataset_size))
+		with query_server(('127.0.0.1', 0), create_command_set(db), metrics=db.metrics) as server:
+			threading.Thread(target=server.serve_forever, daemon=True).start()
+			port = server.server_address[1]
+
+			replicas = list()
+			try:
+				for replica_count in (0, 1, 2):
+					while len(replicas) < replica_count:
+						replicas.append(start_replica(port))
+
+					with connection_pool('127.0.0.1', port, max_connections=reader_count, replicas=[('127.0.0.1', replica_port) for process, replica_port in replicas]) as pool:
+						reads_per_second = run_readers(pool, dataset_size, reader_count, reads_per_reader)
+						statistics = pool.statistics()
+
+					results.append(result(f'replication.get.replicas_{replica_count}',
+						reads_per_second = reads_per_second,
+						replica_reads = statistics.get('replica_reads', 0),
+					))
+
+				with remote_db_interface('127.0.0.1', port) as primary:
+					delays = visibility_delays(primary, replicas[0][1], 20 if quick else 200)
+				results.append(result('replication.visibility', **{f'{key}_ms': value * 1e3 for key, value in percentiles(delays).items()}))
+
+			finally:
+				for process, replica_port in replicas:
+					process.terminate()
+					process.wait()
+
+	return results
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,88 @@
+#Runs the benchmark suite and appends the results to a results file (one JSON document per run) so that runs of different versions can be compared.
+#	python benchmarks/run_all.py [--quick] [--only core_throughput ...] [--results benchmarks/results.jsonl]
+#Each run is compared to the previous run in the results file, measurements are matched by name.
+
+import core_throughput, value_copying, journal_flush, startup, service_throughput, lock_contention, file_compression, memory_per_key, value_tiering, replication
+
+import json, os, platform, subprocess, sys, time
+
+suite = dict(
+	core_throughput = core_throughput.main,
+	value_copying = value_copying.main,
+	journal_flush = journal_flush.main,
+	startup = startup.main,
+	service_throughput = service_throughput.main,
+	lock_contention = lambda quick: lock_contention.main(writes_per_thread=200 if quick else 2000),
+	file_compression = file_compression.main,
+	memory_per_key = memory_per_key.main,
+	value_tiering = value_tiering.main,
+	replication = replication.main,
+)
+
+benchmark_directory = os.path.dirname(os.path.abspath(__file__))
+
+
+def describe_version():
+	try:
+		return subprocess.run(('git', 'describe', '--always', '--dirty'), cwd=benchmark_directory, capture_output=True, text=True, check=True).stdout.strip()
+	except (OSError, subprocess.CalledProcessError):
+		return None
+
+
+def load_runs(filename):
+	if not os.path.exists(filename):
+		return []
+	with open(filename) as results_file:
+		return [json.loads(line) for line in results_file if line.strip()]
+
+
+def compare(previous, current):
+	#Prints the ratio current / previous of every numeric value that changed by more than 10%
+	previous_by_name = {item['name']: item for item in previous['results']}
+	print(f'---= Compared to {previous["version"]} ({time.ctime(previous["started"])}) =---')
+	for item in current['results']:
+		if not (before := previous_by_name.get(item['name'])):
+			continue
+		for key, value in item.items():
+			if isinstance(value, (int, float)) and isinstance(before.get(key), (int, float)) and before[key]:
+				ratio = value / before[key]
+				if abs(ratio - 1) > 0.1:
+					print(f'{item["name"]:<56} {key:<24} {ratio:6.2f}x')
+
+
+def main(selected=None, quick=False, results_filename=None):
+	results_filename = results_filename or os.path.join(benchmark_directory, 'results.jsonl')
+	run = dict(
+		version = describe_version(),
+		started = time.time(),
+		quick = quick,
+		python = sys.version,
+		platform = platform.platform(),
+		cpu_count = os.cpu_count(),
+		results = list(),
+	)
+
+	for name, benchmark in suite.items():
+		if selected and name not in selected:
+			continue
+		print(f'---= {name} =---')
+		for item in benchmark(quick):
+			run['results'].append(dict(item, name=item.get('name') or f'{name}.{len(run["results"])}'))
+
+	previous_runs = [previous for previous in load_runs(results_filename) if previous['quick'] == quick]
+	with open(results_filename, 'a') as results_file:
+		results_file.write(json.dumps(run) + '\n')
+
+	if previous_runs:
+		compare(previous_runs[-1], run)
+
+
+if __name__ == '__main__':
+	import argparse
+	parser = argparse.ArgumentParser(description='Run benchmark suite')
+	parser.add_argument('--only', type=str, nargs='+', choices=tuple(suite), help='Only run these benchmarks')
+	parser.add_argument('--quick', action='store_true', help='Smaller datasets, for checking that the suite works')
+	parser.add_argument('--results', type=str, help='Results file, defaults to results.jsonl next to this script')
+	args = parser.parse_args()
+
+	main(args.only, args.quick, args.results)
@@ -0,0 +1,95 @@
+#End to end throughput and latency of service_endpoint with N concurrent service_client connections against a local server
+#Large values are measured with both wire protocols since only PROTOCOL_FRAMED sends them out of band.
+#Every large write sends a new object, PROTOCOL_LEGACY would otherwise only send a reference to its memo.
+
+from efforting.persistent_storage2.db_core import database_core
+from efforting.persistent_storage2.service_endpoint import query_server, create_command_set
+from efforting.persistent_storage2.service_client import remote_db_interface
+from efforting.persistent_storage2.wire_format import PROTOCOL_LEGACY, PROTOCOL_FRAMED
+
+from common import temporary_directory, result, percentiles
+
+import threading, time
+
+
+def run_clients(port, connection_count, requests_per_connection, command, value=0, protocols=(PROTOCOL_FRAMED,)):
+	latencies = list()
+	start_barrier = threading.Barrier(connection_count + 1)
+
+	def client(index):
+		with remote_db_interface('localhost', port, protocols) as remote:
+			remote.set(f'benchmark.client_{index}', value)
+			samples = list()
+			start_barrier.wait()
+			for n in range(requests_per_connection):
+				start = time.perf_counter()
+				if command == 'get':
+					remote.get(f'benchmark.client_{index}')
+				else:
+					remote.set(f'benchmark.client_{index}', value and value[:-8] + n.to_bytes(8) or n)
+				samples.append(time.perf_counter() - start)
+			latencies.extend(samples)
+
+	threads = [threading.Thread(target=client, args=(index,)) for index in range(connection_count)]
+	for thread in threads:
+		thread.start()
+	start_barrier.wait()
+	start = time.perf_counter()
+	for thread in threads:
+		thread.join()
+	duration = time.perf_counter() - start
+
+	return len(latencies) / duration, percentiles(latencies)
+
+
+def run_stream(port, size, chunk_size=256 * 1024):
+	chunk = bytes(chunk_size)
+	with remote_db_interface('localhost', port) as remote:
+		start = time.perf_counter()
+		remote.set_stream('benchmark.stream', (chunk for n in range(size // chunk_size)))
+		set_duration = time.perf_counter() - start
+
+		start = time.perf_counter()
+		for chunk in remote.get_stream('benchmark.stream', chunk_size):
+			pass
+		get_duration = time.perf_counter() - start
+
+	return size / set_duration / 1e6, size / get_duration / 1e6
+
+
+def main(quick=False):
+	results = list()
+	requests_per_connection = 500 if quick else 5000
+
+	with temporary_directory(), database_core(create_snapshot=True, journal_auto_flush_timeout=1) as db:
+		with query_server(('localhost', 0), create_command_set(db), metrics=db.metrics) as server:
+			threading.Thread(target=server.serve_forever, daemon=True).start()
+			port = server.server_address[1]
+			try:
+				for command in ('get', 'set'):
+					for connection_count in (1, 4, 16):
+						requests_per_second, latency = run_clients(port, connection_count, requests_per_connection // connection_count, command)
+						results.append(result(f'service.{command}.connections_{connection_count}',
+							requests_per_second = requests_per_second,
+							**{f'{key}_us': value * 1e6 for key, value in latency.items()},
+						))
+
+				large_value = bytes(1 << 20)
+				for protocol_name, protocol in (('legacy', PROTOCOL_LEGACY), ('framed', PROTOCOL_FRAMED)):
+					requests_per_second, latency = run_clients(port, 1, requests_per_connection // 10, 'set', large_value, (protocol,))
+					results.append(result(f'service.set_1mb.{protocol_name}',
+						requests_per_second = requests_per_second,
+						**{f'{key}_us': value * 1e6 for key, value in latency.items()},
+					))
+
+				set_throughput, get_throughput = run_stream(port, (16 if quick else 256) << 20)
+				results.append(result('service.set_stream', megabytes_per_second=set_throughput))
+				results.append(result('service.get_stream', megabytes_per_second=get_throughput))
+			finally:
+				server.shutdown()
+
+	return results
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,60 @@
+#Startup time: load_snapshot by snapshot size and recover_journal by journal size
+
+from efforting.persistent_storage2.db_core import database_core
+
+from common import temporary_directory, timed, result
+
+import os
+
+
+def main(quick=False):
+	results = list()
+	sizes = (1000, 10000) if quick else (1000, 10000, 100000)
+
+	for snapshot_format in ('pickle', 'indexed'):
+		for dataset_size in sizes:
+			with temporary_directory():
+				with database_core(create_snapshot=True, snapshot_format=snapshot_format, journal_auto_flush_timeout=None) as db:
+					db.store_many(((f'benchmark.key_{n}', {'n': n, 'text': f'value {n}'}) for n in range(dataset_size)))
+
+				#Exiting wrote a snapshot and left an empty journal
+				db = database_core(snapshot_format=snapshot_format)
+				db.create_journal_stream(db.journal_filename)
+				duration, _ = timed(db.load_snapshot)
+				db.journal_file.close()
+
+				results.append(result(f'startup.load_snapshot.{snapshot_format}.{dataset_size}',
+					seconds = duration,
+					snapshot_bytes = os.path.getsize(db.snapshot_filename),
+				))
+
+	for journal_size in sizes:
+		with temporary_directory():
+			db = database_core(create_snapshot=True, journal_batch_size=1000)
+			db.create_journal_stream(db.journal_filename)
+			db.load_snapshot()
+			for n in range(journal_size):
+				db.store(f'benchmark.key_{n % 1000}', n)
+				if n % 1000 == 999:
+					db.flush_journal()
+			db.flush_journal()
+			db.journal_file.close()
+
+			#Reopen without the snapshot that terminating would write, everything comes from the journal
+			db = database_core()
+			db.create_journal_stream(db.journal_filename)
+			db.load_snapshot()
+			duration, _ = timed(db.recover_journal)
+			db.journal_file.close()
+
+			results.append(result(f'startup.recover_journal.{journal_size}',
+				seconds = duration,
+				journal_bytes = os.path.getsize(db.journal_filename),
+				entries_per_second = db.last_recovery['entries_per_second'],
+			))
+
+	return results
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,27 @@
+#Cost of prepare_for_storage, deep_copy and freeze by value shape
+
+from efforting.persistent_storage2.data_utils import prepare_for_storage, deep_copy, freeze
+
+from common import best_of, result, value_shapes
+
+
+def main(quick=False):
+	results = list()
+	for shape, value in value_shapes.items():
+		repeat = 20 if shape.startswith('nested') else 2000
+		if quick:
+			repeat //= 10
+
+		frozen = freeze(value)
+		results.append(result(f'copying.{shape}',
+			prepare_for_storage_us = best_of(5, lambda: [prepare_for_storage(value) for _ in range(repeat)]) / repeat * 1e6,
+			deep_copy_us = best_of(5, lambda: [deep_copy(value) for _ in range(repeat)]) / repeat * 1e6,
+			freeze_us = best_of(5, lambda: [freeze(value) for _ in range(repeat)]) / repeat * 1e6,
+			deep_copy_frozen_us = best_of(5, lambda: [deep_copy(frozen) for _ in range(repeat)]) / repeat * 1e6,
+		))
+
+	return results
+
+
+if __name__ == '__main__':
+	main()
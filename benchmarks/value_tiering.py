@@ -0,0 +1,53 @@
+#Throughput with a memory_budget smaller than the dataset, reads are skewed so that a hot set stays resident.
+#budget_fraction is the budget relative to the estimated size of all values, 1.0 runs without a budget.
+
+from efforting.persistent_storage2.db_core import database_core
+from efforting.persistent_storage2.data_utils import estimated_size
+
+from common import temporary_directory, timed, result
+
+import random
+
+
+def value(n):
+	return {'name': f'item {n}', 'tags': ['alpha', 'beta', 'gamma'], 'text': f'lorem ipsum dolor sit amet {n}' * 8}
+
+
+def skewed_keys(dataset_size, count, hot_fraction=0.1, hot_share=0.9):
+	#hot_share of the reads go to the first hot_fraction of the keys
+	generator = random.Random(1)
+	hot_size = max(1, int(dataset_size * hot_fraction))
+	return [f'benchmark.key_{generator.randrange(hot_size) if generator.random() < hot_share else generator.randrange(dataset_size)}' for _ in range(count)]
+
+
+def main(quick=False):
+	results = list()
+	dataset_size = 20000 if quick else 200000
+	read_count = dataset_size
+	dataset_bytes = sum(estimated_size(value(n)) for n in range(dataset_size))
+	paths = skewed_keys(dataset_size, read_count)
+
+	for budget_fraction in (1.0, 0.5, 0.2):
+		with temporary_directory():
+			memory_budget = None if budget_fraction == 1.0 else int(dataset_bytes * budget_fraction)
+			with database_core(create_snapshot=True, journal_auto_flush_timeout=None, memory_budget=memory_budget) as db:
+				store_duration, _ = timed(lambda: [db.store(f'benchmark.key_{n}', value(n)) for n in range(dataset_size)])
+				load_duration, _ = timed(lambda: [db.load(path) for path in paths])
+				snapshot_duration, _ = timed(db.flush_everything)
+				report = db.tiering_report()
+
+			results.append(result(f'tiering.budget_{budget_fraction}',
+				store_per_second = dataset_size / store_duration,
+				load_per_second = read_count / load_duration,
+				snapshot_seconds = snapshot_duration,
+				resident_bytes = report['resident_bytes'] or dataset_bytes,
+				spills = report['spills'],
+				faults = report['faults'],
+				fault_rate = report['fault_rate'] or 0.0,
+			))
+
+	return results
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,86 @@
+#Content addressed files for values stored with database_core.store_stream.
+#A blob is written to a temporary file while it arrives and moved into place, named by the sha256 of its content, once complete.
+#Entries, journal entries and snapshots only hold a blob_reference so large values are never part of the snapshot pickle.
+#Blob files are immutable and not removed automatically since history (get_at, checkpoints, the archive) may still refer to them.
+
+from .storage_types import blob_reference
+
+import hashlib, tempfile, os
+
+DEFAULT_CHUNK_SIZE = 256 * 1024		#Above wire_format.OUT_OF_BAND_THRESHOLD so chunks are sent without being copied into the payload
+
+
+class blob_writer:
+	def __init__(self, store):
+		self.store = store
+		self.hash = hashlib.sha256()
+		self.size = 0
+		descriptor, self.temporary_filename = tempfile.mkstemp(prefix='incoming-', dir=store.directory)
+		self.file = os.fdopen(descriptor, 'wb')
+		self.reference = None
+
+	def write(self, chunk):
+		self.hash.update(chunk)
+		self.file.write(chunk)
+		self.size += len(chunk)
+
+	def commit(self):
+		#Durable before it is returned so that a journaled reference never outlives its blob
+		self.file.flush()
+		os.fsync(self.file.fileno())
+		self.file.close()
+		self.reference = blob_reference(self.hash.hexdigest(), self.size)
+		os.replace(self.temporary_filename, self.store.filename(self.reference))	#Content addressed, replacing an existing blob changes nothing
+		return self.reference
+
+	def close(self):
+		#Discards the blob unless it was committed
+		if self.reference is None:
+			self.file.close()
+			try:
+				os.unlink(self.temporary_filename)
+			except FileNotFoundError:
+				pass
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, et, ev, tb):
+		self.close()
+
+
+class blob_store:
+	def __init__(self, directory):
+		self.directory = directory
+
+	def filename(self, reference):
+		return os.path.join(self.directory, reference.digest)
+
+	def writer(self):
+		os.makedirs(self.directory, exist_ok=True)
+		return blob_writer(self)
+
+	def read(self, reference):
+		with open(self.filename(reference), 'rb') as blob_file:
+			return blob_file.read()
+
+	def chunks(self, reference, chunk_size=DEFAULT_CHUNK_SIZE):
+		#The file is opened right away so a missing blob is reported before iterating
+		return read_chunks(open(self.filename(reference), 'rb'), chunk_size)
+
+	def remove_incomplete(self):
+		#Temporary files left behind by writers that never finished
+		if os.path.isdir(self.directory):
+			for name in os.listdir(self.directory):
+				if name.startswith('incoming-'):
+					os.unlink(os.path.join(self.directory, name))
+
+
+def read_chunks(blob_file, chunk_size):
+	with blob_file:
+		while chunk := blob_file.read(chunk_size):
+			yield chunk
+
+def slice_chunks(value, chunk_size):
+	for offset in range(0, len(value), chunk_size):
+		yield value[offset:offset + chunk_size]
@@ -0,0 +1,262 @@
+from .service_client import interface, connection_lost
+from .wire_format import SUPPORTED_PROTOCOLS
+from .blob_store import DEFAULT_CHUNK_SIZE
+
+import threading, socket, time, collections, contextlib, itertools
+
+
+class connection_pool:
+	#Thread safe pool of service_client.interface connections.
+	#Use per call (pool.get(...)) or check out a connection for a sequence of calls (with pool.connection() as db: ...).
+	#With replicas ((host, port) of replica.py processes) get, require, get_meta and multi_get go to the replicas in turn.
+	#Replicas lag behind the primary, a read failing on a replica (unreachable, not bootstrapped, missing path) is retried on the primary.
+
+	def __init__(self, host, port, min_connections=1, max_connections=8, health_check_interval=30, connect_timeout=10, checkout_timeout=None, protocols=SUPPORTED_PROTOCOLS, replicas=(), replica_retry_interval=5):
+		self.host = host
+		self.port = port
+		self.min_connections = min_connections
+		self.max_connections = max_connections
+		self.health_check_interval = health_check_interval		#Idle connections older than this are pinged before being handed out
+		self.connect_timeout = connect_timeout
+		self.checkout_timeout = checkout_timeout
+		self.protocols = protocols
+
+		self.condition = threading.Condition()
+		self.idle = collections.deque()		#(interface, monotonic time when returned)
+		self.open_count = 0
+		self.closed = False
+		self.counters = collections.Counter()	#Statistics only, updated without locking
+		self.replicas = tuple(connection_pool(replica_host, replica_port, 0, max_connections, health_check_interval, connect_timeout, checkout_timeout, protocols) for replica_host, replica_port in replicas)
+		self.replica_turns = itertools.count()
+		self.replica_retry_interval = replica_retry_interval		#A replica that couldn't be reached is left alone for this long
+		self.replica_retry_at = [0] * len(self.replicas)
+
+	def connect(self):
+		sock = socket.create_connection((self.host, self.port), self.connect_timeout)
+		remote = interface(sock, self.protocols)	#Protocol negotiation is still covered by connect_timeout
+		sock.settimeout(None)
+		remote.start()
+		self.counters['connections_created'] += 1
+		return remote
+
+	def fill(self):
+		while True:
+			with self.condition:
+				if self.closed or self.open_count >= self.min_connections:
+					return
+				self.open_count += 1
+
+			try:
+				remote = self.connect()
+			except:
+				self.forget_connection()
+				raise
+
+			self.release(remote)
+
+	def is_healthy(self, remote, idle_since):
+		if remote.broken:
+			return False
+		if self.health_check_interval is None or time.monotonic() - idle_since < self.health_check_interval:
+			return True
+
+		self.counters['health_checks'] += 1
+		try:
+			if remote.ping(self.connect_timeout):
+				return True
+		except connection_lost:
+			pass
+
+		self.counters['health_check_failures'] += 1
+		return False
+
+	def acquire(self):
+		deadline = None if self.checkout_timeout is None else time.monotonic() + self.checkout_timeout
+		while True:
+			with self.condition:
+				while True:
+					if self.closed:
+						raise Exception('Connection pool is closed')
+					elif self.idle:
+						remote, idle_since = self.idle.pop()		#Most recently used first, it is the least likely to be stale
+						break
+					elif self.open_count < self.max_connections:
+						remote = None
+						self.open_count += 1
+						break
+
+					self.counters['checkout_waits'] += 1
+					remaining = None if deadline is None else deadline - time.monotonic()
+					if remaining is not None and remaining <= 0 or not self.condition.wait(remaining):
+						raise TimeoutError('No connection available')
+
+			self.counters['checkouts'] += 1
+			if remote is None:
+				try:
+					return self.connect()
+				except:
+					self.forget_connection()
+					raise
+
+			elif self.is_healthy(remote, idle_since):
+				return remote
+
+			self.discard(remote)
+
+	def release(self, remote):
+		if remote.broken:
+			self.discard(remote)
+			return
+
+		with self.condition:
+			if not self.closed:
+				self.idle.append((remote, time.monotonic()))
+				self.condition.notify()
+				return
+
+		self.discard(remote)
+
+	def discard(self, remote):
+		self.counters['connections_discarded'] += 1
+		remote.close()
+		self.forget_connection()
+
+	def forget_connection(self):
+		with self.condition:
+			self.open_count -= 1
+			self.condition.notify()
+
+	@contextlib.contextmanager
+	def connection(self):
+		remote = self.acquire()
+		try:
+			yield remote
+		finally:
+			self.release(remote)
+
+	def call(self, method, *arguments):
+		#A connection that broke before or while we used it is replaced and the call is retried once
+		for attempt in range(2):
+			with self.connection() as remote:
+				try:
+					return getattr(remote, method)(*arguments)
+				except connection_lost:
+					self.counters['reconnects'] += 1
+					if attempt:
+						raise
+
+	def read_call(self, method, *arguments):
+		for attempt in range(len(self.replicas)):
+			index = next(self.replica_turns) % len(self.replicas)
+			if self.replica_retry_at[index] > time.monotonic():
+				continue
+
+			try:
+				result = self.replicas[index].call(method, *arguments)
+			except (connection_lost, OSError):
+				self.counters['replica_unreachable'] += 1
+				self.replica_retry_at[index] = time.monotonic() + self.replica_retry_interval
+			except Exception:
+				self.counters['replica_fallbacks'] += 1		#Remote error, the primary answers instead
+				break
+			else:
+				self.counters['replica_reads'] += 1
+				return result
+
+		return self.call(method, *arguments)
+
+	def get_db_info(self):
+		return self.call('get_db_info')
+
+	def get_metrics(self):
+		return self.call('get_metrics')
+
+	def get(self, path, default=None):
+		return self.read_call('get', path, default)
+
+	def require(self, path):
+		return self.read_call('require', path)
+
+	def set(self, path, value, durability=None):
+		return self.call('set', path, value, durability)
+
+	def compare_and_set(self, path, expected_version, value, durability=None):
+		#Retrying after a lost connection is safe, if the first attempt went through the retry reports a conflict
+		return self.call('compare_and_set', path, expected_version, value, durability)
+
+	def update_if_unmodified(self, path, function, default=None, durability=None, max_attempts=None):
+		#Not retried on another connection since function might then be applied twice
+		with self.connection() as remote:
+			return remote.update_if_unmodified(path, function, default, durability, max_attempts)
+
+	def set_stream(self, path, chunks, durability=None, window=4):
+		#Not retried since chunks may not be iterable twice
+		with self.connection() as remote:
+			return remote.set_stream(path, chunks, durability, window)
+
+	def get_stream(self, path, chunk_size=DEFAULT_CHUNK_SIZE, window=4):
+		#The connection is checked out until the generator is exhausted or closed
+		with self.connection() as remote:
+			yield from remote.get_stream(path, chunk_size, window)
+
+	def list_paths_page(self, prefix='', chunk_size=1000, cursor=None):
+		return self.read_call('list_paths_page', prefix, chunk_size, cursor)
+
+	def list_paths(self, prefix='', chunk_size=1000, cursor=None):
+		#Every page is a call of its own so no connection stays checked out while the paths are consumed
+		while True:
+			page = self.list_paths_page(prefix, chunk_size, cursor)
+			yield from page
+			if len(page) < chunk_size:
+				return
+			cursor = page[-1]
+
+	def get_meta(self, path, default=None, load_value=False):
+		return self.read_call('get_meta', path, default, load_value)
+
+	def get_at(self, path, timestamp, default=None):
+		return self.call('get_at', path, timestamp, default)
+
+	def restore_to(self, timestamp, durability=None):
+		return self.call('restore_to', timestamp, durability)
+
+	def multi_get(self, paths, default=None):
+		return self.read_call('multi_get', paths, default)
+
+	def multi_set(self, mapping, durability=None):
+		return self.call('multi_set', mapping, durability)
+
+	def batch(self, operations, durability=None):
+		return self.call('batch', operations, durability)
+
+	def statistics(self):
+		with self.condition:
+			return dict(
+				self.counters,
+				open = self.open_count,
+				idle = len(self.idle),
+				in_use = self.open_count - len(self.idle),
+				min_connections = self.min_connections,
+				max_connections = self.max_connections,
+				replicas = tuple(replica.statistics() for replica in self.replicas),
+			)
+
+	def close(self):
+		with self.condition:
+			self.closed = True
+			idle = tuple(remote for remote, idle_since in self.idle)
+			self.idle.clear()
+			self.condition.notify_all()
+
+		for remote in idle:
+			self.discard(remote)
+
+		for replica in self.replicas:
+			replica.close()
+
+	def __enter__(self):
+		self.fill()
+		return self
+
+	def __exit__(self, et, ev, tb):
+		self.close()
@@ -0,0 +1,114 @@
+#Optional stdlib compression of snapshot, journal and archive files.
+#Journal sections are compressed one by one, their frame magic tells which codec was used (see journal_format).
+#Snapshots are compressed in the container format of the codec (gzip for zlib, xz for lzma, bz2) and recognized by their leading bytes.
+
+import zlib, lzma, bz2, gzip
+import concurrent.futures, collections, os
+
+CODECS = ('zlib', 'lzma', 'bz2')
+ZLIB_LEVEL = 6
+
+containers = (		#(leading bytes, file type reading the container)
+	(b'\x1f\x8b', lambda file: gzip.GzipFile(fileobj=file, mode='rb')),
+	(b'\xfd7zXZ\x00', lzma.LZMAFile),
+	(b'BZh', bz2.BZ2File),
+)
+
+
+def compress(codec, data):
+	match codec:
+		case 'zlib':
+			return zlib.compress(data, ZLIB_LEVEL)
+		case 'lzma':
+			return lzma.compress(data)
+		case 'bz2':
+			return bz2.compress(data)
+		case _:
+			raise ValueError(codec)
+
+def decompress(codec, data):
+	match codec:
+		case 'zlib':
+			return zlib.decompress(data)
+		case 'lzma':
+			return lzma.decompress(data)
+		case 'bz2':
+			return bz2.decompress(data)
+		case _:
+			raise ValueError(codec)
+
+def stream_compressor(codec):
+	#Incremental compressor producing the container format of codec
+	match codec:
+		case 'zlib':
+			return zlib.compressobj(ZLIB_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+		case 'lzma':
+			return lzma.LZMACompressor()
+		case 'bz2':
+			return bz2.BZ2Compressor()
+		case _:
+			raise ValueError(codec)
+
+def open_decompressed(file):
+	#File object reading the decompressed content of file if it holds a compressed container, otherwise None. The position of file is kept.
+	start = file.tell()
+	header = file.read(6)
+	file.seek(start)
+	for magic, file_type in containers:
+		if header.startswith(magic):
+			return file_type(file)
+	return None
+
+
+class compressing_writer:
+	#Write only file object producing a compressed container. Data is cut into chunks that are compressed independently on worker threads
+	#while the caller keeps producing data (the codecs release the GIL), each chunk is a complete stream and readers of all three formats
+	#accept concatenated streams. Compressed chunks are written in order by the caller.
+	def __init__(self, file, codec, chunk_size=1 << 20, workers=None):
+		self.file = file
+		self.codec = codec
+		self.chunk_size = chunk_size
+		self.buffer = bytearray()
+		workers = workers or min(4, os.cpu_count() or 1)
+		self.executor = concurrent.futures.ThreadPoolExecutor(workers, thread_name_prefix='compressor')
+		self.pending = collections.deque()		#Futures of compressed chunks not written yet
+		self.queue_depth = 2 * workers			#Bounds memory use, the caller waits for the oldest chunk beyond this
+		self.chunk_count = 0
+
+	def submit(self, chunk):
+		self.pending.append(self.executor.submit(compress_stream, self.codec, chunk))
+		self.chunk_count += 1
+		while len(self.pending) > self.queue_depth or (self.pending and self.pending[0].done()):
+			self.file.write(self.pending.popleft().result())
+
+	def write(self, data):
+		self.buffer += data
+		if len(self.buffer) >= self.chunk_size:
+			self.submit(bytes(self.buffer))
+			self.buffer.clear()
+		return len(data)
+
+	def close(self):
+		if self.executor is None:
+			return
+		try:
+			if self.buffer or not self.chunk_count:
+				#An empty input still produces a valid, empty container
+				self.submit(bytes(self.buffer))
+				self.buffer.clear()
+			while self.pending:
+				self.file.write(self.pending.popleft().result())
+		finally:
+			self.executor.shutdown(cancel_futures=True)
+			self.executor = None
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, et, ev, tb):
+		self.close()
+
+
+def compress_stream(codec, data):
+	compressor = stream_compressor(codec)
+	return compressor.compress(data) + compressor.flush()
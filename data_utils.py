@@ -1,4 +1,6 @@
-from .storage_types import namespace
+from .storage_types import namespace, frozen_namespace, frozen_mapping, blob_reference
+
+import sys
 
 
 def dict_map(function, dct):
@@ -9,9 +11,12 @@ def dict_items(function, items):
 
 def prepare_for_storage(item):
 	match item:
-		case int() | float() | str() | bytes():
+		case int() | float() | str() | bytes() | blob_reference():
 			return item
 
+		case frozen_mapping() | frozen_namespace():
+			return freeze(item)
+
 		case tuple() | list() | set() | frozenset():
 			return type(item)(map(prepare_for_storage, item))
 
@@ -30,7 +35,10 @@ def prepare_for_storage(item):
 
 def deep_copy(item):
 	match item:
-		case int() | float() | str() | bytes():
+		case int() | float() | str() | bytes() | blob_reference():
+			return item
+
+		case frozen_mapping() | frozen_namespace():
 			return item
 
 		case tuple() | list() | set() | frozenset():
@@ -49,3 +57,45 @@ def deep_copy(item):
 			raise TypeError(item)
 
 
+def freeze(item):
+	match item:
+		case int() | float() | str() | bytes() | blob_reference():
+			return item
+
+		case tuple() | list():
+			return tuple(map(freeze, item))
+
+		case set() | frozenset():
+			return frozenset(map(freeze, item))
+
+		case dict() | frozen_mapping():
+			return frozen_mapping(dict_items(freeze, item.items()))
+
+		case namespace():
+			return frozen_namespace(dict_items(freeze, item))
+
+		case _ if item is None:
+			return item
+
+		case _:
+			raise TypeError(item)
+
+
+
+def estimated_size(item):
+	#Bytes of memory held by item and everything in it, objects referenced more than once are counted every time
+	match item:
+		case int() | float() | str() | bytes() | blob_reference():
+			return sys.getsizeof(item)
+
+		case tuple() | list() | set() | frozenset():
+			return sys.getsizeof(item) + sum(map(estimated_size, item))
+
+		case dict():
+			return sys.getsizeof(item) + sum(estimated_size(k) + estimated_size(v) for k, v in item.items())
+
+		case frozen_mapping() | namespace():
+			return sys.getsizeof(item) + estimated_size(item._data)
+
+		case _:
+			return sys.getsizeof(item)
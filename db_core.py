@@ -1,163 +1,776 @@
 from . import storage_types, journal_types
+from .access_tracking import access_tracker
+from .locking import striped_lock, journal_buffer
 from .file_utils import stream_copy
-from .data_utils import deep_copy, prepare_for_storage
-from .pickling import db_pickler, db_unpickler
+from .data_utils import deep_copy, prepare_for_storage, freeze, estimated_size
+from .pickling import db_pickler
+from .journal_format import write_section, section_reader, copy_sections
+from .compression import compressing_writer
+from .snapshot_format import snapshot_value, write_indexed_snapshot, read_snapshot
+from .archive_compaction import rotate_archive, compact_rotated_archive, segment_filenames, compacting_filename
+from .time_index import section_time_index
+from .metrics import metrics_registry, timed_lock
+from .subscriptions import subscription, subscription_registry, change_notification
+from .blob_store import blob_store, slice_chunks, DEFAULT_CHUNK_SIZE
+from .path_index import path_index
+from .entry_table import entry_table
+from .value_store import value_store, spilled_value
+from .journal_shipping import journal_feed, journal_shipment, bootstrap_shipments
 
 from efforting.mvp4 import type_system as TS
 from efforting.mvp4.type_system.bases import public_base
 from efforting.mvp4.symbols.directory import symbol_node
 
-#TODO - We should also consider having an event system so that we can subscribe to changes to certain paths
-#		this might be implemented in a way where we supply a "last known value" of some kind so that we can make sure
-#		we don't get a race condition.
-
 #TODO - we should consider a locking mechanism which also should be part of the snapshot.
 #		maybe locks have keys (which are not a security measure but rather a method to ensure that intentions are followed properly)
 
-import time, threading, os
+import time, threading, os, itertools, heapq, shutil
 
+DURABILITY_NONE = 'none'		#Return as soon as the entry is queued for the journal writer
+DURABILITY_WRITE = 'write'		#Return when the batch holding the entry has been written to the journal file
+DURABILITY_FSYNC = 'fsync'		#Return when the batch holding the entry has been fsynced (group commit)
+DURABILITY_MODES = (DURABILITY_NONE, DURABILITY_WRITE, DURABILITY_FSYNC)
 
 
 class database_core(public_base):
 	#TODO - mark these as "private" to make intentions clear
 	symbol_tree = TS.factory(symbol_node)
 	storage_map = TS.factory(dict)
+	entry_table = TS.factory(entry_table)		#Compact records and timestamp columns of the entries in storage_map
+	path_index = TS.factory(path_index)		#Sorted paths of storage_map for list_paths and prefix scans
 
 	#Config
 	#TODO - maybe rename journal stuff to make it more clear what is recovery journal and what is archive
-	journal_auto_flush_timeout = TS.named(10)
+	journal_auto_flush_timeout = TS.named(10)		#Max age in seconds of a pending batch before the journal writer flushes it, None disables age based flushing
+	journal_batch_size = TS.named(1000)				#Flush as soon as this many entries are pending
+	default_durability = TS.named(DURABILITY_NONE)
 	journal_filename = TS.named('db-journal-recovery.pickle')
 	journal_archive_filename = TS.named('db-journal-archive.pickle')
+	journal_rotated_filename = TS.named('db-journal-rotated.pickle')	#Journal sections waiting for a snapshot in progress to complete
 	snapshot_filename = TS.named('db-snapshot.pickle')
+	snapshot_format = TS.named('pickle')		#'pickle' for a single pickled tuple, 'indexed' for a memory mapped index with lazily decoded values (load_snapshot detects either)
+	snapshot_compression = TS.named(None)		#None, 'zlib', 'lzma' or 'bz2'. Only for the 'pickle' format, compressed on a worker thread while pickling
+	journal_compression = TS.named(None)		#Codec for sections of the recovery journal, compressed by the journal writer
+	archive_compression = TS.named(None)		#Codec sections are recompressed with when archived or compacted
+	background_snapshots = TS.named(False)		#flush_everything returns as soon as the point in time view has been captured
+
+	checkpoint_interval = TS.named(None)		#Keep a copy of a completed snapshot at most this often (seconds) for get_at and restore_to, None disables checkpoints
+	checkpoint_directory = TS.named('db-checkpoints')
+	blob_directory = TS.named('db-blobs')		#Values stored with store_stream, see blob_store
+	value_store_filename = TS.named('db-values.pickle')
+
+	memory_budget = TS.named(None)		#Bytes (estimated) of resident values before the least recently accessed are spilled to the value store, None keeps every value resident
+	spill_target = TS.named(0.9)		#Spilling continues until resident values fit in this fraction of memory_budget
 
 	create_snapshot = TS.named(False)
+	freeze_values = TS.named(False)		#Store values as immutable equivalents so that reads and journal entries can share them without copying
+	track_access = TS.named(True)		#When False, reads neither journal nor update the accessed timestamp
+	collect_metrics = TS.named(True)	#Lock wait and hold times, journal flushes and snapshots, see metrics
+	replication_flush_timeout = TS.named(0.05)		#Max age of a pending batch while replicas follow the journal, they only receive what has been written
 
 	#State
-	pending_log = TS.factory(list)
-	journal_auto_flush_timer = TS.state(None)
-	write_lock = TS.factory(threading.Lock)
-	journal_lock = TS.factory(threading.Lock)
+	metrics = TS.factory(metrics_registry)
+	access_log = TS.factory(access_tracker)
+	write_lock = TS.factory(striped_lock)				#Guards values, striped by path
+	symbol_lock = TS.factory(threading.Lock)			#Guards creation of symbols in symbol_tree
+	subscriptions = TS.factory(subscription_registry)
+	journal_feeds = TS.factory(subscription_registry)	#Followers of the journal (prefix ''), see follow_journal
+	shipped_sections = TS.state(0)
+	journal_lock = TS.factory(threading.Lock)			#Guards the journal file
+	journal_signal = TS.factory(threading.Condition)	#Guards the journal generation counters and wakes up the journal writer
+
+	#Pending journal entries are kept in one buffer per thread and merged by sequence number when taken.
+	#Entries are tagged with the generation that was open when they were journaled, taking the pending log closes the open generation.
+	journal_buffers = TS.factory(list)
+	journal_buffers_lock = TS.factory(threading.Lock)
+	journal_local = TS.factory(threading.local)
+	journal_sequence = TS.factory(itertools.count)
+	journal_taken = TS.state(0)					#Entries taken by take_pending_log, the entries pending are the sequence numbers handed out minus these
+	journal_generation = TS.state(1)			#Currently open generation
+	journal_written_generation = TS.state(0)	#Generations up to this one have been written
+	journal_synced_generation = TS.state(0)		#Generations up to this one have been fsynced
+	journal_requested_generation = TS.state(0)	#Someone is waiting for generations up to this one
+	journal_pending_since = TS.state(None)
+	journal_writer_thread = TS.state(None)
+	journal_writer_running = TS.state(False)
+	journal_writer_failure = TS.state(None)
 
 	journal_file = TS.state(None)
-	journal_pickler = TS.state(None)
+	last_recovery = TS.state(None)
+
+	snapshot_lock = TS.factory(threading.Lock)		#Held from the start of flush_everything until the snapshot is written and the journal archived
+	snapshot_thread = TS.state(None)
+	last_snapshot = TS.state(None)
+
+	archive_lock = TS.factory(threading.Lock)		#Guards appending to and rotating out the journal archive
+	compaction_lock = TS.factory(threading.Lock)
+	last_compaction = TS.state(None)
+
+	time_indexes = TS.factory(dict)		#Journal filename -> section_time_index
+	history_lock = TS.factory(threading.Lock)
+
+	blobs = TS.state(None)
+
+	spill_store = TS.state(None)		#value_store the values of cold entries are spilled to, see memory_budget
+	spill_lock = TS.factory(threading.Lock)		#Held by the one thread spilling at a time
+	spilled_copies = TS.factory(dict)		#Slot -> spilled_value of faulted in values, reused when spilled again if the entry is unchanged
 
 	def recreate_journal_entry(self, entry):
 		#TBD: that further subclasses from these may be unintentionally covered here. Since match doesn't support type identity, maybe we should do this with if instead?
 		match entry:
-			case journal_types.update(time=now, path=path, value=value):
-				with self.write_lock:
-					symbol = self.symbol_tree.create_symbol(path)
-					value_to_store = prepare_for_storage(value)
+			case journal_types.update(time=now, path=path, value=value, version=version):
+				with self.write_lock.for_path(path):
+					symbol = self.create_symbol(path)
 					if existing := self.storage_map.get(symbol):
-						#TBD - should we worry about this? Maybe it should be configurable.
-						existing.updated, existing.accessed, existing.value = now, now, value_to_store
+						if version is not None and existing.version >= version:
+							#Already part of the snapshot, happens when a rotated journal is replayed
+							return
+						existing.updated, existing.accessed, existing.value = now, now, self.prepare_value(value)
+						existing.version = existing.version + 1 if version is None else version
+						self.account_value(existing)
 					else:
 						#TBD - should we worry about this? Maybe it should be configurable.
-						new = storage_types.entry(path, value, now, now, now)
+						new = self.entry_table.add(path, self.prepare_value(value), now, now, now, version or 1)
 						self.storage_map[symbol] = new
+						self.path_index.add(new.path)
+						self.account_value(new)
 
 
-			case journal_types.create(time=now, path=path, value=value):
-				with self.write_lock:
-					symbol = self.symbol_tree.create_symbol(path)
-					value_to_store = prepare_for_storage(value)
-					new = storage_types.entry(path, value, now, now, now)
+			case journal_types.create(time=now, path=path, value=value, version=version):
+				with self.write_lock.for_path(path):
+					symbol = self.create_symbol(path)
 					if existing := self.storage_map.get(symbol):
 						#TBD - should we worry about this? Maybe it should be configurable.
 						pass
 					else:
 						#Create
-						self.storage_map[symbol] = new
+						self.storage_map[symbol] = new = self.entry_table.add(path, self.prepare_value(value), now, now, now, version or 1)
+						self.path_index.add(new.path)
+						self.account_value(new)
 
 			case journal_types.access(time=now, path=path):
 				symbol = self.symbol_tree.require_symbol(path)
 				meta = self.storage_map[symbol]
 				meta.accessed = now
 
+			case journal_types.batch(changes=changes):
+				for change in changes:
+					self.recreate_journal_entry(change)
+
+			case journal_types.access_batch(paths=paths, timestamps=timestamps) | journal_types.access_summary(paths=paths, timestamps=timestamps):
+				#The batch is appended last in its section so it may be older than updates in the same section
+				for path, accessed in zip(paths, timestamps):
+					if (symbol := self.symbol_tree.get_symbol(path)) and (meta := self.storage_map.get(symbol)):
+						meta.accessed = max(meta.accessed, accessed)
+
 			case _:
 				raise TypeError(entry)
 
 
+	def replay_journal_file(self, journal_file):
+		#Streams the file section by section, a torn tail (from a crash during a write) is truncated away
+		journal_file.seek(0)
+		reader = section_reader(journal_file)
+		entry_count = 0
+		for section in reader:
+			for entry in section:
+				self.recreate_journal_entry(entry)
+			entry_count += len(section)
+			self.spill_cold_values()
+
+		truncated_bytes = 0
+		if reader.torn:
+			journal_file.seek(0, os.SEEK_END)
+			truncated_bytes = journal_file.tell() - reader.valid_end
+			journal_file.truncate(reader.valid_end)
+			journal_file.flush()
+			os.fsync(journal_file.fileno())
+
+		if reader.continued_sections:
+			#Sections written before framing that refer to earlier ones can't be read on their own (see section_time_index), the file is rewritten framed
+			self.rewrite_framed(journal_file.name)
+			if journal_file is self.journal_file:
+				journal_file.close()
+				self.journal_file = journal_file = open(self.journal_filename, 'ba+')
+
+		journal_file.seek(0, os.SEEK_END)
+		return entry_count, reader.section_count, truncated_bytes
+
+	def rewrite_framed(self, filename):
+		temporary_filename = f'{filename}.framed'
+		with open(filename, 'rb') as source, open(temporary_filename, 'wb') as framed_file:
+			copy_sections(source, framed_file, self.journal_compression)
+			framed_file.flush()
+			os.fsync(framed_file.fileno())
+		os.replace(temporary_filename, filename)
+
 	def recover_journal(self):
 		with self.journal_lock:
-			start_pos = self.journal_file.tell()
+			start = time.monotonic()
+			entry_count = section_count = truncated_bytes = 0
 
-			if start_pos:
-				self.journal_file.seek(0)	#Rewind
+			#A rotated journal is left behind if we crashed while writing a snapshot, it precedes the current journal.
+			#The snapshot may already contain it but replaying it again leaves the state unchanged.
+			#It stays in place until the next snapshot covers it (see rotate_journal).
+			journal_files = [self.journal_file]
+			if os.path.exists(self.journal_rotated_filename):
+				journal_files.insert(0, open(self.journal_rotated_filename, 'rb+'))
 
-				unpickler = db_unpickler(self.journal_file)
-				for entry in unpickler.load():
-					self.recreate_journal_entry(entry)
-					self.pending_log.append(entry)
+			for journal_file in journal_files:
+				try:
+					entries, sections, truncated = self.replay_journal_file(journal_file)
+				finally:
+					if journal_file is not self.journal_file:
+						journal_file.close()
 
-				assert start_pos == self.journal_file.tell()
-
-			self.journal_file.seek(0)
-			self.journal_file.truncate(0)
-			self.journal_pickler = db_pickler(self.journal_file)
-			#Note: If we don't recreate the db_pickler we end up in a weird state and get corrupted data, not sure why (maybe a position counter is not reset)
-			# Doesn't seem like there is a way to reset it: https://docs.python.org/3/library/pickle.html#pickle.Pickler
+				entry_count += entries
+				section_count += sections
+				truncated_bytes += truncated
 
+			duration = time.monotonic() - start
+			self.last_recovery = dict(
+				entry_count = entry_count,
+				section_count = section_count,
+				truncated_bytes = truncated_bytes,
+				duration = duration,
+				entries_per_second = entry_count / duration if duration else None,
+			)
 
 
 	def create_journal_stream(self, filename):
 		with self.journal_lock:
 			self.journal_file = open(filename, 'ba+')
-			self.journal_pickler = db_pickler(self.journal_file)
+
+	def journal_buffer(self):
+		if not (buffer := getattr(self.journal_local, 'buffer', None)):
+			buffer = self.journal_local.buffer = journal_buffer(threading.current_thread())
+			with self.journal_buffers_lock:
+				self.journal_buffers.append(buffer)
+		return buffer
 
 	def journal(self, entry):
-		with self.journal_lock:
-			self.pending_log.append(entry)
+		buffer = self.journal_buffer()
+		with buffer.lock:
+			generation = self.journal_generation
+			sequence = next(self.journal_sequence)
+			buffer.entries.append((sequence, generation, entry))
+
+		#Wake the writer when entries start pending (so it can start the age deadline) and each time another batch is pending across all buffers.
+		#The count may be off while a batch is being taken but the writer then checks the buffers itself.
+		pending = sequence + 1 - self.journal_taken
+		if pending == 1 or pending % self.journal_batch_size == 0:
+			with self.journal_signal:
+				self.journal_signal.notify_all()
+
+		return generation
+
+	def durability_mode(self, durability):
+		#durability or the default, checked before anything is written so that an unknown mode changes nothing
+		if (durability := durability or self.default_durability) not in DURABILITY_MODES:
+			raise ValueError(f'Unknown durability {durability!r}, expected one of DURABILITY_MODES {DURABILITY_MODES}')
+		return durability
+
+	def wait_for_journal(self, generation, durability):
+		#Not a match statement, bare names in case patterns would capture instead of compare
+		if durability == DURABILITY_NONE:
+			return
+		elif durability == DURABILITY_WRITE:
+			reached = lambda: self.journal_written_generation >= generation
+		elif durability == DURABILITY_FSYNC:
+			reached = lambda: self.journal_synced_generation >= generation
+		else:
+			raise ValueError(f'Unknown durability {durability!r}, expected one of DURABILITY_MODES {DURABILITY_MODES}')
+
+		with self.journal_signal:
+			if self.journal_requested_generation < generation:
+				self.journal_requested_generation = generation
+				self.journal_signal.notify_all()
+
+			while not reached():
+				if self.journal_writer_failure:
+					raise Exception('Journal writer failed') from self.journal_writer_failure
+				if not self.journal_writer_running:
+					raise Exception('Journal writer is not running')
+				self.journal_signal.wait()
+
+	def journal_flush_due(self):
+		#Must be called while holding journal_signal. Returns True if due, otherwise seconds until due (or None for no deadline).
+		if self.journal_requested_generation > self.journal_written_generation:
+			return True
+
+		pending = sum(len(buffer.entries) for buffer in self.journal_buffers)
+		if not pending and not self.access_log:
+			self.journal_pending_since = None
+			return False
+		if pending >= self.journal_batch_size:
+			return True		#Pending accesses are coalesced into one entry, they only count towards the age deadline
+		if self.journal_pending_since is None:
+			self.journal_pending_since = time.monotonic()
+		timeout = self.journal_auto_flush_timeout
+		if self.journal_feeds.by_prefix and self.replication_flush_timeout is not None:
+			timeout = self.replication_flush_timeout if timeout is None else min(timeout, self.replication_flush_timeout)
+		if timeout is None:
+			return None
+		remaining = self.journal_pending_since + timeout - time.monotonic()
+		return True if remaining <= 0 else remaining
+
+	def run_journal_writer(self):
+		try:
+			while True:
+				with self.journal_signal:
+					while (due := self.journal_flush_due()) is not True:
+						if not self.journal_writer_running:
+							return
+						self.journal_signal.wait(due or None)
+
+				self.flush_journal()
+
+		except BaseException as e:
+			with self.journal_signal:
+				self.journal_writer_failure = e
+				self.journal_signal.notify_all()
+			raise
+
+		finally:
+			with self.journal_signal:
+				self.journal_writer_running = False
+				self.journal_signal.notify_all()
+
+	def start_journal_writer(self):
+		with self.journal_signal:
+			self.journal_writer_running = True
+		self.journal_writer_thread = threading.Thread(target=self.run_journal_writer, name='journal-writer', daemon=True)
+		self.journal_writer_thread.start()
+
+	def stop_journal_writer(self):
+		if thread := self.journal_writer_thread:
+			with self.journal_signal:
+				self.journal_writer_running = False
+				self.journal_signal.notify_all()
+			thread.join()
+			self.journal_writer_thread = None
 
-		if self.journal_auto_flush_timer:
-			self.journal_auto_flush_timer.cancel()
+	def take_pending_log(self):
+		#Must be called while holding journal_lock so that the batch is written in the same order it was taken.
+		#Returns the entries of the generation that was open, in the order they were journaled, and that generation.
+		with self.journal_signal:
+			generation = self.journal_generation
+			self.journal_generation += 1
+			self.journal_pending_since = None
 
-		if self.journal_auto_flush_timeout:
-			self.journal_auto_flush_timer = threading.Timer(self.journal_auto_flush_timeout, self.flush_journal)
-			self.journal_auto_flush_timer.start()
+		with self.journal_buffers_lock:
+			buffers = tuple(self.journal_buffers)
+
+		taken = list()
+		for buffer in buffers:
+			if entries := buffer.take(generation):
+				taken.append(entries)
+			elif not buffer.thread.is_alive():
+				#A finished thread can't add more entries
+				with self.journal_buffers_lock:
+					self.journal_buffers.remove(buffer)
+
+		to_flush = tuple(entry for sequence, entry_generation, entry in heapq.merge(*taken))
+		self.journal_taken += len(to_flush)
+
+		if access_batch := self.access_log.drain():
+			to_flush += (access_batch,)
+
+		return to_flush, generation
+
+	def register_access(self, meta, path, now):
+		if self.track_access:
+			if self.access_log.touch(path, now):
+				#The writer starts the age deadline, access times are journaled even if nothing is written
+				with self.journal_signal:
+					self.journal_signal.notify_all()
+			meta.accessed = now
+
+	def mark_journal_progress(self, written=None, synced=None):
+		with self.journal_signal:
+			if written is not None:
+				self.journal_written_generation = max(self.journal_written_generation, written)
+			if synced is not None:
+				self.journal_synced_generation = max(self.journal_synced_generation, synced)
+			self.journal_signal.notify_all()
 
 	def flush_journal(self):
+		#One batch is one frame and one fsync - this is the group commit
 		with self.journal_lock:
-			to_flush = tuple(self.pending_log)
-			self.pending_log.clear()
+			to_flush, generation = self.take_pending_log()
+			if not to_flush:
+				self.mark_journal_progress(written=generation, synced=generation)
+				return
 
-			self.journal_pickler.dump(to_flush)
+			start = time.perf_counter()
+			size = write_section(self.journal_file, to_flush, self.journal_compression)
+			self.journal_file.flush()
+			self.mark_journal_progress(written=generation)
+			self.ship_journal(to_flush)
 
+			written = time.perf_counter()
+			os.fsync(self.journal_file.fileno())
+			self.mark_journal_progress(synced=generation)
 
-	def store(self, path, value):
-		with self.write_lock:
-			now = time.time()
-			symbol = self.symbol_tree.create_symbol(path)
-			value_to_store = prepare_for_storage(value)
-			if existing := self.storage_map.get(symbol):
-				#Update
-				self.journal(journal_types.update(now, path, deep_copy(value_to_store), deep_copy(existing.value)))
-				existing.updated, existing.accessed, existing.value = now, now, value_to_store
+		if self.collect_metrics:
+			metrics = self.metrics
+			metrics.counter('journal.flushes').add()
+			metrics.histogram('journal.flush_entries', unit='entries').record(len(to_flush))
+			metrics.histogram('journal.flush_bytes', unit='bytes').record(size)
+			metrics.timing('journal.write').record(written - start)
+			metrics.timing('journal.fsync').record(time.perf_counter() - written)
+
+
+	def ship_journal(self, entries):
+		#Must be called while holding journal_lock right after entries were written as a section so that followers receive sections in journal order
+		if feeds := self.journal_feeds.by_prefix.get(''):
+			self.shipped_sections += 1
+			shipment = journal_shipment('section', self.shipped_sections, time.time(), entries=entries)
+			for feed in feeds:
+				feed.push(shipment)
+
+	def follow_journal(self, chunk_size=1000, max_backlog=10000):
+		#Returns a journal_feed for a replica, see journal_shipping. Closing it stops following.
+		#Registering happens together with capturing the bootstrap so that every change is in one or the other (or both).
+		feed = journal_feed('', max_backlog=max_backlog)
+		with self.journal_lock:
+			with self.write_lock.all():
+				entries = self.capture_entries()
+				self.journal_feeds.add(feed)
+				sequence = self.shipped_sections
+
+		#The writer may be waiting without a deadline, it has to pick up replication_flush_timeout now that there is a follower
+		with self.journal_signal:
+			self.journal_signal.notify_all()
+
+		feed.bootstrap = bootstrap_shipments(entries, chunk_size, sequence, time.time())
+		return feed
+
+	def replication_report(self):
+		feeds = self.journal_feeds.by_prefix.get('', ())
+		return dict(
+			followers = len(feeds),
+			shipped_sections = self.shipped_sections,
+			backlogs = tuple(len(feed.pending) for feed in feeds),		#Shipments each follower has yet to receive
+		)
+
+	def prepare_value(self, value):
+		if self.freeze_values:
+			return freeze(value)
+		else:
+			return prepare_for_storage(value)
+
+	def resolve_value(self, meta):
+		#Values from an indexed snapshot or spilled to the value store are decoded on first use
+		if self.memory_budget is not None:
+			self.metrics.counter('values.reads').add()
+		if isinstance(external := meta.value, snapshot_value):
+			value = external.load()
+			if self.freeze_values:
+				value = freeze(value)
+			if isinstance(external, spilled_value):
+				self.metrics.counter('values.faults').add()
+			self.fault_in(meta, external, value)
+			return value
+		return external
+
+	def fault_in(self, meta, external, value):
+		#Keeps a decoded value resident unless the entry changed meanwhile.
+		#Skipped when the write_lock stripe is busy, possibly held by the caller, the value is just decoded again next time.
+		lock = self.write_lock.for_path(meta.path)
+		if not lock.acquire(False):
+			return
+		try:
+			if meta.value is not external:
+				return
+			meta.value = value
+			if isinstance(external, spilled_value):
+				self.spilled_copies[meta.slot] = external
+			self.account_value(meta)
+		finally:
+			lock.release()
+		self.spill_cold_values()
+
+	def account_value(self, meta):
+		#Must be called whenever the value of meta is replaced, keeps track of the size of resident values
+		if self.memory_budget is None:
+			return
+		self.entry_table.set_size(meta.slot, 0 if isinstance(meta.value, snapshot_value) else estimated_size(meta.value))
+
+	def spill_cold_values(self):
+		#Spills the values of the least recently accessed entries until resident values fit in spill_target of memory_budget.
+		#Entries whose write_lock stripe is busy are skipped so this can be called while holding stripes, only one thread spills at a time.
+		if self.memory_budget is None or self.entry_table.resident_bytes <= self.memory_budget or not self.spill_lock.acquire(False):
+			return
+		try:
+			start = time.perf_counter()
+			target = self.memory_budget * self.spill_target
+			table = self.entry_table
+			resident = [meta for meta in tuple(self.storage_map.values()) if table.sizes[meta.slot]]
+			resident.sort(key=lambda meta: table.accessed[meta.slot])
+			spilled = 0
+			for meta in resident:
+				if table.resident_bytes <= target:
+					break
+				lock = self.write_lock.for_path(meta.path)
+				if not lock.acquire(False):
+					continue
+				try:
+					if table.sizes[meta.slot]:
+						self.spill_value(meta)
+						spilled += 1
+				finally:
+					lock.release()
+
+		finally:
+			self.spill_lock.release()
+
+		self.metrics.counter('values.spills').add(spilled)
+		if self.collect_metrics:
+			self.metrics.timing('values.spill').record(time.perf_counter() - start)
+
+	def spill_value(self, meta):
+		#Must be called while holding the write_lock stripe for meta.path
+		copy = self.spilled_copies.pop(meta.slot, None)
+		if copy is None or copy.version != meta.version:
+			copy = self.spill_store.spill(meta.value, meta.version)
+			self.metrics.counter('values.spilled_bytes').add(copy.length)
+		meta.value = copy
+		self.account_value(meta)
+
+	def tiering_report(self):
+		reads = self.metrics.counter('values.reads').value
+		faults = self.metrics.counter('values.faults').value
+		tracked = self.memory_budget is not None		#Resident values are only accounted for with a memory_budget
+		return dict(
+			memory_budget = self.memory_budget,
+			resident_bytes = self.entry_table.resident_bytes if tracked else None,
+			resident_entries = self.entry_table.resident_count if tracked else None,
+			spilled_entries = len(self.storage_map) - self.entry_table.resident_count if tracked else None,
+			spills = self.metrics.counter('values.spills').value,
+			spilled_bytes = self.metrics.counter('values.spilled_bytes').value,
+			faults = faults,
+			fault_rate = faults / reads if reads else None,		#Fraction of value reads served from the value store
+		)
+
+	def values_resident(self, paths):
+		#True if the values of paths can be read without I/O, none is kept in the blob store, spilled or still in an indexed snapshot.
+		#A value may still be spilled right after, reading it then faults it in.
+		for path in paths:
+			if (symbol := self.symbol_tree.get_symbol(path)) and (meta := self.storage_map.get(symbol)) and isinstance(meta.value, (storage_types.blob_reference, snapshot_value)):
+				return False
+		return True
+
+	def read_value(self, meta):
+		#Value of an entry as handed out to readers, blobs are read from their file
+		value = self.share_value(self.resolve_value(meta))
+		if isinstance(value, storage_types.blob_reference):
+			return self.blobs.read(value)
+		return value
+
+	def share_value(self, value):
+		#Stored values are never mutated in place, when they are also immutable we can hand out references
+		if self.freeze_values:
+			return value
+		else:
+			return deep_copy(value)
+
+	def create_symbol(self, path):
+		if (symbol := self.symbol_tree.get_symbol(path)) is None:
+			with self.symbol_lock:
+				symbol = self.symbol_tree.create_symbol(path)
+		return symbol
+
+	def store_locked(self, path, value_to_store, now):
+		#Must be called while holding the write_lock stripe for path, returns the journal entry describing the change
+		symbol = self.create_symbol(path)
+		if existing := self.storage_map.get(symbol):
+			#Update
+			change = journal_types.update(now, path, self.share_value(value_to_store), self.share_value(self.resolve_value(existing)), version=existing.version + 1)
+			existing.updated, existing.accessed, existing.value, existing.version = now, now, value_to_store, change.version
+			self.account_value(existing)
+		else:
+			#Create
+			change = journal_types.create(now, path, self.share_value(value_to_store), version=1)
+			self.storage_map[symbol] = new = self.entry_table.add(path, value_to_store, now, now, now)
+			self.path_index.add(new.path)		#The same string as the entry so that the index doesn't hold a copy of its own
+			self.account_value(new)
+
+		self.subscriptions.publish(change)
+		return change
+
+	def store(self, path, value, durability=None):
+		durability = self.durability_mode(durability)
+		value_to_store = self.prepare_value(value)
+		with self.write_lock.for_path(path):
+			generation = self.journal(self.store_locked(path, value_to_store, time.time()))
+
+		self.spill_cold_values()
+		#Wait outside of write_lock so that concurrent writers can join the same group commit
+		self.wait_for_journal(generation, durability)
+
+	def compare_and_set(self, path, expected_version, value, durability=None):
+		#Stores value only if the entry is still at expected_version, 0 means that path must not exist yet.
+		#Returns (True, new version) or (False, current immutable_entry or None if missing) so that the caller can retry without reading again.
+		durability = self.durability_mode(durability)
+		value_to_store = self.prepare_value(value)
+		with self.write_lock.for_path(path):
+			if (symbol := self.symbol_tree.get_symbol(path)) and (meta := self.storage_map.get(symbol)):
+				current_version = meta.version
 			else:
-				#Create
-				self.journal(journal_types.create(now, path, value))
-				new = storage_types.entry(path, value, now, now, now)
-				self.storage_map[symbol] = new
+				meta, current_version = None, 0
+
+			if current_version != expected_version:
+				return False, meta and self.describe_entry(meta, True)
+
+			change = self.store_locked(path, value_to_store, time.time())
+			generation = self.journal(change)
+
+		self.spill_cold_values()
+		self.wait_for_journal(generation, durability)
+		return True, change.version
+
+	def open_blob(self):
+		#Writer for a bytes value that should not be built in memory, pass it to store_blob once everything is written
+		return self.blobs.writer()
+
+	def store_blob(self, path, writer, durability=None):
+		durability = self.durability_mode(durability)
+		reference = writer.commit()
+		with self.write_lock.for_path(path):
+			generation = self.journal(self.store_locked(path, reference, time.time()))
+
+		self.wait_for_journal(generation, durability)
+		return reference
+
+	def store_stream(self, path, chunks, durability=None):
+		#Stores the concatenated chunks as a bytes value kept out of line in the blob store, returns its blob_reference
+		durability = self.durability_mode(durability)
+		with self.open_blob() as writer:
+			for chunk in chunks:
+				writer.write(chunk)
+			return self.store_blob(path, writer, durability)
+
+	def load_stream(self, path, chunk_size=DEFAULT_CHUNK_SIZE):
+		#Iterates the bytes value of path in chunks, whether it was stored with store_stream or store
+		now = time.time()
+		symbol = self.symbol_tree.require_symbol(path)
+		meta = self.storage_map[symbol]
+		self.register_access(meta, path, now)
+		match value := self.resolve_value(meta):
+			case storage_types.blob_reference():
+				return self.blobs.chunks(value, chunk_size)
+			case bytes():
+				return slice_chunks(value, chunk_size)
+			case _:
+				raise TypeError(f'{path} holds {type(value).__name__}, only bytes can be streamed')
+
+	def store_many(self, items, durability=None):
+		return self.apply_batch([('set', path, value) for path, value in items], durability)
+
+	def get_many(self, paths, default=None):
+		return [self.get(path, default) for path in paths]
+
+	def list_paths(self, prefix='', chunk_size=1000, cursor=None):
+		#Yields tuples of at most chunk_size stored paths at or below prefix in sorted order.
+		#Pass the last path received as cursor to continue after it, paths created meanwhile that sort after it are included.
+		return self.path_index.iter_prefix(prefix, chunk_size, cursor)
+
+	def exists(self, path):
+		return (symbol := self.symbol_tree.get_symbol(path)) is not None and symbol in self.storage_map
+
+	def apply_batch(self, operations, durability=None):
+		#Operations are ('set', path, value), ('get', path[, default]) or ('require', path).
+		#They are applied in order while holding the write_lock stripes of every involved path and all changes are journaled as one record.
+		#Nothing is applied if a value can't be stored or a required path is missing.
+		durability = self.durability_mode(durability)
+		prepared = list()
+		for operation in operations:
+			match operation:
+				case ('set', path, value):
+					prepared.append(('set', path, self.prepare_value(value)))
+				case ('get', path) | ('get', path, _) | ('require', path):
+					prepared.append(operation)
+				case _:
+					raise ValueError(operation)
+
+		results = list()
+		changes = list()
+		with self.write_lock.for_paths(path for command, path, *_ in prepared):
+			now = time.time()
+			to_be_created = set()
+			for command, path, *_ in prepared:
+				if command == 'set':
+					to_be_created.add(path)
+				elif command == 'require' and path not in to_be_created and not self.exists(path):
+					raise KeyError(path)
+
+			for operation in prepared:
+				match operation:
+					case ('set', path, value_to_store):
+						changes.append(self.store_locked(path, value_to_store, now))
+						results.append(None)
+					case ('get', path, *default):
+						results.append(self.get(path, *default))
+					case ('require', path):
+						results.append(self.load(path))
+
+			if changes:
+				generation = self.journal(journal_types.batch(now, tuple(changes)))
+
+		if changes:
+			self.spill_cold_values()
+			self.wait_for_journal(generation, durability)
+
+		return results
+
+	def watch(self, prefix, last_known_updated=None, include_values=False, max_backlog=10000):
+		#Subscribes to changes of prefix and everything below it.
+		#If last_known_updated is given, everything updated since then (inclusive, so a change sharing that timestamp is not missed) is delivered first as 'current'.
+		#Registering and collecting those happens while holding every write_lock stripe so no change falls in between.
+		#Closing the returned subscription unsubscribes.
+		#Values stored with store_stream are delivered as their blob_reference rather than read from the blob store.
+		subscriber = subscription(prefix, include_values=include_values, max_backlog=max_backlog)
+		with self.write_lock.all():
+			self.subscriptions.add(subscriber)
+			if last_known_updated is not None:
+				for chunk in self.path_index.iter_prefix(prefix):
+					for path in chunk:
+						meta = self.storage_map[self.symbol_tree.get_symbol(path)]
+						if meta.updated >= last_known_updated:
+							value = self.share_value(self.resolve_value(meta)) if include_values else None
+							subscriber.push(change_notification('current', meta.path, meta.updated, value=value), bounded=False)
+
+		return subscriber
 
 	def load(self, path):
 		now = time.time()
 		symbol = self.symbol_tree.require_symbol(path)
 		meta = self.storage_map[symbol]
-		self.journal(journal_types.access(now, path))
-		meta.accessed = now
-		return deep_copy(meta.value)
+		self.register_access(meta, path, now)
+		return self.read_value(meta)
 
 	def get(self, path, default=None):
 		now = time.time()
 		if not (symbol := self.symbol_tree.get_symbol(path)):
 			return default
 		meta = self.storage_map[symbol]
-		self.journal(journal_types.access(now, path))
-		meta.accessed = now
-		return deep_copy(meta.value)
+		self.register_access(meta, path, now)
+		return self.read_value(meta)
 
 	#NOTE - loading metadata should not add access to the log unless we also request the value
 
+	def describe_entry(self, meta, load_value):
+		info = dict(meta.__getstate__())
+		if load_value:
+			info['value'] = self.read_value(meta)
+			return storage_types.immutable_entry(**info)
+		else:
+			value = info.pop('value')
+			value_type = value.type if isinstance(value, snapshot_value) else type(value)
+			info['type'] = bytes if value_type is storage_types.blob_reference else value_type		#What reading the value returns
+			return storage_types.meta_entry(**info)
+
 	def load_meta(self, path, load_value=False):
 		now = time.time()
 		symbol = self.symbol_tree.require_symbol(path)
@@ -166,14 +779,8 @@ class database_core(public_base):
 
 		meta = self.storage_map[symbol]
 		if load_value:
-			self.journal(journal_types.access(now, path))
-			meta.accessed = now
-			info = deep_copy(meta.__getstate__())
-			return storage_types.immutable_entry(**info)
-		else:
-			info = deep_copy(meta.__getstate__())
-			info['type'] = type(info.pop('value'))
-			return storage_types.meta_entry(**info)
+			self.register_access(meta, path, now)
+		return self.describe_entry(meta, load_value)
 
 	def get_meta(self, path, default=None, load_value=False):
 		now = time.time()
@@ -184,14 +791,8 @@ class database_core(public_base):
 		#return immutable_entry._from_state(self.storage_map[symbol].__getstate__())
 		meta = self.storage_map[symbol]
 		if load_value:
-			self.journal(journal_types.access(now, path))
-			meta.accessed = now
-			info = deep_copy(meta.__getstate__())
-			return storage_types.immutable_entry(**info)
-		else:
-			info = deep_copy(meta.__getstate__())
-			info['type'] = type(info.pop('value'))
-			return storage_types.meta_entry(**info)
+			self.register_access(meta, path, now)
+		return self.describe_entry(meta, load_value)
 
 	def load_snapshot(self):
 		if self.create_snapshot:
@@ -199,59 +800,287 @@ class database_core(public_base):
 				pass
 
 		with open(self.snapshot_filename , 'rb') as snapshot_file:
-			snapshot_file.seek(0, os.SEEK_END)
-			if snapshot_file.tell():
-				snapshot_file.seek(0)
-				snapshot_unpickler = db_unpickler(snapshot_file)
-				for entry in snapshot_unpickler.load():
-					self.storage_map[self.symbol_tree.create_symbol(entry.path)] = entry
+			for entry in read_snapshot(snapshot_file):
+				self.load_entry(entry, index=False)
+			self.path_index.update(entry.path for entry in self.storage_map.values())
+		self.spill_cold_values()
 
+	def load_entry(self, entry, index=True):
+		#Stores a storage_types.entry as is (timestamps and version included) replacing the entry of its path, as when loading a snapshot.
+		#Pass index=False to update path_index at once afterwards.
+		if isinstance(entry.value, spilled_value):
+			entry.value.bind(self.spill_store)
+		elif self.freeze_values and not isinstance(entry.value, snapshot_value):
+			entry.value = freeze(entry.value)
+
+		with self.write_lock.for_path(entry.path):
+			symbol = self.create_symbol(entry.path)
+			if existing := self.storage_map.get(symbol):
+				existing.value, existing.created, existing.updated, existing.accessed, existing.version = entry.value, entry.created, entry.updated, entry.accessed, entry.version
+			else:
+				self.storage_map[symbol] = existing = self.entry_table.add_entry(entry)
+				if index:
+					self.path_index.add(existing.path)
+			self.account_value(existing)
 
-	def flush_everything(self):
-		with self.journal_lock:
-			with self.write_lock:
-				with open(self.snapshot_filename, 'wb') as snapshot_file:
-					snapshot_pickler = db_pickler(snapshot_file)
-					snapshot_pickler.dump(tuple(self.storage_map.values()))
 
-				to_flush = tuple(self.pending_log)
+	def capture_entries(self):
+		#Must be called while holding all write_lock stripes. Stored values are never mutated in place so copying the entry records gives us a consistent view.
+		return tuple(entry.to_entry() for entry in self.storage_map.values())
 
+	def rotate_journal(self):
+		#Must be called while holding journal_lock. The current journal is rotated out, it is archived once the snapshot that covers it is in place.
+		self.journal_file.flush()
+		os.fsync(self.journal_file.fileno())
+
+		if os.path.exists(self.journal_rotated_filename):
+			#Left behind by an interrupted snapshot, the rotated journal keeps growing until a snapshot succeeds
+			with open(self.journal_rotated_filename, 'ab') as rotated_file:
 				self.journal_file.seek(0)
-				self.journal_file.truncate(0)
-				self.journal_pickler = db_pickler(self.journal_file)
+				stream_copy(self.journal_file, rotated_file)
+				rotated_file.flush()
+				os.fsync(rotated_file.fileno())
+			self.journal_file.truncate(0)
+		else:
+			self.journal_file.close()
+			os.replace(self.journal_filename, self.journal_rotated_filename)
+			self.journal_file = open(self.journal_filename, 'ba+')
 
-				self.journal_pickler.dump(to_flush)
+	def flush_everything(self, background=None):
+		if background is None:
+			background = self.background_snapshots
 
-				self.pending_log.clear()
+		self.snapshot_lock.acquire()	#Released by write_snapshot, possibly from the snapshot thread
+		try:
+			capture_start = time.monotonic()
+			with self.journal_lock:
+				with self.write_lock.all():
+					captured = time.time()		#Every change journaled after this has a later time
+					entries = self.capture_entries()
+					to_flush, generation = self.take_pending_log()
 
+					if to_flush:
+						write_section(self.journal_file, to_flush)	#Not compressed while holding write_lock, it is when archived
+						self.ship_journal(to_flush)
+					self.rotate_journal()
 
-				#TODO - not hardcode
-				with open(self.journal_archive_filename, 'ab+') as journal_archive:
-					self.journal_file.seek(0)
-					stream_copy(self.journal_file, journal_archive)
+			#Everything pending is now durable in the rotated journal
+			self.mark_journal_progress(written=generation, synced=generation)
+			capture_duration = time.monotonic() - capture_start
 
-				self.journal_file.seek(0)
-				self.journal_file.truncate(0)
-				self.journal_pickler = db_pickler(self.journal_file)
+		except:
+			self.snapshot_lock.release()
+			raise
+
+		if background:
+			self.snapshot_thread = threading.Thread(target=self.write_snapshot, args=(entries, capture_duration, captured), name='snapshot-writer', daemon=True)
+			self.snapshot_thread.start()
+		else:
+			return self.write_snapshot(entries, capture_duration, captured)
+
+	def write_snapshot(self, entries, capture_duration, captured):
+		try:
+			start = time.monotonic()
+			temporary_filename = f'{self.snapshot_filename}.tmp'
+			with open(temporary_filename, 'wb') as snapshot_file:
+				match self.snapshot_format:
+					case 'pickle' if self.snapshot_compression:
+						with compressing_writer(snapshot_file, self.snapshot_compression) as compressed_file:
+							db_pickler(compressed_file).dump(entries)
+					case 'pickle':
+						db_pickler(snapshot_file).dump(entries)
+					case 'indexed':
+						write_indexed_snapshot(snapshot_file, entries)
+					case _:
+						raise ValueError(self.snapshot_format)
+				snapshot_file.flush()
+				os.fsync(snapshot_file.fileno())
+				bytes_written = snapshot_file.tell()
+
+			self.spill_store.sync()		#Spilled values the snapshot refers to
+			os.replace(temporary_filename, self.snapshot_filename)
+
+			if self.checkpoint_interval is not None and captured - max(self.checkpoint_times(), default=0) >= self.checkpoint_interval:
+				self.create_checkpoint(captured)
+
+			#TODO - not hardcode
+			with self.archive_lock, open(self.journal_archive_filename, 'ab+') as journal_archive, open(self.journal_rotated_filename, 'rb') as rotated_file:
+				copy_sections(rotated_file, journal_archive, self.archive_compression)
+				journal_archive.flush()
+				os.fsync(journal_archive.fileno())
+
+			os.remove(self.journal_rotated_filename)
+
+			self.last_snapshot = dict(
+				entry_count = len(entries),
+				bytes_written = bytes_written,
+				capture_duration = capture_duration,
+				captured = captured,
+				duration = time.monotonic() - start,
+				completed = time.time(),
+			)
+
+			if self.collect_metrics:
+				self.metrics.timing('snapshot.capture').record(capture_duration)
+				self.metrics.timing('snapshot.write').record(self.last_snapshot['duration'])
+				self.metrics.histogram('snapshot.bytes', unit='bytes').record(bytes_written)
+			return self.last_snapshot
+
+		finally:
+			self.snapshot_lock.release()
+
+	def compact_archive(self, bucket_seconds=3600, collapse=False):
+		#The archive is only locked while it is rotated out, snapshots completing meanwhile start a new one
+		with self.compaction_lock:
+			with self.archive_lock:
+				rotated = rotate_archive(self.journal_archive_filename)
+			if not rotated:
+				return None
+			self.last_compaction = compact_rotated_archive(self.journal_archive_filename, bucket_seconds, collapse, compression=self.archive_compression)
+			return self.last_compaction
+
+	def checkpoint_times(self):
+		if not os.path.isdir(self.checkpoint_directory):
+			return []
+		return sorted(float(name.removesuffix('.snapshot')) for name in os.listdir(self.checkpoint_directory) if name.endswith('.snapshot'))
+
+	def checkpoint_filename(self, captured):
+		return os.path.join(self.checkpoint_directory, f'{captured:.6f}.snapshot')
+
+	def create_checkpoint(self, captured):
+		#Snapshots are replaced rather than rewritten so a hard link keeps this one around
+		os.makedirs(self.checkpoint_directory, exist_ok=True)
+		try:
+			os.link(self.snapshot_filename, self.checkpoint_filename(captured))
+		except OSError:
+			shutil.copyfile(self.snapshot_filename, self.checkpoint_filename(captured))
+
+	def history_filenames(self):
+		#Journal files oldest first, every change since the first snapshot is in one of these
+		return (
+			*segment_filenames(self.journal_archive_filename),
+			compacting_filename(self.journal_archive_filename),
+			self.journal_archive_filename,
+			self.journal_rotated_filename,
+			self.journal_filename,
+		)
+
+	def history_changes(self, after=None, until=None):
+		#Yields create and update entries with after < time <= until in the order they were journaled.
+		#Collapsed archive segments only hold the last change per path and bucket, stamped with its time (see archive_compaction.collapse_change).
+		self.flush_journal()	#Changes still pending in memory are part of the history too
+		with self.history_lock:
+			filenames = self.history_filenames()
+			for filename in filenames:
+				if filename not in self.time_indexes:
+					#The live journals and the archive being compacted are too short lived to be worth keeping an index file for
+					transient = filename in (compacting_filename(self.journal_archive_filename), self.journal_rotated_filename, self.journal_filename)
+					self.time_indexes[filename] = section_time_index(filename, persist=not transient)
+			indexes = [self.time_indexes[filename] for filename in filenames]
+
+		for index in indexes:
+			for section in index.read(after, until):
+				for entry in section:
+					for change in (entry.changes if isinstance(entry, journal_types.batch) else (entry,)):
+						if isinstance(change, journal_types.create) and (after is None or change.time > after) and (until is None or change.time <= until):
+							yield change
+
+	def read_checkpoint(self, timestamp):
+		#Returns the time of the latest checkpoint at or before timestamp and its entries by path, or (None, {}) if there is none
+		captured = max((checkpoint for checkpoint in self.checkpoint_times() if checkpoint <= timestamp), default=None)
+		if captured is None:
+			return None, dict()
+
+		with open(self.checkpoint_filename(captured), 'rb') as checkpoint_file:
+			entries = {entry.path: entry for entry in read_snapshot(checkpoint_file)}
+		for entry in entries.values():
+			if isinstance(entry.value, spilled_value):
+				entry.value.bind(self.spill_store)
+		return captured, entries
+
+	def state_at(self, timestamp):
+		#Entries by path as they were at timestamp, rebuilt from the nearest checkpoint and the journal after it
+		captured, entries = self.read_checkpoint(timestamp)
+		for change in self.history_changes(captured, timestamp):
+			if existing := entries.get(change.path):
+				existing.value, existing.updated = change.value, change.time
+				existing.version = change.version or existing.version + 1
+			else:
+				entries[change.path] = storage_types.entry(change.path, change.value, change.time, change.time, change.time, version=change.version or 1)
+		return entries
+
+	def get_at(self, path, timestamp, default=None):
+		#Value of path as it was at timestamp.
+		#Inside a collapsed archive bucket this is the value from before the bucket, or of the latest checkpoint before timestamp if that is later, until the last change of the bucket.
+		if (symbol := self.symbol_tree.get_symbol(path)) and (meta := self.storage_map.get(symbol)):
+			if meta.updated <= timestamp:
+				return self.read_value(meta)
+			elif meta.created > timestamp:
+				return default
+
+		captured, entries = self.read_checkpoint(timestamp)
+		if entry := entries.get(path):
+			value = entry.value.load() if isinstance(entry.value, snapshot_value) else entry.value
+		else:
+			value = default
+
+		for change in self.history_changes(captured, timestamp):
+			if change.path == path:
+				value = change.value
+
+		if isinstance(value, storage_types.blob_reference):
+			return self.blobs.read(value)
+		return value
+
+	def restore_to(self, timestamp, durability=None):
+		#Stores the values every path had at timestamp as one atomic, journaled batch (so the restore can be undone the same way).
+		#Paths created after timestamp can't be removed since there is no delete, they are reported instead.
+		entries = self.state_at(timestamp)
+		operations = list()
+		for path, entry in entries.items():
+			value = entry.value.load() if isinstance(entry.value, snapshot_value) else entry.value
+			if (symbol := self.symbol_tree.get_symbol(path)) and (meta := self.storage_map.get(symbol)) and meta.version == entry.version:
+				continue
+			operations.append(('set', path, value))
+
+		if operations:
+			self.apply_batch(operations, durability)
 
-				#Note: If we don't recreate the db_pickler we end up in a weird state and get corrupted data, not sure why (maybe a position counter is not reset)
-				# Doesn't seem like there is a way to reset it: https://docs.python.org/3/library/pickle.html#pickle.Pickler
+		return dict(
+			restored = tuple(path for command, path, value in operations),
+			created_since = tuple(meta.path for meta in tuple(self.storage_map.values()) if meta.path not in entries),
+		)
 
+	def wait_for_snapshot(self):
+		if thread := self.snapshot_thread:
+			thread.join()
+			self.snapshot_thread = None
 
 
 
 	def terminate(self):
-		with self.write_lock:
-			if self.journal_auto_flush_timer:
-				self.journal_auto_flush_timer.cancel()
+		self.stop_journal_writer()
+		self.wait_for_snapshot()
+		self.flush_everything(background=False)
 
-		self.flush_everything()
+	def instrument_locks(self):
+		self.write_lock.instrument(self.metrics.timing('write_lock.wait'), self.metrics.timing('write_lock.hold'))
+		self.journal_lock = timed_lock(self.journal_lock, self.metrics.timing('journal_lock.wait'), self.metrics.timing('journal_lock.hold'))
 
 	def __enter__(self):
+		if self.snapshot_compression and self.snapshot_format == 'indexed':
+			raise ValueError('Indexed snapshots are memory mapped and can not be compressed')
+		if self.collect_metrics:
+			self.instrument_locks()
+		self.blobs = blob_store(self.blob_directory)
+		self.blobs.remove_incomplete()
+		self.spill_store = value_store(self.value_store_filename)
 		self.create_journal_stream(self.journal_filename)
 		self.load_snapshot()
 		self.recover_journal()
+		self.start_journal_writer()
 		return self
 
 	def __exit__(self, et, ev, tb):
 		self.terminate()
+		self.spill_store.close()
@@ -0,0 +1,97 @@
+#Compact in memory representation of the entries in database_core.storage_map.
+#An entry is a slotted record of path, value, version and a slot number. Its three timestamps are stored in columns of array('d')
+#indexed by the slot, so they cost 24 bytes instead of an instance dict entry and a float object each.
+#The path string of an entry is the one object shared with path_index, it isn't copied or interned (the table of interned strings would
+#cost more per key than it saves since nothing else keeps a copy of the full path).
+#storage_types.entry remains the form entries are persisted and exchanged in, see to_entry and entry_table.add_entry.
+
+from . import storage_types
+
+from array import array
+import threading
+
+
+class compact_entry:
+	#Subclassed by every entry_table so that the table is a class attribute rather than a slot of each entry
+	__slots__ = ('path', 'value', 'slot', 'version')
+	table = None
+
+	def __init__(self, path, value, slot, version):
+		self.path = path
+		self.value = value
+		self.slot = slot
+		self.version = version
+
+	@property
+	def created(self):
+		return self.table.created[self.slot]
+
+	@created.setter
+	def created(self, value):
+		self.table.created[self.slot] = value
+
+	@property
+	def updated(self):
+		return self.table.updated[self.slot]
+
+	@updated.setter
+	def updated(self, value):
+		self.table.updated[self.slot] = value
+
+	@property
+	def accessed(self):
+		return self.table.accessed[self.slot]
+
+	@accessed.setter
+	def accessed(self, value):
+		self.table.accessed[self.slot] = value
+
+	def __getstate__(self):
+		#Same fields as storage_types.entry
+		return dict(path=self.path, value=self.value, created=self.created, updated=self.updated, accessed=self.accessed, version=self.version)
+
+	def __reduce__(self):
+		raise TypeError(f'{self.__class__.__name__} is only kept in memory, persist to_entry() instead')
+
+	def to_entry(self):
+		return storage_types.entry(**self.__getstate__())
+
+	def __repr__(self):
+		inner = ', '.join(f'{k}={v!r}' for k, v in self.__getstate__().items())
+		return f'{self.__class__.__name__}({inner})'
+
+
+class entry_table:
+	#Entries are never removed so slots are simply handed out in order
+	def __init__(self):
+		self.created = array('d')
+		self.updated = array('d')
+		self.accessed = array('d')
+		self.sizes = array('Q')		#Estimated size of resident values, only kept by database_core when it has a memory_budget
+		self.resident_bytes = 0
+		self.resident_count = 0
+		self.lock = threading.Lock()		#Guards handing out slots and the totals of sizes
+		self.entry_type = type('compact_entry', (compact_entry,), dict(__slots__=(), table=self))
+
+	def __len__(self):
+		return len(self.created)
+
+	def add(self, path, value, created, updated, accessed, version=1):
+		with self.lock:
+			slot = len(self.created)
+			self.created.append(created)
+			self.updated.append(updated)
+			self.accessed.append(accessed)
+			self.sizes.append(0)
+		return self.entry_type(path, value, slot, version)
+
+	def set_size(self, slot, size):
+		with self.lock:
+			previous = self.sizes[slot]
+			self.sizes[slot] = size
+			self.resident_bytes += size - previous
+			self.resident_count += bool(size) - bool(previous)
+
+	def add_entry(self, entry):
+		#From a storage_types.entry, for instance one loaded from a snapshot
+		return self.add(entry.path, entry.value, entry.created, entry.updated, entry.accessed, entry.version)
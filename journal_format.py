@@ -0,0 +1,121 @@
+#Journal files (recovery, rotated and archive) are a sequence of sections.
+#Each section is a tuple of journal entries stored in a frame: magic, payload length, crc32 of payload, payload.
+#Files written before framing was introduced contain bare pickled sections, these are still readable.
+#Bare sections of a recovery journal were written by one pickler so later ones may refer to objects of earlier ones, they are decoded with one unpickler.
+#A section may be compressed, the magic of its frame tells with which codec. Files can mix codecs.
+
+from .pickling import db_dumps, db_loads, db_unpickler
+from .compression import compress, decompress
+
+import struct, zlib, pickletools
+
+FRAME_MAGIC = b'PSJ1'
+COMPRESSED_FRAME_MAGIC = dict(zlib=b'PSJZ', lzma=b'PSJX', bz2=b'PSJB')
+codec_by_magic = {FRAME_MAGIC: None, **{magic: codec for codec, magic in COMPRESSED_FRAME_MAGIC.items()}}
+LEGACY_SECTION_START = 0x80		#Pickle PROTO opcode
+MEMO_STORES = frozenset(('MEMOIZE', 'PUT', 'BINPUT', 'LONG_BINPUT'))
+MEMO_FETCHES = frozenset(('GET', 'BINGET', 'LONG_BINGET'))
+frame_header = struct.Struct('<4sII')
+
+
+def write_frame(file, payload, codec=None):
+	#payload is already compressed with codec
+	file.write(frame_header.pack(COMPRESSED_FRAME_MAGIC[codec] if codec else FRAME_MAGIC, len(payload), zlib.crc32(payload)))
+	file.write(payload)
+	return frame_header.size + len(payload)
+
+def write_section(file, entries, codec=None):
+	payload = db_dumps(entries)
+	return write_frame(file, compress(codec, payload) if codec else payload, codec)
+
+def continues_stream(file):
+	#True if the pickle at the current position of file fetches memo entries it did not store itself, it then continues the stream of an earlier pickle.
+	#None if it doesn't use the memo at all, it can then be decoded either way.
+	stored = set()
+	for opcode, argument, position in pickletools.genops(file):
+		if opcode.name in MEMO_STORES:
+			stored.add(len(stored) if argument is None else argument)
+		elif opcode.name in MEMO_FETCHES and argument not in stored:
+			return True
+	return False if stored else None
+
+def copy_sections(source, destination, codec=None):
+	#Copies the sections of source from its current position, recompressing those not already compressed with codec.
+	#Stops at a torn section like section_reader, returns the reader.
+	reader = section_reader(source)
+	for payload_codec, payload in reader.frames():
+		if payload_codec != codec:
+			if payload_codec:
+				payload = decompress(payload_codec, payload)
+			if codec:
+				payload = compress(codec, payload)
+		write_frame(destination, payload, codec)
+	return reader
+
+
+class section_reader:
+	#Streams one section at a time from the current position of file.
+	#Stops at the first torn or corrupt frame, valid_end is then where that frame starts so the file can be truncated there.
+
+	def __init__(self, file):
+		self.file = file
+		self.valid_end = file.tell()
+		self.torn = False
+		self.section_count = 0
+		self.legacy_unpickler = None		#Unpickler of the previous legacy section, the next one may continue its stream
+		self.continued_sections = 0			#Legacy sections that can only be decoded after the ones before them
+
+	def __iter__(self):
+		for codec, payload, section in self.read_sections():
+			yield db_loads(decompress(codec, payload) if codec else payload) if section is None else section
+
+	def frames(self):
+		#Yields (codec, payload) of each section without decoding it.
+		#Legacy sections are yielded as their pickled form, pickled again on their own if they continue an earlier one.
+		for codec, payload, section in self.read_sections():
+			yield codec, payload
+
+	def read_sections(self):
+		#Yields (codec, payload, section) where section is only decoded already for legacy sections
+		while header := self.file.read(frame_header.size):
+			section = None
+			if header[0] == LEGACY_SECTION_START:
+				try:
+					self.file.seek(self.valid_end)
+					continued = continues_stream(self.file)
+					self.file.seek(self.valid_end)
+					if continued is False or self.legacy_unpickler is None:
+						self.legacy_unpickler = db_unpickler(self.file)
+					section = self.legacy_unpickler.load()
+				except Exception:
+					break
+				end = self.file.tell()
+				if continued:
+					self.continued_sections += 1
+					codec, payload = None, db_dumps(section)
+				else:
+					self.file.seek(self.valid_end)
+					codec, payload = None, self.file.read(end - self.valid_end)
+				self.file.seek(end)
+			else:
+				self.legacy_unpickler = None
+
+				if len(header) < frame_header.size:
+					break
+
+				magic, length, checksum = frame_header.unpack(header)
+				if (codec := codec_by_magic.get(magic, False)) is False:
+					break
+
+				payload = self.file.read(length)
+				if len(payload) < length or zlib.crc32(payload) != checksum:
+					break
+
+			self.valid_end = self.file.tell()
+			self.section_count += 1
+			yield codec, payload, section
+
+		else:
+			return
+
+		self.torn = True
@@ -0,0 +1,42 @@
+#Journal shipping to replicas (see replica.py).
+#A follower subscribes with database_core.follow_journal and receives journal_shipment:
+#	'bootstrap'	entries of everything stored when following started, in chunks
+#	'ready'		the bootstrap is complete
+#	'section'	journal entries as they are written, in journal order. Entries may already be part of the bootstrap, applying them again changes nothing.
+#A follower falling more than max_backlog shipments behind is dropped with an 'overflow' change_notification and has to bootstrap again.
+
+from .subscriptions import subscription
+from .value_store import spilled_value
+
+from efforting.mvp4 import type_system as TS
+from efforting.mvp4.type_system.bases import public_base
+
+
+class journal_shipment(public_base):
+	kind = TS.positional(read_only=True)		#'bootstrap', 'ready' or 'section'
+	sequence = TS.positional(read_only=True)	#Number of the last section written on the primary when this was shipped
+	updated = TS.positional(read_only=True)		#When this was shipped by the primary
+	entries = TS.named((), read_only=True)		#storage_types.entry for 'bootstrap', journal entries for 'section'
+
+
+class journal_feed(subscription):
+	#The bootstrap is produced one chunk at a time as it is taken while sections keep queuing up behind it
+	bootstrap = TS.state(None)
+
+	def take(self, timeout=None):
+		if self.bootstrap is not None:
+			if not self.closed and (shipment := next(self.bootstrap, None)) is not None:
+				return (shipment,)
+			self.bootstrap = None
+		return super().take(timeout)
+
+
+def bootstrap_shipments(entries, chunk_size, sequence, updated):
+	#Spilled values are read back one chunk at a time, they are only meaningful to the value store of the primary
+	for offset in range(0, len(entries), chunk_size):
+		chunk = entries[offset:offset + chunk_size]
+		for entry in chunk:
+			if isinstance(entry.value, spilled_value):
+				entry.value = entry.value.load()
+		yield journal_shipment('bootstrap', sequence, updated, entries=chunk)
+	yield journal_shipment('ready', sequence, updated)
@@ -10,7 +10,22 @@ class access(base):
 
 class create(access):
 	value = TS.positional()
+	version = TS.named(None)	#Version of the entry after the change, None in journals written before entries were versioned
 
 class update(create):
 	previous_value = TS.positional()
 
+class access_batch(base):
+	#Coalesced access times, paths[i] was last accessed at timestamps[i]
+	paths = TS.positional()
+	timestamps = TS.positional()
+
+class batch(base):
+	#create/update entries that were applied atomically
+	changes = TS.positional()
+
+class access_summary(base):
+	#Written by archive compaction, paths[i] was accessed in counts[i] journal sections and last at timestamps[i]
+	paths = TS.positional()
+	counts = TS.positional()
+	timestamps = TS.positional()
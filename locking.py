@@ -0,0 +1,61 @@
+from .metrics import timed_lock
+
+import threading, contextlib
+
+
+class striped_lock:
+	#Lock striping by path so that writes to unrelated paths don't serialize.
+	#Stripes are always acquired in index order, all() gives a consistent view of everything.
+
+	def __init__(self, stripe_count=64):
+		self.stripes = tuple(threading.Lock() for _ in range(stripe_count))
+
+	def instrument(self, wait, hold):
+		#Must be called before the lock is used
+		self.stripes = tuple(timed_lock(stripe, wait, hold) for stripe in self.stripes)
+
+	def for_path(self, path):
+		return self.stripes[hash(path) % len(self.stripes)]
+
+	@contextlib.contextmanager
+	def for_indices(self, indices):
+		acquired = list()
+		try:
+			for index in indices:
+				self.stripes[index].acquire()
+				acquired.append(self.stripes[index])
+			yield
+		finally:
+			for lock in reversed(acquired):
+				lock.release()
+
+	def for_paths(self, paths):
+		return self.for_indices(sorted({hash(path) % len(self.stripes) for path in paths}))
+
+	def all(self):
+		return self.for_indices(range(len(self.stripes)))
+
+
+class journal_buffer:
+	#Per thread list of (sequence, generation, entry) so appending to the journal has no global critical section
+	__slots__ = ('lock', 'entries', 'thread')
+
+	def __init__(self, thread):
+		self.lock = threading.Lock()
+		self.entries = list()
+		self.thread = thread
+
+	def take(self, generation):
+		#Removes entries journaled in generation or earlier, they are always at the front
+		with self.lock:
+			entries = self.entries
+			split = len(entries)
+			while split and entries[split - 1][1] > generation:
+				split -= 1
+
+			if split == len(entries):
+				self.entries = list()
+				return entries
+			else:
+				self.entries = entries[split:]
+				return entries[:split]
@@ -0,0 +1,136 @@
+#Cheap always-on instrumentation.
+#Histograms have fixed power of two buckets so recording is a bit_length and an increment, nothing is allocated on the hot path.
+#Updates are not locked, concurrent updates of the same counter may very rarely lose an increment which is fine for statistics.
+
+from efforting.mvp4 import type_system as TS
+from efforting.mvp4.type_system.bases import public_base
+
+import threading, time
+
+BUCKET_COUNT = 40
+
+
+class counter:
+	__slots__ = ('value',)
+
+	def __init__(self):
+		self.value = 0
+
+	def add(self, amount=1):
+		self.value += amount
+
+
+class histogram:
+	#Bucket n holds values v (in units, see scale) with int(v).bit_length() == n, so bucket n covers [2**(n-1), 2**n)
+	__slots__ = ('scale', 'unit', 'buckets', 'count', 'total', 'maximum')
+
+	def __init__(self, scale=1, unit=''):
+		self.scale = scale		#Recorded values are multiplied by this, 1e6 records seconds as microseconds
+		self.unit = unit
+		self.buckets = [0] * BUCKET_COUNT
+		self.count = 0
+		self.total = 0
+		self.maximum = 0
+
+	def record(self, value):
+		scaled = int(value * self.scale)
+		self.buckets[min(scaled.bit_length(), BUCKET_COUNT - 1)] += 1
+		self.count += 1
+		self.total += scaled
+		if scaled > self.maximum:
+			self.maximum = scaled
+
+	def percentile(self, fraction):
+		#Upper bound of the bucket holding the percentile
+		if not self.count:
+			return None
+		remaining = fraction * self.count
+		for bits, count in enumerate(self.buckets):
+			remaining -= count
+			if remaining <= 0:
+				return min((1 << bits) - 1, self.maximum)
+		return self.maximum
+
+	def summary(self):
+		return dict(
+			unit = self.unit,
+			count = self.count,
+			mean = self.total / self.count if self.count else None,
+			p50 = self.percentile(0.5),
+			p90 = self.percentile(0.9),
+			p99 = self.percentile(0.99),
+			max = self.maximum,
+			buckets = {(1 << bits - 1 if bits else 0): count for bits, count in enumerate(self.buckets) if count},
+		)
+
+
+class timed_lock:
+	#Lock wrapper recording how long the lock was held and, when it was contended, how long acquiring it waited.
+	#Uncontended acquisitions are not timed, the hold histogram counts every acquisition.
+	#acquired is only touched by the thread holding the lock.
+	__slots__ = ('lock', 'wait', 'hold', 'acquired')
+
+	def __init__(self, lock, wait, hold):
+		self.lock = lock
+		self.wait = wait
+		self.hold = hold
+		self.acquired = 0
+
+	def acquire(self, blocking=True):
+		if self.lock.acquire(False):
+			self.acquired = time.perf_counter()
+		elif not blocking:
+			return False
+		else:
+			start = time.perf_counter()
+			self.lock.acquire()
+			self.acquired = now = time.perf_counter()
+			self.wait.record(now - start)
+		return True
+
+	def release(self):
+		self.hold.record(time.perf_counter() - self.acquired)
+		self.lock.release()
+
+	__enter__ = acquire
+
+	def __exit__(self, et, ev, tb):
+		self.release()
+
+
+class metrics_registry(public_base):
+	started = TS.factory(time.monotonic)
+	counters = TS.factory(dict)
+	histograms = TS.factory(dict)
+	lock = TS.factory(threading.Lock)	#Only guards creating counters and histograms
+
+	def counter(self, name):
+		if (result := self.counters.get(name)) is None:
+			with self.lock:
+				result = self.counters.setdefault(name, counter())
+		return result
+
+	def histogram(self, name, scale=1, unit=''):
+		if (result := self.histograms.get(name)) is None:
+			with self.lock:
+				result = self.histograms.setdefault(name, histogram(scale, unit))
+		return result
+
+	def timing(self, name):
+		return self.histogram(name, 1e6, 'us')
+
+	def record_command(self, command, duration, failed):
+		self.timing(f'command.{command}').record(duration)
+		if failed:
+			self.counter(f'command.{command}.errors').add()
+
+	def report(self):
+		with self.lock:
+			counters = tuple(self.counters.items())
+			histograms = tuple(self.histograms.items())
+
+		return dict(
+			uptime = time.monotonic() - self.started,
+			counters = {name: item.value for name, item in sorted(counters)},
+			histograms = {name: item.summary() for name, item in sorted(histograms)},
+		)
@@ -0,0 +1,97 @@
+#Sorted index of stored paths so that everything at or below a prefix can be enumerated in order without scanning storage_map.
+#Paths are kept in buckets of bounded size, adding a path is a bisect and a short list insert no matter how many paths there are.
+#Enumeration is paged by path rather than position so that it can be resumed from a cursor while paths are being added.
+
+import bisect, threading
+
+BUCKET_SIZE = 1024
+
+
+class path_index:
+	def __init__(self):
+		self.buckets = list()		#Sorted, non empty lists of paths
+		self.maximums = list()		#Last path of each bucket
+		self.count = 0
+		self.lock = threading.Lock()
+
+	def __len__(self):
+		return self.count
+
+	def __contains__(self, path):
+		with self.lock:
+			position = bisect.bisect_left(self.maximums, path)
+			if position == len(self.buckets):
+				return False
+			bucket = self.buckets[position]
+			offset = bisect.bisect_left(bucket, path)
+			return offset < len(bucket) and bucket[offset] == path
+
+	def add(self, path):
+		with self.lock:
+			if not self.buckets:
+				self.buckets.append([path])
+				self.maximums.append(path)
+				self.count += 1
+				return
+
+			position = min(bisect.bisect_left(self.maximums, path), len(self.buckets) - 1)
+			bucket = self.buckets[position]
+			offset = bisect.bisect_left(bucket, path)
+			if offset < len(bucket) and bucket[offset] == path:
+				return
+
+			bucket.insert(offset, path)
+			self.maximums[position] = bucket[-1]
+			self.count += 1
+			if len(bucket) >= 2 * BUCKET_SIZE:
+				self.buckets[position:position + 1] = bucket[:BUCKET_SIZE], bucket[BUCKET_SIZE:]
+				self.maximums[position:position + 1] = bucket[BUCKET_SIZE - 1], bucket[-1]
+
+	def update(self, paths):
+		#Adds many paths at once by sorting everything again, cheaper than add when loading a snapshot
+		with self.lock:
+			ordered = sorted(set(paths).union(*self.buckets))
+			self.buckets = [ordered[offset:offset + BUCKET_SIZE] for offset in range(0, len(ordered), BUCKET_SIZE)]
+			self.maximums = [bucket[-1] for bucket in self.buckets]
+			self.count = len(ordered)
+
+	def page(self, lower, inclusive, limit):
+		#Up to limit paths in order starting at lower (or right after it unless inclusive)
+		result = list()
+		with self.lock:
+			position = bisect.bisect_left(self.maximums, lower)
+			if position < len(self.buckets):
+				offset = (bisect.bisect_left if inclusive else bisect.bisect_right)(self.buckets[position], lower)
+				while position < len(self.buckets) and len(result) < limit:
+					result.extend(self.buckets[position][offset:offset + limit - len(result)])
+					position += 1
+					offset = 0
+		return result
+
+	def iter_prefix(self, prefix='', chunk_size=1000, cursor=None):
+		#Yields tuples of at most chunk_size paths at or below prefix in order, only paths after cursor if given.
+		#Each chunk is collected under the lock on its own, paths added in between are included if they sort after the previous chunk.
+		if chunk_size < 1:
+			raise ValueError(f'chunk_size must be positive, not {chunk_size}')
+		below = f'{prefix}.' if prefix else ''		#Everything below prefix sorts together, prefix itself sorts right before
+		chunk = [prefix] if prefix and (cursor is None or cursor < prefix) and prefix in self else []
+		lower, inclusive = (cursor, False) if cursor is not None and cursor >= below else (below, True)
+
+		while True:
+			requested = chunk_size - len(chunk)
+			page = self.page(lower, inclusive, requested)
+			for path in page:
+				if not path.startswith(below):
+					if chunk:
+						yield tuple(chunk)
+					return
+				chunk.append(path)
+
+			if len(page) < requested:
+				if chunk:
+					yield tuple(chunk)
+				return
+
+			yield tuple(chunk)
+			lower, inclusive = (chunk[-1], False) if chunk[-1] >= below else (below, True)
+			chunk = []
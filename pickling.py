@@ -1,6 +1,6 @@
 from . import storage_types, journal_types
 
-import pickle
+import pickle, pickletools, io
 
 class db_pickler(pickle.Pickler):
 
@@ -8,6 +8,10 @@ class db_pickler(pickle.Pickler):
 		match item:
 			case journal_types.base():
 				return (db_unpickler.recreate_journal_entry, (item.__class__, item.__getstate__()))
+			case storage_types.frozen_namespace():
+				return (db_unpickler.recreate_frozen_namespace, (tuple(item),))
+			case storage_types.frozen_mapping():
+				return (db_unpickler.recreate_frozen_mapping, (tuple(item.items()),))
 			case storage_types.namespace():
 				return (db_unpickler.recreate_namespace, (tuple(item),))
 			case _:
@@ -17,6 +21,106 @@ class db_unpickler(pickle.Unpickler):
 	def recreate_namespace(parameters):
 		return storage_types.namespace(parameters)
 
+	def recreate_frozen_namespace(parameters):
+		return storage_types.frozen_namespace(parameters)
+
+	def recreate_frozen_mapping(items):
+		return storage_types.frozen_mapping(items)
+
 	def recreate_journal_entry(entry_type, state):
 		return entry_type(**state)
 
+
+def db_dumps(item):
+	buffer = io.BytesIO()
+	db_pickler(buffer).dump(item)
+	return buffer.getvalue()
+
+def db_loads(data):
+	return db_unpickler(io.BytesIO(data)).load()
+
+
+class incomplete_message(Exception):
+	pass
+
+class message_buffer:
+	#File like object for an unpickler fed from a non blocking source, reading past the received data raises incomplete_message
+	def __init__(self):
+		self.data = bytearray()
+		self.position = 0
+		self.required = 0		#Decoding can't progress until data is at least this long
+
+	def need(self, size):
+		if self.position + size > len(self.data):
+			self.required = self.position + size
+			raise incomplete_message()
+
+	def read(self, size=-1):
+		if size < 0:
+			size = len(self.data) - self.position
+		self.need(size)
+		result = bytes(self.data[self.position:self.position + size])
+		self.position += size
+		return result
+
+	def readinto(self, target):
+		size = len(target)
+		self.need(size)
+		target[:] = self.data[self.position:self.position + size]
+		self.position += size
+		return size
+
+	def readline(self):
+		if (end := self.data.find(b'\n', self.position)) == -1:
+			self.required = len(self.data) + 1
+			raise incomplete_message()
+		return self.read(end + 1 - self.position)
+
+	def discard_consumed(self):
+		del self.data[:self.position]
+		self.required = max(0, self.required - self.position)
+		self.position = 0
+
+
+def skip_message(buffer):
+	#Walks the opcodes of the next pickle in buffer without unpickling, raises incomplete_message if it hasn't fully arrived
+	for opcode, argument, position in pickletools.genops(buffer):
+		pass
+
+
+class stream_decoder:
+	#Decodes a stream written by a single db_pickler as data arrives.
+	#The unpickler is kept for the whole stream since the pickler memo spans messages.
+	#A message is only unpickled once it has fully arrived, a partial load would already have memoized some of its objects.
+	def __init__(self):
+		self.buffer = message_buffer()
+		self.unpickler = db_unpickler(self.buffer)
+
+	def feed(self, data):
+		buffer = self.buffer
+		buffer.data += data
+		while buffer.position < len(buffer.data) and len(buffer.data) >= buffer.required:
+			start = buffer.position
+			try:
+				skip_message(buffer)
+			except incomplete_message:
+				buffer.position = start
+				break
+			buffer.position = start
+			yield self.unpickler.load()
+
+		buffer.discard_consumed()
+
+
+class stream_encoder:
+	#Counterpart of stream_decoder, encodes messages with a single db_pickler and hands out the bytes
+	def __init__(self):
+		self.buffer = io.BytesIO()
+		self.pickler = db_pickler(self.buffer)
+
+	def encode(self, item):
+		self.pickler.dump(item)
+		result = self.buffer.getvalue()
+		self.buffer.seek(0)
+		self.buffer.truncate()
+		return result
@@ -0,0 +1,197 @@
+#Read replica following a primary service endpoint through its journal, see journal_shipping.
+#	python -m efforting.persistent_storage2.replica --primary 127.0.0.1:55201 --port 55202
+#The replica keeps its own database_core in memory (spilling to its own value store if given a memory_budget), it writes no journal or snapshot.
+#Values stored with store_stream are read from the blob directory of the primary so replicas run on the same machine or share that directory.
+#Reads are refused until the first bootstrap is complete, connection_pool(replicas=...) then routes reads to replicas.
+
+from .db_core import database_core
+from .blob_store import blob_store
+from .value_store import value_store
+from .service_client import remote_db_interface, SENTINEL
+from .service_endpoint import query_server, create_command_set
+from .subscriptions import change_notification
+from .wire_format import SUPPORTED_PROTOCOLS
+
+from efforting.mvp4 import type_system as TS
+from efforting.mvp4.type_system.bases import public_base
+
+import threading, time
+
+#Commands of the primary command set served by replicas, only after the bootstrap unless also in status_commands
+read_commands = ('ping', 'get_db_info', 'get_metrics', 'require', 'get', 'get_meta', 'multi_get', 'list_paths', 'iter_all_object_paths', 'get_stream_open', 'get_stream_read', 'get_stream_close')
+status_commands = ('ping', 'get_db_info', 'get_metrics')
+
+
+def replica_database(**settings):
+	#database_core for a replica, none of its files are opened so that it can run next to the primary
+	db = database_core(track_access=False, **settings)
+	if db.collect_metrics:
+		db.instrument_locks()
+	db.blobs = blob_store(db.blob_directory)
+	db.spill_store = value_store(db.value_store_filename)
+	return db
+
+
+class replica(public_base):
+	primary_host = TS.positional()
+	primary_port = TS.positional()
+	db = TS.positional()		#See replica_database
+	chunk_size = TS.named(1000)		#Entries per bootstrap shipment
+	max_backlog = TS.named(10000)		#Shipments the primary queues for us before dropping us, we then bootstrap again
+	window = TS.named(16)		#Batches of shipments received ahead of being applied
+	retry_interval = TS.named(1)
+	protocols = TS.named(SUPPORTED_PROTOCOLS)
+
+	state = TS.state('stopped')		#'connecting', 'bootstrapping', 'following' or 'stopped'
+	ready = TS.state(False)			#Set once the first bootstrap is complete, stays set while bootstrapping again
+	ready_event = TS.factory(threading.Event)
+	running = TS.state(False)
+	thread = TS.state(None)
+	remote = TS.state(None)			#Connection to the primary while connected
+	follow_query = TS.state(None)
+
+	bootstraps = TS.state(0)
+	applied_sections = TS.state(0)
+	applied_entries = TS.state(0)
+	primary_sequence = TS.state(None)	#Sections written by the primary as of the last applied shipment
+	last_shipped = TS.state(None)		#Time the primary shipped the last applied shipment
+	lag = TS.state(None)				#Seconds from the primary shipping the last applied shipment until it was applied
+	last_error = TS.state(None)
+
+	def start(self):
+		self.running = True
+		self.thread = threading.Thread(target=self.run, name='replica-follower', daemon=True)
+		self.thread.start()
+
+	def stop(self):
+		self.running = False
+		if remote := self.remote:
+			remote.close()
+		if thread := self.thread:
+			thread.join()
+			self.thread = None
+		self.state = 'stopped'
+
+	def wait_until_ready(self, timeout=None):
+		return self.ready_event.wait(timeout)
+
+	def run(self):
+		while self.running:
+			self.state = 'connecting'
+			try:
+				with remote_db_interface(self.primary_host, self.primary_port, self.protocols) as remote:
+					self.remote = remote
+					while self.running and self.follow(remote):
+						pass
+			except Exception as e:
+				self.last_error = repr(e)
+			finally:
+				self.remote = None
+
+			if self.running:
+				time.sleep(self.retry_interval)
+
+	def follow(self, remote):
+		#Returns True if the primary dropped us for falling behind, we then follow again starting with a new bootstrap
+		self.follow_query = q = remote.query('follow_journal', self.chunk_size, self.max_backlog, max_partial=self.window)
+		self.state = 'bootstrapping'
+		self.bootstraps += 1
+		try:
+			while (batch := q.next_partial()) is not SENTINEL:
+				for shipment in batch:
+					if isinstance(shipment, change_notification):
+						#Overflow, the primary ends the query after this
+						q.require_response()
+						return True
+					self.apply(shipment)
+
+			q.require_response()
+			return False
+
+		finally:
+			self.follow_query = None
+			if not q.finished.is_set():
+				q.discard_partial()
+
+	def apply(self, shipment):
+		db = self.db
+		match shipment.kind:
+			case 'bootstrap':
+				for entry in shipment.entries:
+					db.load_entry(entry)
+				db.spill_cold_values()
+
+			case 'ready':
+				self.state = 'following'
+				self.ready = True
+				self.ready_event.set()
+
+			case 'section':
+				for entry in shipment.entries:
+					db.recreate_journal_entry(entry)
+				db.spill_cold_values()
+				self.applied_sections += 1
+				self.applied_entries += len(shipment.entries)
+
+			case _:
+				raise ValueError(shipment.kind)
+
+		self.primary_sequence = shipment.sequence
+		self.last_shipped = shipment.updated
+		self.lag = time.time() - shipment.updated		#Both clocks are the same on one machine
+
+	def report(self):
+		q = self.follow_query
+		return dict(
+			primary = f'{self.primary_host}:{self.primary_port}',
+			state = self.state,
+			ready = self.ready,
+			bootstraps = self.bootstraps,
+			applied_sections = self.applied_sections,
+			applied_entries = self.applied_entries,
+			primary_sequence = self.primary_sequence,
+			lag = self.lag,
+			received_backlog = q.partial.qsize() if q else None,		#Batches received but not applied yet
+			since_last_shipment = time.time() - self.last_shipped if self.last_shipped is not None else None,	#Grows while the primary has nothing to ship
+			last_error = self.last_error,
+		)
+
+
+def create_replica_command_set(follower):
+	commands = create_command_set(follower.db)
+
+	def after_bootstrap(command):
+		def guarded(session, *arguments):
+			if not follower.ready:
+				raise Exception(f'Replica of {follower.primary_host}:{follower.primary_port} has not completed its bootstrap yet')
+			return command(session, *arguments)
+		return guarded
+
+	def cmd_get_replication_status(session):
+		return follower.report()
+
+	command_set = {name: commands[name] if name in status_commands else after_bootstrap(commands[name]) for name in read_commands}
+	command_set['get_replication_status'] = cmd_get_replication_status
+	return command_set
+
+
+if __name__ == '__main__':
+	import argparse
+	parser = argparse.ArgumentParser(description='Serve reads from a replica following the journal of a primary service endpoint')
+	parser.add_argument('--primary', type=str, default='127.0.0.1:55201', help='host:port of the primary')
+	parser.add_argument('--host', type=str, default='127.0.0.1', help='Address to serve reads on')
+	parser.add_argument('--port', type=int, default=55202, help='Port to serve reads on')
+	parser.add_argument('--blob-directory', type=str, default='db-blobs', help='Blob directory of the primary')
+	parser.add_argument('--memory-budget', type=int, help='Bytes of resident values before values are spilled, see database_core.memory_budget')
+	parser.add_argument('--value-store', type=str, help='File for spilled values, one per port by default')
+	args = parser.parse_args()
+
+	primary_host, primary_port = args.primary.rsplit(':', 1)
+	db = replica_database(blob_directory=args.blob_directory, memory_budget=args.memory_budget, value_store_filename=args.value_store or f'db-replica-{args.port}-values.pickle')
+	follower = replica(primary_host, int(primary_port), db)
+	follower.start()
+	try:
+		with query_server((args.host, args.port), create_replica_command_set(follower), metrics=db.metrics) as server:
+			server.serve_forever()
+	finally:
+		follower.stop()
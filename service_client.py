@@ -1,14 +1,18 @@
-from .pickling import db_pickler, db_unpickler
+from .wire_format import open_channel, SUPPORTED_PROTOCOLS
+from .blob_store import DEFAULT_CHUNK_SIZE
 
 from efforting.mvp4.rudimentary_types.data_path import data_path
 
-from socketserver import StreamRequestHandler
-import threading, queue
+import threading, queue, itertools, collections
 import socket
 
 SENTINEL = object()
 
 
+class connection_lost(Exception):
+	pass
+
+
 
 class pythonic_path:
 	def __init__(self, *path_spec):
@@ -26,17 +30,25 @@ class pythonic_path:
 
 class interface:
 	#TODO: Make a lot of stuff "private", like read/write
-	def __init__(self, sock):
+	def __init__(self, sock, protocols=SUPPORTED_PROTOCOLS):
 		self.socket = sock
-		self.stream = StreamRequestHandler(sock, None, None)
-		self.stream.setup()
+		self.rfile = sock.makefile('rb')
+		self.wfile = sock.makefile('wb')	#Buffered, flushed when there are no more queued requests
 		self.to_request_queue = queue.Queue()
-		self.outstanding_queries = dict()
+		self.outstanding_queries = dict()	#Keyed by request id
+		self.request_ids = itertools.count(1)
+		self.query_lock = threading.Lock()
 		self.all_finished = threading.Event()
+		self.broken = False
+
+		self.channel = open_channel(self.rfile, self.wfile, protocols)
+
 
-		self.unpickler = db_unpickler(self.stream.rfile)
-		self.pickler = db_pickler(self.stream.wfile)
+	def get_db_info(self):
+		return self.query('get_db_info').require_response()
 
+	def get_metrics(self):
+		return self.query('get_metrics').require_response()
 
 	def get(self, path, default=None):
 		return self.query('get', str(path), default).require_response()
@@ -44,25 +56,137 @@ class interface:
 	def require(self, path):
 		return self.query('require', str(path)).require_response()
 
-	def set(self, path, value):
-		self.query('set', str(path), value).require_response()
+	def set(self, path, value, durability=None):
+		self.query('set', str(path), value, durability).require_response()
+
+	def compare_and_set(self, path, expected_version, value, durability=None):
+		#Returns (True, new version) or (False, current entry or None), see database_core.compare_and_set
+		return self.query('compare_and_set', str(path), expected_version, value, durability).require_response()
+
+	def update_if_unmodified(self, path, function, default=None, durability=None, max_attempts=None):
+		#Optimistic read-modify-write, function(current value or default) is retried against the current value until nobody changed it in between.
+		#A conflict returns the current entry so each retry is a single round trip.
+		current = self.get_meta(path, None, True)
+		for attempt in itertools.count(1):
+			version, value = (current.version, current.value) if current else (0, default)
+			success, result = self.compare_and_set(path, version, function(value), durability)
+			if success:
+				return result
+			if max_attempts is not None and attempt >= max_attempts:
+				raise Exception(f'{path} was modified concurrently in {attempt} attempts')
+			current = result
+
+	def set_stream(self, path, chunks, durability=None, window=4):
+		#Stores the concatenated chunks (bytes like objects) without building the whole value on either side, the server keeps it in a blob file.
+		#At most window chunks are in flight so memory use is bounded by the chunk size.
+		upload_id = self.query('set_stream_open', str(path)).require_response()
+		in_flight = collections.deque()
+		try:
+			for chunk in chunks:
+				in_flight.append(self.query('set_stream_write', upload_id, bytes(chunk)))
+				if len(in_flight) > window:
+					in_flight.popleft().require_response()
+			while in_flight:
+				in_flight.popleft().require_response()
+		except:
+			if not self.broken:
+				self.query('set_stream_abort', upload_id)
+			raise
+
+		return self.query('set_stream_commit', upload_id, durability).require_response()
+
+	def get_stream(self, path, chunk_size=DEFAULT_CHUNK_SIZE, window=4):
+		#Yields the bytes value of path in chunks.
+		#Each chunk is a query of its own with up to window of them in flight, the server only sends what was asked for so other queries on the connection are never held up behind chunks not consumed yet.
+		download_id = self.query('get_stream_open', str(path), chunk_size).require_response()
+		in_flight = collections.deque()
+		try:
+			while True:
+				while len(in_flight) < window:
+					in_flight.append(self.query('get_stream_read', download_id))
+				if (chunk := in_flight.popleft().require_response()) is None:
+					return
+				yield chunk
+		finally:
+			if not self.broken:
+				self.query('get_stream_close', download_id)
+
+	def list_paths_page(self, prefix='', chunk_size=1000, cursor=None):
+		#Tuple of at most chunk_size stored paths at or below prefix after cursor in sorted order, a shorter page is the last one
+		return self.query('list_paths', str(prefix), chunk_size, cursor).require_response()
+
+	def list_paths(self, prefix='', chunk_size=1000, cursor=None):
+		#Yields stored paths at or below prefix in sorted order, each page is requested once the previous one is consumed.
+		#To resume after an interruption pass the last path received as cursor.
+		while True:
+			page = self.list_paths_page(prefix, chunk_size, cursor)
+			yield from page
+			if len(page) < chunk_size:
+				return
+			cursor = page[-1]
 
 	def get_meta(self, path, default=None, load_value=False):
 		return self.query('get_meta', str(path), default, load_value).require_response()
 
+	def get_at(self, path, timestamp, default=None):
+		#Value of path as it was at timestamp (seconds since epoch)
+		return self.query('get_at', str(path), timestamp, default).require_response()
+
+	def restore_to(self, timestamp, durability=None):
+		return self.query('restore_to', timestamp, durability).require_response()
+
+	def multi_get(self, paths, default=None):
+		return self.query('multi_get', tuple(map(str, paths)), default).require_response()
+
+	def multi_set(self, mapping, durability=None):
+		self.query('multi_set', {str(path): value for path, value in mapping.items()}, durability).require_response()
 
-	def query(self, command, *arguments):
-		assert command not in self.outstanding_queries
-		q = query(command, arguments)
-		self.outstanding_queries[command] = q
+	def batch(self, operations, durability=None):
+		#Operations are ('set', path, value), ('get', path[, default]) or ('require', path), applied atomically
+		return self.query('batch', tuple((command, str(path), *rest) for command, path, *rest in operations), durability).require_response()
+
+	def watch(self, path, last_known_updated=None, include_values=False):
+		#Yields change notifications for path and everything below it until the generator is closed.
+		#If the server drops the subscription because we fell behind we subscribe again from the oldest change we missed.
+		while True:
+			q = self.query('watch', str(path), last_known_updated, include_values)
+			overflow = False
+			try:
+				while (batch := q.partial.get()) is not SENTINEL:
+					for notification in batch:
+						if notification.kind == 'overflow':
+							overflow = True
+							last_known_updated = notification.updated
+						else:
+							yield notification
+			finally:
+				if not q.finished.is_set() and not self.broken:
+					self.query('unwatch', q.request_id)
+
+			q.require_response()
+			if not overflow:
+				return
+
+
+	def ping(self, timeout=None):
+		success, response = self.query('ping').wait(timeout)
+		return success and response is True
+
+	def query(self, command, *arguments, max_partial=None):
+		#Thread safe, any number of queries may be in flight on the same connection
+		with self.query_lock:
+			if self.broken:
+				raise connection_lost()
+			q = query(next(self.request_ids), command, arguments, max_partial)
+			self.outstanding_queries[q.request_id] = q
 		self.to_request_queue.put(q)
 		return q
 
 	def read(self):
-		return self.unpickler.load()
+		return self.channel.read()
 
 	def write(self, value):
-		self.pickler.dump(value)
+		self.channel.write(value)
 
 
 	def start(self):
@@ -76,20 +200,31 @@ class interface:
 	def handle_query_responses(self):
 		try:
 			while True:
-				state, command, arguments = self.read()
+				state, request_id, arguments = self.read()
 
 				if state == 'response':
-					self.outstanding_queries.pop(command).emit_response(arguments)
+					self.outstanding_queries.pop(request_id).emit_response(arguments)
 				elif state == 'failure':
-					self.outstanding_queries.pop(command).emit_failure(arguments)
+					self.outstanding_queries.pop(request_id).emit_failure(arguments)
 				elif state == 'partial':
-					self.outstanding_queries[command].emit_partial(arguments)
+					self.outstanding_queries[request_id].emit_partial(arguments)
 				else:
-					raise Exception((state, command, arguments))
+					raise Exception((state, request_id, arguments))
+
+		except (EOFError, OSError):
+			pass	#Connection closed
+
+		finally:
+			#Exceptions other than the connection closing will still not be caught because it happens within this thread, but at least nobody is left waiting
+			with self.query_lock:
+				self.broken = True
+				abandoned = tuple(self.outstanding_queries.values())
+				self.outstanding_queries.clear()
+
+			for q in abandoned:
+				q.emit_connection_lost()
 
-		except:	#Exceptions here will not be caught because it happens within this thread. We should deal with this better.
 			self.to_request_queue.put(SENTINEL)
-			raise
 
 
 	def handle_query_requests(self):
@@ -97,18 +232,35 @@ class interface:
 			if (q := self.to_request_queue.get()) is SENTINEL:
 				break
 
-			self.write((q.command, *q.arguments))
+			try:
+				self.write((q.request_id, q.command, *q.arguments))
+				if self.to_request_queue.empty():
+					self.wfile.flush()
+			except OSError:
+				break	#The response thread will notice too and fail outstanding queries
+
+	def close(self):
+		try:
+			self.socket.shutdown(socket.SHUT_RDWR)
+		except OSError:
+			pass
+		self.socket.close()
 
 	def exhaust(self):
 		self.all_finished.wait()
 
 class query:
-	def __init__(self, command, arguments):
+	def __init__(self, request_id, command, arguments, max_partial=None):
+		self.request_id = request_id
 		self.command = command
 		self.arguments = arguments
 		self.finished = threading.Event()
 		self.partial = queue.Queue()
+		self.max_partial = max_partial
+		self.partial_slots = max_partial and threading.Semaphore(max_partial)	#Consumed with next_partial when bounded
+		self.discarding = False
 		self.success = False
+		self.lost = False
 
 	def emit_response(self, response):
 		self.response = response
@@ -122,16 +274,47 @@ class query:
 		self.success = False
 		self.finished.set()
 
+	def emit_connection_lost(self):
+		self.lost = True
+		self.emit_failure('Connection lost')
+
 	def emit_partial(self, response):
+		#Blocks the response thread while max_partial partial responses are waiting, nothing else on the connection is received meanwhile.
+		#Only bound queries on a connection dedicated to them (see replica.follow).
+		if self.partial_slots:
+			self.partial_slots.acquire()
+			if self.discarding:
+				self.partial_slots.release()
+				return
 		self.partial.put(response)
 
-	def wait(self):
-		self.finished.wait()
+	def next_partial(self):
+		item = self.partial.get()
+		if self.partial_slots and item is not SENTINEL:
+			self.partial_slots.release()
+		return item
+
+	def discard_partial(self):
+		#For a consumer that stops early, the remaining partial responses are dropped so that the response thread is never left blocked
+		self.discarding = True
+		if self.partial_slots:
+			self.partial_slots.release(self.max_partial)
+		while True:
+			try:
+				self.partial.get_nowait()
+			except queue.Empty:
+				break
+
+	def wait(self, timeout=None):
+		if not self.finished.wait(timeout):
+			return False, 'Timeout'
 		return self.success, self.response
 
 	def require_response(self):
 		self.finished.wait()
-		if self.success:
+		if self.lost:
+			raise connection_lost()
+		elif self.success:
 			return self.response
 		else:
 			import textwrap
@@ -140,19 +323,21 @@ class query:
 
 
 class remote_db_interface:
-	def __init__(self, host, port):
+	def __init__(self, host, port, protocols=SUPPORTED_PROTOCOLS):
 		self.host = host
 		self.port = port
+		self.protocols = protocols		#Offer only (PROTOCOL_LEGACY,) to talk to endpoints predating protocol negotiation
 		self.socket = None
 
 	def __enter__(self):
 		self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM).__enter__()
-		self.socket.connect(('localhost', 55201))
-		self.remote = interface(self.socket)
+		self.socket.connect((self.host, self.port))
+		self.remote = interface(self.socket, self.protocols)
 		self.remote.start()
 		return self.remote
 
 	def __exit__(self, et, ev, tb):
-		self.socket.__exit__(et, ev, tb)	#Closes socket which causes self.remote to terminate too
+		#Shut down explicitly, the files from makefile keep the connection open after the socket object is closed
+		self.remote.close()	#Causes self.remote to terminate too
 
 
@@ -4,14 +4,16 @@
 #		implement and test automatic flushing of journal
 
 from .db_core import database_core
-from .pickling import db_pickler, db_unpickler
+from .wire_format import accept_channel, protocol_error
+from .subscriptions import subscription
+from .blob_store import DEFAULT_CHUNK_SIZE
 
 from efforting.mvp4 import type_system as TS
 from efforting.mvp4.type_system.bases import public_base
 
 from collections.abc import Iterator
 import socketserver
-import time, threading
+import time, threading, select, itertools
 
 class session_lock(public_base):
 	path = TS.positional()
@@ -22,72 +24,175 @@ current_sessions = set()
 lock_by_path = dict()
 lock_by_session = dict()
 lock_guard = threading.Lock()
+stream_by_session = dict()	#Detached streams (subscriptions) by request id
+upload_by_session = dict()	#(path, blob_writer) of unfinished set_stream uploads by upload id
+upload_ids = itertools.count(1)
+download_by_session = dict()	#Chunk iterators of unfinished get_stream downloads by download id
+download_ids = itertools.count(1)
+
+
+def open_session(session):
+	current_sessions.add(session)
+	lock_by_session[session] = set()
+	stream_by_session[session] = dict()
+	upload_by_session[session] = dict()
+	download_by_session[session] = dict()
+
+def close_session(session):
+	current_sessions.discard(session)
+	with lock_guard:
+		for lock in lock_by_session.pop(session, ()):
+			lock_by_path.pop(lock.path, None)
+
+	for stream in tuple(stream_by_session.pop(session, {}).values()):
+		stream.close()
+
+	for path, writer in upload_by_session.pop(session, {}).values():
+		writer.close()
+
+	for chunks in download_by_session.pop(session, {}).values():
+		chunks.close()
+
+def format_exception(exception):
+	import io, traceback
+	formatted_exception = io.StringIO()
+	traceback.print_exception(exception, file=formatted_exception)
+	return formatted_exception.getvalue()
 
 
 #TODO - do not allow non identifier names nor names that begins with underscore to simplify interfaces
 
 class query_handler(socketserver.StreamRequestHandler):
+	wbufsize = -1	#Buffered so that responses to pipelined requests can be sent together
 
 	def handle(self):
-		current_sessions.add(self)
-		lock_by_session[self] = set()
+		command_set = self.server.command_set
+		metrics = self.server.metrics
 
-		unpickler = db_unpickler(self.rfile)
-		pickler = db_pickler(self.wfile)
+		try:
+			channel = accept_channel(self.rfile, self.wfile)
+		except (EOFError, protocol_error):
+			return
+
+		open_session(self)
+		output_lock = threading.Lock()	#Detached streams write from their own threads
 
 		def read():
-			return unpickler.load()
+			return channel.read()
 
 		def write(value):
-			pickler.dump(value)
+			with output_lock:
+				channel.write(value)
 
-		while True:
-			try:
-				command, *args = read()
-			except EOFError:
-				break
+		def flush():
+			with output_lock:
+				self.wfile.flush()
+
+		def flush_unless_pipelined():
+			#If the client already sent more requests we hold on to the response so it is sent together with the next ones
+			if not select.select([self.connection], [], [], 0)[0]:
+				flush()
+
+		def forward_stream(request_id, stream):
+			#Runs until the stream is closed (unwatch, overflow or end of session) while the session keeps serving other requests
+			start_time = time.monotonic()
 			try:
-				result = command_set[command](self, *args)
-			except Exception as e:
-				import io, traceback
-				formatted_exception = io.StringIO()
-				traceback.print_exception(e, file=formatted_exception)
-				write(('failure', command, formatted_exception.getvalue()))
-			else:
-				if isinstance(result, Iterator):
-					start_time = time.monotonic()
-					for sub_item in result:
-						write(('partial', command, sub_item))
-					stop_time = time.monotonic()
-					duration = stop_time - start_time
-					write(('response', command, duration))
+				for sub_item in stream:
+					write(('partial', request_id, sub_item))
+					flush()
+				write(('response', request_id, time.monotonic() - start_time))
+				flush()
+			except (OSError, ValueError):
+				pass	#Session is gone
+			finally:
+				stream.close()
+				stream_by_session.get(self, {}).pop(request_id, None)
+
+		try:
+			while True:
+				try:
+					request_id, command, *args = read()
+				except (EOFError, OSError):
+					break
+				start_time = time.perf_counter()
+				failed = False
+				try:
+					result = command_set[command](self, *args)
+				except Exception as e:
+					failed = True
+					write(('failure', request_id, format_exception(e)))
 				else:
-					write(('response', command, result))
+					if isinstance(result, subscription):
+						stream_by_session[self][request_id] = result
+						threading.Thread(target=forward_stream, args=(request_id, result), daemon=True).start()
+					elif isinstance(result, Iterator):
+						stream_start = time.monotonic()
+						for sub_item in result:
+							write(('partial', request_id, sub_item))
+						stop_time = time.monotonic()
+						duration = stop_time - stream_start
+						write(('response', request_id, duration))
+					else:
+						write(('response', request_id, result))
 
-		current_sessions.discard(self)
-		with lock_guard:
-			for lock in lock_by_session.pop(self, ()):
-				lock_by_path.pop(lock.path, None)
+				if metrics and command in command_set:
+					metrics.record_command(command, time.perf_counter() - start_time, failed)
+
+				flush_unless_pipelined()
+
+		except OSError:
+			pass	#Connection reset while responding
+
+		finally:
+			close_session(self)
 
 
 class query_server(socketserver.ThreadingTCPServer):
 	allow_reuse_address = True
 
+	def __init__(self, server_address, command_set, RequestHandlerClass=query_handler, metrics=None):
+		self.command_set = command_set
+		self.metrics = metrics		#metrics_registry for per command latency and errors
+		super().__init__(server_address, RequestHandlerClass)
+
+
+def check_write_lock(session, path):
+	if lock := lock_by_path.get(path):
+		match lock:
+			case session_lock():
+				assert session is lock.session
+
 
-with database_core(journal_auto_flush_timeout=None) as db:
+def create_command_set(db):
 
+	def cmd_ping(session):
+		return True
 
 	def cmd_get_db_info(session):
 		return dict(
 			stored_object_count=len(db.storage_map),
 			sessions_count=len(current_sessions),
 			lock_count=len(lock_by_path),
+			uptime=time.monotonic() - db.metrics.started,
+			journal_written_generation=db.journal_written_generation,
+			journal_synced_generation=db.journal_synced_generation,
+			last_recovery=db.last_recovery,
+			last_snapshot=db.last_snapshot,
+			last_compaction=db.last_compaction,
+			value_tiering=db.tiering_report(),
+			replication=db.replication_report(),
 		)
 
+	def cmd_get_metrics(session):
+		return db.metrics.report()
+
 	def cmd_iter_all_object_paths(session, chunk_size=None):
-		assert chunk_size is None, 'Not supported yet'
-		paths = tuple(o.path for o in db.storage_map.values())
-		return iter((paths,))
+		#Without chunk_size every path is sent as one partial response, see list_paths
+		return db.list_paths('', chunk_size or max(len(db.path_index), 1))
+
+	def cmd_list_paths(session, prefix='', chunk_size=1000, cursor=None):
+		#One page, a tuple of at most chunk_size paths in sorted order after cursor (see database_core.list_paths). A shorter page is the last one.
+		return next(db.list_paths(prefix, chunk_size, cursor), ())
 
 	def cmd_require(session, path):
 		return db.load(path)
@@ -95,13 +200,87 @@ with database_core(journal_auto_flush_timeout=None) as db:
 	def cmd_get(session, path, default=None):
 		return db.get(path, default)
 
-	def cmd_set(session, path, value):	#TODO - offer commands that require path to be free
+	def cmd_set(session, path, value, durability=None):	#TODO - offer commands that require path to be free
 		check_write_lock(session, path)
-		db.store(path, value)
+		db.store(path, value, durability)
+
+	def cmd_compare_and_set(session, path, expected_version, value, durability=None):
+		check_write_lock(session, path)
+		return db.compare_and_set(path, expected_version, value, durability)
+
+	def cmd_set_stream_open(session, path):
+		#Starts an upload, chunks are sent with set_stream_write and the value is stored by set_stream_commit
+		check_write_lock(session, path)
+		upload_id = next(upload_ids)
+		upload_by_session[session][upload_id] = path, db.open_blob()
+		return upload_id
+
+	def cmd_set_stream_write(session, upload_id, chunk):
+		path, writer = upload_by_session[session][upload_id]
+		writer.write(chunk)
+
+	def cmd_set_stream_commit(session, upload_id, durability=None):
+		path, writer = upload_by_session[session].pop(upload_id)
+		with writer:
+			check_write_lock(session, path)
+			return db.store_blob(path, writer, durability)
+
+	def cmd_set_stream_abort(session, upload_id):
+		if upload := upload_by_session[session].pop(upload_id, None):
+			path, writer = upload
+			writer.close()
+
+	def cmd_get_stream_open(session, path, chunk_size=DEFAULT_CHUNK_SIZE):
+		#Starts a download, chunks are requested one at a time with get_stream_read so nothing is sent that the client did not ask for
+		download_id = next(download_ids)
+		download_by_session[session][download_id] = db.load_stream(path, chunk_size)
+		return download_id
+
+	def cmd_get_stream_read(session, download_id):
+		#Next chunk, None once the whole value was read
+		return next(download_by_session[session][download_id], None)
+
+	def cmd_get_stream_close(session, download_id):
+		if chunks := download_by_session[session].pop(download_id, None):
+			chunks.close()
 
 	def cmd_get_meta(session, path, default=None, load_value=False):
 		return db.get_meta(path, default, load_value)
 
+	def cmd_multi_get(session, paths, default=None):
+		return db.get_many(paths, default)
+
+	def cmd_multi_set(session, mapping, durability=None):
+		for path in mapping:
+			check_write_lock(session, path)
+		db.store_many(mapping.items(), durability)
+
+	def cmd_batch(session, operations, durability=None):
+		for command, path, *_ in operations:
+			if command == 'set':
+				check_write_lock(session, path)
+		return db.apply_batch(operations, durability)
+
+	def cmd_get_at(session, path, timestamp, default=None):
+		return db.get_at(path, timestamp, default)
+
+	def cmd_restore_to(session, timestamp, durability=None):
+		return db.restore_to(timestamp, durability)
+
+	def cmd_compact_archive(session, bucket_seconds=3600, collapse=False):
+		return db.compact_archive(bucket_seconds, collapse)
+
+	def cmd_watch(session, prefix, last_known_updated=None, include_values=False):
+		#Partial responses are tuples of change_notification, the query only finishes when unwatched or if the session falls too far behind (see subscription.push)
+		return db.watch(prefix, last_known_updated, include_values)
+
+	def cmd_follow_journal(session, chunk_size=1000, max_backlog=10000):
+		#Partial responses are tuples of journal_shipment, see replica
+		return db.follow_journal(chunk_size, max_backlog)
+
+	def cmd_unwatch(session, request_id):
+		if stream := stream_by_session[session].get(request_id):
+			stream.close()
 
 	def cmd_session_lock(session, path):
 		with lock_guard:
@@ -114,22 +293,40 @@ with database_core(journal_auto_flush_timeout=None) as db:
 			lock = lock_by_path.pop(path)
 			lock_by_session[session].discard(lock)
 
-	def check_write_lock(session, path):
-		if lock := lock_by_path.get(path):
-			match lock:
-				case session_lock():
-					assert session is lock.session
-
-	command_set = dict(
+	return dict(
+		ping = cmd_ping,
 		get_db_info = cmd_get_db_info,
+		get_metrics = cmd_get_metrics,
 		iter_all_object_paths = cmd_iter_all_object_paths,
+		list_paths = cmd_list_paths,
 		require = cmd_require,
 		get = cmd_get,
 		set = cmd_set,
+		compare_and_set = cmd_compare_and_set,
+		set_stream_open = cmd_set_stream_open,
+		set_stream_write = cmd_set_stream_write,
+		set_stream_commit = cmd_set_stream_commit,
+		set_stream_abort = cmd_set_stream_abort,
+		get_stream_open = cmd_get_stream_open,
+		get_stream_read = cmd_get_stream_read,
+		get_stream_close = cmd_get_stream_close,
 		session_lock = cmd_session_lock,
 		session_unlock = cmd_session_unlock,
 		get_meta = cmd_get_meta,
+		multi_get = cmd_multi_get,
+		multi_set = cmd_multi_set,
+		batch = cmd_batch,
+		get_at = cmd_get_at,
+		restore_to = cmd_restore_to,
+		compact_archive = cmd_compact_archive,
+		watch = cmd_watch,
+		unwatch = cmd_unwatch,
+		follow_journal = cmd_follow_journal,
 	)
 
-	with query_server(('0.0.0.0', 55201), query_handler) as server:
-		server.serve_forever()
+
+if __name__ == '__main__':
+	with database_core(journal_auto_flush_timeout=None) as db:
+		with query_server(('0.0.0.0', 55201), create_command_set(db), metrics=db.metrics) as server:
+			server.serve_forever()
+
@@ -0,0 +1,93 @@
+#Indexed snapshot format, an alternative to a single pickled tuple of entries.
+#Layout: magic, individually pickled values, pickled index, footer (index offset, index length, magic).
+#The file is read through mmap, opening it only decodes the index and values are decoded on first use.
+
+from . import storage_types
+from .pickling import db_dumps, db_loads, db_unpickler
+from .compression import open_decompressed
+
+import mmap, struct
+
+SNAPSHOT_MAGIC = b'PSS1'
+snapshot_footer = struct.Struct('<QQ4s')
+
+
+class snapshot_value:
+	#Value still residing in a memory mapped snapshot
+	__slots__ = ('snapshot', 'offset', 'length', 'type')
+
+	def __init__(self, snapshot, offset, length, type):
+		self.snapshot = snapshot
+		self.offset = offset
+		self.length = length
+		self.type = type
+
+	def raw(self):
+		return self.snapshot.map[self.offset:self.offset + self.length]
+
+	def load(self):
+		return db_loads(self.raw())
+
+	def __reduce__(self):
+		#Pickling a value that was never decoded just passes its serialized form along
+		return (db_loads, (self.raw(),))
+
+	def __repr__(self):
+		return f'{self.__class__.__name__}({self.type.__name__}, {self.length} bytes)'
+
+
+def write_indexed_snapshot(file, entries):
+	file.write(SNAPSHOT_MAGIC)
+	index = list()
+	for entry in entries:
+		value = entry.value
+		if isinstance(value, snapshot_value):
+			data, value_type = value.raw(), value.type
+		else:
+			data, value_type = db_dumps(value), type(value)
+
+		offset = file.tell()
+		file.write(data)
+		index.append((entry.path, value_type, entry.created, entry.updated, entry.accessed, offset, len(data), entry.version))
+
+	index_offset = file.tell()
+	index_data = db_dumps(tuple(index))
+	file.write(index_data)
+	file.write(snapshot_footer.pack(index_offset, len(index_data), SNAPSHOT_MAGIC))
+
+
+class indexed_snapshot:
+	def __init__(self, file):
+		self.map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+	def __iter__(self):
+		index_offset, index_length, magic = snapshot_footer.unpack_from(self.map, len(self.map) - snapshot_footer.size)
+		if magic != SNAPSHOT_MAGIC:
+			raise ValueError('Indexed snapshot is missing its footer')
+
+		#Snapshots written before entries were versioned have no version in the index
+		for path, value_type, created, updated, accessed, offset, length, *version in db_loads(self.map[index_offset:index_offset + index_length]):
+			yield storage_types.entry(path, snapshot_value(self, offset, length, value_type), created, updated, accessed, version=version[0] if version else 1)
+
+
+def read_snapshot(file):
+	#Entries of a snapshot in either format, possibly compressed. file must stay open while the entries are used.
+	header = file.read(len(SNAPSHOT_MAGIC))
+	if header == SNAPSHOT_MAGIC:
+		return indexed_snapshot(file)
+	elif header:
+		file.seek(0)
+		if decompressed_file := open_decompressed(file):
+			with decompressed_file:
+				return upgrade_entries(db_unpickler(decompressed_file).load())
+		return upgrade_entries(db_unpickler(file).load())
+	else:
+		return ()
+
+
+def upgrade_entries(entries):
+	#Entries of pickled snapshots written before entries were versioned are restored without a version
+	for entry in entries:
+		if not hasattr(entry, 'version'):
+			entry.version = 1
+	return entries
@@ -1,6 +1,8 @@
 from efforting.mvp4 import type_system as TS
 from efforting.mvp4.type_system.bases import public_base
 
+from collections.abc import Mapping
+
 
 class namespace:
 	def __init__(self, *initial_sources, **initial_values):
@@ -38,12 +40,74 @@ class namespace:
 		return self._data == other._data
 
 
+class frozen_namespace(namespace):
+	def __setattr__(self, key, value):
+		raise TypeError(f'{self.__class__.__name__} is immutable')
+
+	def __delattr__(self, key):
+		raise TypeError(f'{self.__class__.__name__} is immutable')
+
+	def __hash__(self):
+		return hash(frozenset(self._data.items()))
+
+
+class frozen_mapping(Mapping):
+	#Read only dict equivalent used when database_core.freeze_values is set
+	__slots__ = ('_data',)
+
+	def __init__(self, *initial_sources, **initial_values):
+		object.__setattr__(self, '_data', dict(*initial_sources, **initial_values))
+
+	def __setattr__(self, key, value):
+		raise TypeError(f'{self.__class__.__name__} is immutable')
+
+	def __getitem__(self, key):
+		return self._data[key]
+
+	def __iter__(self):
+		return iter(self._data)
+
+	def __len__(self):
+		return len(self._data)
+
+	def __repr__(self):
+		return f'{self.__class__.__name__}({self._data!r})'
+
+	def __hash__(self):
+		return hash(frozenset(self._data.items()))
+
+
+class blob_reference:
+	#Stored value of a blob kept out of line in a blob_store file, see database_core.store_stream
+	__slots__ = ('digest', 'size')
+
+	def __init__(self, digest, size):
+		object.__setattr__(self, 'digest', digest)
+		object.__setattr__(self, 'size', size)
+
+	def __setattr__(self, key, value):
+		raise TypeError(f'{self.__class__.__name__} is immutable')
+
+	def __reduce__(self):
+		return (self.__class__, (self.digest, self.size))
+
+	def __repr__(self):
+		return f'{self.__class__.__name__}({self.digest!r}, {self.size!r})'
+
+	def __eq__(self, other):
+		return isinstance(other, blob_reference) and self.digest == other.digest
+
+	def __hash__(self):
+		return hash(self.digest)
+
+
 class entry(public_base):
 	path = TS.positional()
 	value = TS.positional()
 	created = TS.positional()
 	updated = TS.positional()
 	accessed = TS.positional()
+	version = TS.named(1)		#Incremented by every update, see database_core.compare_and_set
 
 class immutable_entry(public_base):
 	path = TS.positional(read_only=True)
@@ -51,6 +115,7 @@ class immutable_entry(public_base):
 	created = TS.positional(read_only=True)
 	updated = TS.positional(read_only=True)
 	accessed = TS.positional(read_only=True)
+	version = TS.named(1, read_only=True)
 
 class meta_entry(public_base):
 	path = TS.positional(read_only=True)
@@ -58,3 +123,4 @@ class meta_entry(public_base):
 	created = TS.positional(read_only=True)
 	updated = TS.positional(read_only=True)
 	accessed = TS.positional(read_only=True)
+	version = TS.named(1, read_only=True)
@@ -0,0 +1,124 @@
+from efforting.mvp4 import type_system as TS
+from efforting.mvp4.type_system.bases import public_base
+
+from collections import deque
+import threading
+
+
+class change_notification(public_base):
+	kind = TS.positional(read_only=True)		#'create', 'update', 'current' (changed since last_known_updated when subscribing) or 'overflow'
+	path = TS.positional(read_only=True)
+	updated = TS.positional(read_only=True)
+	value = TS.named(None, read_only=True)		#Only set for subscriptions that include values
+
+
+def path_prefixes(path):
+	#'a.b.c' -> '', 'a', 'a.b', 'a.b.c'
+	yield ''
+	position = path.find('.')
+	while position != -1:
+		yield path[:position]
+		position = path.find('.', position + 1)
+	yield path
+
+def matches_prefix(prefix, path):
+	return not prefix or path == prefix or path.startswith(f'{prefix}.')
+
+
+class subscription(public_base):
+	prefix = TS.positional()
+	include_values = TS.named(False)
+	max_backlog = TS.named(10000)		#A subscriber that falls further behind than this is dropped with an 'overflow' notification
+	listener = TS.named(None)			#Called (from the writing thread) whenever notifications become available
+
+	pending = TS.factory(deque)
+	signal = TS.factory(threading.Condition)
+	closed = TS.state(False)
+	registry = TS.state(None)
+
+	def push(self, notification, bounded=True):
+		with self.signal:
+			if self.closed:
+				return
+			overflow = bounded and len(self.pending) >= self.max_backlog
+			if overflow:
+				#Whatever was dropped can be recovered by subscribing again with the time of the oldest dropped change as last_known_updated
+				oldest = self.pending[0].updated if self.pending else notification.updated
+				self.pending.clear()
+				self.pending.append(change_notification('overflow', self.prefix, oldest))
+				self.closed = True
+			else:
+				self.pending.append(notification)
+			self.signal.notify_all()
+
+		if overflow and self.registry:
+			self.registry.remove(self)
+		if self.listener:
+			self.listener()
+
+	def close(self):
+		#Pending notifications can still be taken after closing
+		with self.signal:
+			self.closed = True
+			self.signal.notify_all()
+
+		if self.registry:
+			self.registry.remove(self)
+		if self.listener:
+			self.listener()
+
+	def take(self, timeout=None):
+		#Returns a tuple of everything pending, an empty tuple on timeout or None once closed and fully taken
+		with self.signal:
+			if not self.pending and not self.closed:
+				self.signal.wait(timeout)
+
+			if self.pending:
+				taken = tuple(self.pending)
+				self.pending.clear()
+				return taken
+			elif self.closed:
+				return None
+			else:
+				return ()
+
+	def __iter__(self):
+		while (batch := self.take()) is not None:
+			yield batch
+
+
+class subscription_registry(public_base):
+	#Subscriptions are keyed by the exact prefix they watch so a change only costs one lookup per path segment no matter how many sessions watch.
+	#The sets are replaced rather than mutated so publishing doesn't need the lock.
+	by_prefix = TS.factory(dict)
+	lock = TS.factory(threading.Lock)
+
+	def add(self, subscription):
+		subscription.registry = self
+		with self.lock:
+			self.by_prefix[subscription.prefix] = self.by_prefix.get(subscription.prefix, frozenset()) | {subscription}
+
+	def remove(self, subscription):
+		with self.lock:
+			if remaining := self.by_prefix.get(subscription.prefix, frozenset()) - {subscription}:
+				self.by_prefix[subscription.prefix] = remaining
+			else:
+				self.by_prefix.pop(subscription.prefix, None)
+
+	def publish(self, change):
+		#Must be called while holding the write_lock stripe for change.path so notifications for a path arrive in order
+		if not self.by_prefix:
+			return
+
+		without_value = with_value = None
+		for prefix in path_prefixes(change.path):
+			for subscription in self.by_prefix.get(prefix, ()):
+				#One notification object per change is shared by every subscriber
+				if subscription.include_values:
+					if with_value is None:
+						with_value = change_notification(type(change).__name__, change.path, change.time, value=change.value)
+					subscription.push(with_value)
+				else:
+					if without_value is None:
+						without_value = change_notification(type(change).__name__, change.path, change.time)
+					subscription.push(without_value)
@@ -0,0 +1,85 @@
+#Sparse time index over the sections of a journal file (archive, segment, rotated or recovery journal).
+#Each section is indexed by its offset and the time span of its entries so that history between two points in time
+#can be read without decoding the sections outside of it. Journal files only grow (or are replaced), the index is
+#therefore updated incrementally and rebuilt when the file was replaced or truncated.
+
+from .journal_format import section_reader
+from .pickling import db_dumps, db_loads
+
+import os
+
+INDEX_SUFFIX = '.time-index'
+
+
+def entry_time_span(entries):
+	times = [entry.time for entry in entries]
+	return min(times), max(times)
+
+
+class section_time_index:
+	def __init__(self, filename, persist=True):
+		self.filename = filename
+		self.persist = persist			#Keep the index in <filename>.time-index between runs
+		self.identity = None			#Inode of the indexed file
+		self.indexed_size = 0
+		self.sections = list()			#(offset, first time, last time)
+		self.loaded = False
+
+	def load(self):
+		self.loaded = True
+		if self.persist and os.path.exists(index_filename := f'{self.filename}{INDEX_SUFFIX}'):
+			with open(index_filename, 'rb') as index_file:
+				self.identity, self.indexed_size, self.sections = db_loads(index_file.read())
+
+	def save(self):
+		index_filename = f'{self.filename}{INDEX_SUFFIX}'
+		with open(f'{index_filename}.tmp', 'wb') as index_file:
+			index_file.write(db_dumps((self.identity, self.indexed_size, self.sections)))
+		os.replace(f'{index_filename}.tmp', index_filename)
+
+	def update(self):
+		if not self.loaded:
+			self.load()
+
+		try:
+			status = os.stat(self.filename)
+		except FileNotFoundError:
+			self.identity, self.indexed_size, self.sections = None, 0, list()
+			return
+
+		if status.st_ino != self.identity or status.st_size < self.indexed_size:
+			self.identity, self.indexed_size, self.sections = status.st_ino, 0, list()
+		elif status.st_size == self.indexed_size:
+			return
+
+		with open(self.filename, 'rb') as journal_file:
+			journal_file.seek(self.indexed_size)
+			reader = section_reader(journal_file)
+			offset = self.indexed_size
+			for entries in reader:
+				if entries:
+					self.sections.append((offset, *entry_time_span(entries)))
+				offset = reader.valid_end
+
+			#A torn tail is either still being written or will be truncated by recovery, it is indexed once complete
+			self.indexed_size = reader.valid_end
+
+		if self.persist:
+			self.save()
+
+	def read(self, after=None, until=None):
+		#Yields sections that may hold entries with after < time <= until
+		self.update()
+		if not self.sections:
+			return
+
+		with open(self.filename, 'rb') as journal_file:
+			for offset, first_time, last_time in self.sections:
+				if after is not None and last_time <= after:
+					continue
+				if until is not None and first_time > until:
+					continue
+				journal_file.seek(offset)
+				for entries in section_reader(journal_file):
+					yield entries
+					break
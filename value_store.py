@@ -0,0 +1,75 @@
+#Values spilled out of memory by database_core when resident values exceed memory_budget.
+#A spilled value is pickled on its own and appended to the value store file, the entry keeps a spilled_value in place of the value.
+#spilled_value is a snapshot_value so it is decoded on first use like values of an indexed snapshot (see database_core.resolve_value).
+#Pickling a spilled_value only writes its location so snapshots refer to the value store instead of holding the value again.
+#The file is append only, values that are no longer referenced are not reclaimed since checkpoints may still refer to them.
+
+from .snapshot_format import snapshot_value
+from .pickling import db_dumps
+
+import threading, os
+
+
+class spilled_value(snapshot_value):
+	#snapshot is the value_store holding the value, it is None until bound (see bind) when unpickled from a snapshot
+	__slots__ = ('version',)		#Version of the entry the value belongs to, a faulted in value is spilled again without being written if unchanged
+
+	def __init__(self, store, offset, length, type, version):
+		super().__init__(store, offset, length, type)
+		self.version = version
+
+	def bind(self, store):
+		self.snapshot = store
+
+	def raw(self):
+		return self.snapshot.read(self.offset, self.length)
+
+	def __reduce__(self):
+		return (self.__class__, (None, self.offset, self.length, self.type, self.version))
+
+
+class value_store:
+	def __init__(self, filename):
+		self.filename = filename
+		self.descriptor = None		#Opened on first use so that databases that never spill don't create the file
+		self.size = 0
+		self.lock = threading.Lock()	#Guards opening and appending
+
+	def open(self):
+		#Must be called while holding lock
+		if self.descriptor is None:
+			self.descriptor = os.open(self.filename, os.O_RDWR | os.O_CREAT | os.O_APPEND)
+			self.size = os.fstat(self.descriptor).st_size		#Anything after the last sync may be garbage from a crash, nothing refers to it
+		return self.descriptor
+
+	def spill(self, value, version):
+		data = db_dumps(value)
+		with self.lock:
+			descriptor = self.open()
+			offset = self.size
+			with memoryview(data) as view:
+				written = 0
+				while written < len(data):
+					written += os.write(descriptor, view[written:])
+			self.size += len(data)
+		return spilled_value(self, offset, len(data), type(value), version)
+
+	def read(self, offset, length):
+		with self.lock:
+			descriptor = self.open()
+		data = os.pread(descriptor, length, offset)
+		if len(data) < length:
+			raise EOFError(f'{self.filename} ends before the spilled value at {offset}')
+		return data
+
+	def sync(self):
+		#Must be done before anything referring to spilled values (a snapshot) is made durable
+		with self.lock:
+			if self.descriptor is not None:
+				os.fsync(self.descriptor)
+
+	def close(self):
+		with self.lock:
+			if self.descriptor is not None:
+				os.close(self.descriptor)
+				self.descriptor = None
@@ -1,22 +1,205 @@
-from .pickling import db_unpickler
-
-def view_journal(filename):
-	with open(filename, 'rb') as infile:
-		while True:
-			unpickler = db_unpickler(infile)
-			try:
-				entries = unpickler.load()
-			except EOFError:
-				break
-
-			print('---= Section =---')
-			for entry in entries:
+from . import journal_types
+from .journal_format import section_reader
+from .time_index import section_time_index, INDEX_SUFFIX
+from .subscriptions import matches_prefix
+from .pickling import db_dumps
+
+import heapq, os
+
+
+class entry_filter:
+	def __init__(self, prefix=None, kinds=None, after=None, until=None):
+		self.prefix = prefix
+		self.kinds = kinds		#Set of 'access', 'create' and 'update', None for all
+		self.after = after
+		self.until = until
+
+	def sections(self, filename):
+		if self.after is None and self.until is None:
+			with open(filename, 'rb') as infile:
+				reader = section_reader(infile)
+				yield from reader
+				torn, valid_end = reader.torn, reader.valid_end
+		else:
+			#Skip sections outside the time range, the index is only kept if the file already has one.
+			#The index covers the file up to a torn tail.
+			index = section_time_index(filename, persist=os.path.exists(f'{filename}{INDEX_SUFFIX}'))
+			yield from index.read(self.after, self.until)
+			valid_end = index.indexed_size
+			torn = os.path.getsize(filename) > valid_end
+
+		if torn:
+			print(f'---= Torn section at offset {valid_end} =---')
+
+	def events(self, entries):
+		#Flattens entries into (kind, path, time, weight, change) events that pass the filter.
+		#weight is the number of accesses an event stands for, change is the create or update entry for writes.
+		for entry in entries:
+			match entry:
+				case journal_types.batch(changes=changes):
+					yield from self.events(changes)
+					continue
+				case journal_types.update():
+					events = (('update', entry.path, entry.time, 1, entry),)
+				case journal_types.create():
+					events = (('create', entry.path, entry.time, 1, entry),)
+				case journal_types.access():
+					events = (('access', entry.path, entry.time, 1, None),)
+				case journal_types.access_batch(paths=paths, timestamps=timestamps):
+					events = (('access', path, timestamp, 1, None) for path, timestamp in zip(paths, timestamps))
+				case journal_types.access_summary(paths=paths, counts=counts, timestamps=timestamps):
+					events = (('access', path, timestamp, count, None) for path, count, timestamp in zip(paths, counts, timestamps))
+				case _:
+					raise TypeError(entry)
+
+			for kind, path, timestamp, weight, change in events:
+				if self.kinds is not None and kind not in self.kinds:
+					continue
+				if self.prefix is not None and not matches_prefix(self.prefix, path):
+					continue
+				if (self.after is not None and timestamp <= self.after) or (self.until is not None and timestamp > self.until):
+					continue
+				yield kind, path, timestamp, weight, change
+
+
+class top_k:
+	#Space saving heavy hitters, counts are overestimated by at most error and memory is bounded by capacity
+	def __init__(self, capacity=1000):
+		self.capacity = capacity
+		self.counters = dict()		#key -> [count, error, first time, last time]
+		self.heap = list()			#(count, key), entries are stale when count no longer matches
+
+	def add(self, key, weight=1, timestamp=None):
+		if counter := self.counters.get(key):
+			counter[0] += weight
+			counter[3] = timestamp
+		elif len(self.counters) < self.capacity:
+			counter = self.counters[key] = [weight, 0, timestamp, timestamp]
+		else:
+			#Replace the smallest counter, the newcomer inherits its count as error
+			while True:
+				count, smallest = heapq.heappop(self.heap)
+				if self.counters[smallest][0] == count:
+					break
+			del self.counters[smallest]
+			counter = self.counters[key] = [count + weight, count, timestamp, timestamp]
+
+		heapq.heappush(self.heap, (counter[0], key))
+		if len(self.heap) > 4 * self.capacity:
+			self.heap = [(counter[0], key) for key, counter in self.counters.items()]
+			heapq.heapify(self.heap)
+
+	def most_common(self, count):
+		return heapq.nlargest(count, ((key, *counter) for key, counter in self.counters.items()), key=lambda item: item[1])
+
+
+class log2_histogram:
+	def __init__(self):
+		self.buckets = [0] * 64		#Bucket n counts values with bit length n
+		self.total = 0
+		self.count = 0
+
+	def add(self, value):
+		self.buckets[min(int(value).bit_length(), 63)] += 1
+		self.total += value
+		self.count += 1
+
+	def rows(self):
+		for bits, count in enumerate(self.buckets):
+			if count:
+				yield (1 << bits - 1 if bits else 0), (1 << bits) - 1, count
+
+
+class journal_analysis:
+	def __init__(self, entry_filter, top_capacity=1000, measure_values=True):
+		self.entry_filter = entry_filter
+		self.measure_values = measure_values		#Pickling every written value to measure it is the most expensive part of the analysis
+		self.reads = top_k(top_capacity)
+		self.writes = top_k(top_capacity)
+		self.written_bytes = top_k(top_capacity)
+		self.value_sizes = log2_histogram()
+		self.section_sizes = log2_histogram()
+		self.totals = dict(access=0, create=0, update=0)
+		self.first_time = self.last_time = None
+
+	def add_section(self, entries):
+		self.section_sizes.add(len(entries))
+		for kind, path, timestamp, weight, change in self.entry_filter.events(entries):
+			self.totals[kind] += weight
+			self.first_time = timestamp if self.first_time is None else min(self.first_time, timestamp)
+			self.last_time = timestamp if self.last_time is None else max(self.last_time, timestamp)
+			if kind == 'access':
+				self.reads.add(path, weight, timestamp)
+			else:
+				self.writes.add(path, 1, timestamp)
+				if self.measure_values:
+					size = len(db_dumps(change.value))
+					self.value_sizes.add(size)
+					self.written_bytes.add(path, size, timestamp)
+
+	def analyze(self, filename):
+		for entries in self.entry_filter.sections(filename):
+			self.add_section(entries)
+
+	def report(self, top=20):
+		print('---= Totals =---')
+		for kind, count in self.totals.items():
+			print(f'{kind:>8}: {count}')
+		if self.first_time is not None:
+			print(f'    span: {self.last_time - self.first_time:.1f} s')
+
+		print('---= Hottest read paths (count, max overcount) =---')
+		for path, count, error, first_time, last_time in self.reads.most_common(top):
+			print(f'{count:>12} {error:>10}  {path}')
+
+		print('---= Hottest write paths (count, max overcount, writes per second while active) =---')
+		for path, count, error, first_time, last_time in self.writes.most_common(top):
+			rate = count / (last_time - first_time) if last_time > first_time else float('nan')
+			print(f'{count:>12} {error:>10} {rate:>12.2f}  {path}')
+
+		if self.measure_values:
+			print('---= Most written bytes (bytes, max overcount) =---')
+			for path, count, error, first_time, last_time in self.written_bytes.most_common(top):
+				print(f'{count:>12} {error:>10}  {path}')
+
+			print('---= Serialized value size (bytes) =---')
+			for low, high, count in self.value_sizes.rows():
+				print(f'{low:>12} - {high:<12} {count}')
+
+		print('---= Entries per section =---')
+		for low, high, count in self.section_sizes.rows():
+			print(f'{low:>12} - {high:<12} {count}')
+
+
+def view_journal(filename, selection=None):
+	selection = selection or entry_filter()
+	for entries in selection.sections(filename):
+		print('---= Section =---')
+		for entry in entries:
+			if any(selection.events((entry,))):
 				print('JOURNAL', repr(entry))
 
+
 if __name__ == '__main__':
 	import argparse
 	parser = argparse.ArgumentParser(description='View journal file')
-	parser.add_argument('filename', type=str, help='Filename of the journal')
+	parser.add_argument('filenames', type=str, nargs='+', help='Filename of the journal (several files are analyzed together)')
+	parser.add_argument('--analyze', action='store_true', help='Print aggregate statistics instead of entries')
+	parser.add_argument('--prefix', type=str, help='Only paths at or below this path')
+	parser.add_argument('--kind', type=str, action='append', choices=('access', 'create', 'update'), help='Only entries of this kind (may be repeated)')
+	parser.add_argument('--after', type=float, help='Only entries after this time (seconds since epoch)')
+	parser.add_argument('--until', type=float, help='Only entries up to this time (seconds since epoch)')
+	parser.add_argument('--top', type=int, default=20, help='Number of paths to list in each ranking')
+	parser.add_argument('--top-capacity', type=int, default=1000, help='Number of paths tracked per ranking, bounds memory use')
+	parser.add_argument('--no-value-sizes', action='store_true', help='Skip measuring serialized value sizes')
 	args = parser.parse_args()
 
-	view_journal(args.filename)
+	selection = entry_filter(args.prefix, set(args.kind) if args.kind else None, args.after, args.until)
+	if args.analyze:
+		analysis = journal_analysis(selection, args.top_capacity, not args.no_value_sizes)
+		for filename in args.filenames:
+			analysis.analyze(filename)
+		analysis.report(args.top)
+	else:
+		for filename in args.filenames:
+			view_journal(filename, selection)
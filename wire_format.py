@@ -0,0 +1,220 @@
+#Wire protocols between service clients and endpoints.
+#
+#PROTOCOL_LEGACY: one db_pickler stream per direction for the lifetime of the connection.
+#	The pickler memo spans messages so every object ever sent stays referenced until the connection closes.
+#
+#PROTOCOL_FRAMED: every message is pickled on its own (protocol 5) and sent as a frame:
+#	payload length, out of band buffer count, the length of each buffer, payload, buffers.
+#	bytes values of at least out_of_band_threshold bytes are not copied into the payload but sent as out of band buffers.
+#
+#A client offers the protocols it supports with a hello, the endpoint answers with the one it picked (0 if none).
+#Clients that start pickling right away (0x80, the pickle PROTO opcode, as first byte) are served with PROTOCOL_LEGACY.
+
+from .pickling import db_pickler, db_unpickler, stream_decoder, stream_encoder
+
+import pickle, struct, io
+
+PROTOCOL_LEGACY = 1
+PROTOCOL_FRAMED = 2
+SUPPORTED_PROTOCOLS = (PROTOCOL_FRAMED, PROTOCOL_LEGACY)	#In order of preference
+
+HELLO_MAGIC = b'PSWH'
+hello_header = struct.Struct('<4sH')			#magic, number of offered protocols (followed by that many protocol_number)
+hello_reply = struct.Struct('<4sH')			#magic, picked protocol
+protocol_number = struct.Struct('<H')
+frame_header = struct.Struct('<IH')			#payload length, buffer count (followed by that many buffer_length)
+buffer_length = struct.Struct('<Q')
+
+OUT_OF_BAND_THRESHOLD = 64 * 1024
+
+
+class protocol_error(Exception):
+	pass
+
+
+def encode_hello(protocols):
+	return hello_header.pack(HELLO_MAGIC, len(protocols)) + b''.join(protocol_number.pack(protocol) for protocol in protocols)
+
+def decode_hello(data):
+	#Returns (offered protocols, size of hello) or None if data doesn't hold the whole hello yet
+	if len(data) < hello_header.size:
+		return None
+	magic, count = hello_header.unpack_from(data)
+	if magic != HELLO_MAGIC:
+		raise protocol_error('Invalid hello')
+	size = hello_header.size + count * protocol_number.size
+	if len(data) < size:
+		return None
+	return tuple(protocol_number.unpack_from(data, hello_header.size + n * protocol_number.size)[0] for n in range(count)), size
+
+def is_hello(first_byte):
+	return first_byte == HELLO_MAGIC[:1]
+
+def pick_protocol(offered):
+	for protocol in SUPPORTED_PROTOCOLS:
+		if protocol in offered:
+			return protocol
+	return 0
+
+
+class wire_pickler(db_pickler):
+	def __init__(self, file, buffer_callback, out_of_band_threshold):
+		super().__init__(file, protocol=5, buffer_callback=buffer_callback)
+		self.out_of_band_threshold = out_of_band_threshold
+
+	def reducer_override(self, item):
+		if type(item) is bytes and len(item) >= self.out_of_band_threshold:
+			return (bytes, (pickle.PickleBuffer(item),))
+		return super().reducer_override(item)
+
+
+def encode_frame(message, out_of_band_threshold=OUT_OF_BAND_THRESHOLD):
+	#Returns the chunks making up the frame, large bytes values are passed along without being copied
+	payload_buffer = io.BytesIO()
+	buffers = list()
+	wire_pickler(payload_buffer, buffers.append, out_of_band_threshold).dump(message)
+	payload = payload_buffer.getbuffer()
+	buffers = [buffer.raw() for buffer in buffers]
+	header = frame_header.pack(len(payload), len(buffers)) + b''.join(buffer_length.pack(buffer.nbytes) for buffer in buffers)
+	return [header, payload, *buffers]
+
+def decode_payload(payload, buffers):
+	return db_unpickler(io.BytesIO(payload), buffers=buffers).load()
+
+
+def read_exactly(rfile, size):
+	data = rfile.read(size)
+	if len(data) < size:
+		raise EOFError()
+	return data
+
+def read_frame(rfile):
+	payload_length, buffer_count = frame_header.unpack(read_exactly(rfile, frame_header.size))
+	lengths = struct.unpack(f'<{buffer_count}Q', read_exactly(rfile, buffer_count * buffer_length.size)) if buffer_count else ()
+	payload = read_exactly(rfile, payload_length)
+	buffers = list()
+	for length in lengths:
+		buffer = bytearray(length)
+		if rfile.readinto(buffer) < length:
+			raise EOFError()
+		buffers.append(buffer)
+	return decode_payload(payload, buffers)
+
+
+class channel:
+	#Blocking message channel over the buffered files of a socket, writes are not flushed
+	def __init__(self, protocol, rfile, wfile, out_of_band_threshold=OUT_OF_BAND_THRESHOLD):
+		self.protocol = protocol
+		self.rfile = rfile
+		self.wfile = wfile
+		self.out_of_band_threshold = out_of_band_threshold
+		if protocol == PROTOCOL_LEGACY:
+			self.unpickler = db_unpickler(rfile)
+			self.pickler = db_pickler(wfile)
+
+	def read(self):
+		if self.protocol == PROTOCOL_LEGACY:
+			return self.unpickler.load()
+		else:
+			return read_frame(self.rfile)
+
+	def write(self, message):
+		if self.protocol == PROTOCOL_LEGACY:
+			self.pickler.dump(message)
+		else:
+			for chunk in encode_frame(message, self.out_of_band_threshold):
+				self.wfile.write(chunk)
+
+	def flush(self):
+		self.wfile.flush()
+
+
+def accept_channel(rfile, wfile):
+	#Endpoint side negotiation
+	first_byte = rfile.peek(1)[:1]
+	if not first_byte:
+		raise EOFError()
+	if not is_hello(first_byte):
+		return channel(PROTOCOL_LEGACY, rfile, wfile)
+
+	magic, count = hello_header.unpack(read_exactly(rfile, hello_header.size))
+	if magic != HELLO_MAGIC:
+		raise protocol_error('Invalid hello')
+	offered = struct.unpack(f'<{count}H', read_exactly(rfile, count * protocol_number.size))
+	protocol = pick_protocol(offered)
+	wfile.write(hello_reply.pack(HELLO_MAGIC, protocol))
+	wfile.flush()
+	if not protocol:
+		raise protocol_error(f'None of the offered protocols {offered} are supported')
+	return channel(protocol, rfile, wfile)
+
+def open_channel(rfile, wfile, protocols=SUPPORTED_PROTOCOLS):
+	#Client side negotiation, offering only PROTOCOL_LEGACY skips the hello so that endpoints predating negotiation can be used
+	if tuple(protocols) == (PROTOCOL_LEGACY,):
+		return channel(PROTOCOL_LEGACY, rfile, wfile)
+
+	wfile.write(encode_hello(protocols))
+	wfile.flush()
+	try:
+		magic, protocol = hello_reply.unpack(read_exactly(rfile, hello_reply.size))
+	except EOFError:
+		raise protocol_error('Connection closed during protocol negotiation, the endpoint might predate it (offer only PROTOCOL_LEGACY)') from None
+	if magic != HELLO_MAGIC:
+		raise protocol_error('Invalid hello reply')
+	if protocol not in protocols:
+		raise protocol_error(f'Endpoint supports none of the offered protocols {tuple(protocols)}')
+	return channel(protocol, rfile, wfile)
+
+
+class frame_decoder:
+	#Counterpart of stream_decoder for PROTOCOL_FRAMED
+	def __init__(self):
+		self.data = bytearray()
+
+	def feed(self, data):
+		self.data += data
+		position = 0
+		with memoryview(self.data) as view:
+			while len(view) - position >= frame_header.size:
+				payload_length, buffer_count = frame_header.unpack_from(view, position)
+				lengths_end = position + frame_header.size + buffer_count * buffer_length.size
+				if len(view) < lengths_end:
+					break
+				lengths = struct.unpack_from(f'<{buffer_count}Q', view, position + frame_header.size) if buffer_count else ()
+				payload_end = lengths_end + payload_length
+				end = payload_end + sum(lengths)
+				if len(view) < end:
+					break
+
+				buffers = list()
+				offset = payload_end
+				for length in lengths:
+					buffers.append(view[offset:offset + length])
+					offset += length
+
+				message = decode_payload(bytes(view[lengths_end:payload_end]), buffers)
+				for buffer in buffers:
+					buffer.release()
+				position = end
+				yield message
+
+		del self.data[:position]
+
+
+class frame_encoder:
+	#Counterpart of stream_encoder for PROTOCOL_FRAMED
+	def __init__(self, out_of_band_threshold=OUT_OF_BAND_THRESHOLD):
+		self.out_of_band_threshold = out_of_band_threshold
+
+	def encode(self, item):
+		return encode_frame(item, self.out_of_band_threshold)
+
+
+def create_codec(protocol):
+	#Returns (decoder, encoder) for non blocking use, encoders return a list of chunks
+	if protocol == PROTOCOL_LEGACY:
+		encoder = stream_encoder()
+		return stream_decoder(), lambda item: [encoder.encode(item)]
+	else:
+		encoder = frame_encoder()
+		return frame_decoder(), encoder.encode